@@ -26,7 +26,7 @@ from .base import *
 from .. import ip_address
 from ..ip_address import ip_address_build
 from ..fdm.packet import AsyncPacketSock
-from ..fdm.stream import AsyncDataStream
+from ..fdm.stream import AsyncFramedStream
 
 # ----------------------------------------------------------------------------- question / RR sections
 
@@ -353,38 +353,16 @@ class ResolverConfig:
       return DNSLookupManager(ed, ns_addr=self.get_addr())
 
 
-class DNSTCPStream(AsyncDataStream):
+class DNSTCPStream(AsyncFramedStream):
    def __init__(self, *args, **kwargs):
-      super().__init__(*args, **kwargs)
-      self.size = 2
+      super().__init__(*args, len_fmt='>H', **kwargs)
    
-   def process_input(self, data):
-      bytes_used = 0
-      bytes_left = len(data)
-      msgs = []
-      while (bytes_left > 2):
-        (l,) = struct.unpack('>H', data[bytes_used:bytes_used+2])
-        wb = l + 2
-        if (wb > bytes_left):
-          self.size = wb
-          break
-        msgs.append(data[bytes_used+2:bytes_used+wb])
-        bytes_used += wb
-        bytes_left -= wb
-      else:
-         self.size = 2
-      self.discard_inbuf_data(bytes_used)
-      
-      if (msgs):
-         self.process_msgs(msgs)
+   def process_frames(self, frames):
+      self.process_msgs(frames)
 
    def send_query(self, query):
       frame_data = query.get_dns_frame().binary_repr()
-      try:
-        header = struct.pack('>H', (len(frame_data)))
-      except struct.error as exc:
-        raise ValueError('Too much data.') from struct.error
-      self.send_bytes((header, frame_data))
+      self.send_frames((frame_data,))
 
 
 class DNSLookupManager:
@@ -516,7 +494,7 @@ class DNSLookupManager:
       
       query_list.append(query)
       
-      self.sock_udp.fl.sendto(dns_frame_str, self.ns_addr)
+      self.sock_udp.send_bytes((dns_frame_str,), self.ns_addr)
    
    def close_process(self):
       """Process close of UDP socket"""
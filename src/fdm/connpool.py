@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Pooling of outgoing stream connections.
+
+import logging
+import socket
+from collections import OrderedDict, deque
+from time import time as time_
+
+from .exceptions import CloseFD
+from .stream import AsyncDataStream
+
+_logger = logging.getLogger('gonium.fdm.connpool')
+_log = _logger.log
+
+# Stream handlers replaced while a stream is idle in the pool.
+_IDLE_HANDLERS = ('process_input', 'process_close')
+
+
+class ConnectionPool:
+   """Pool of outgoing stream connections, keyed by (host, port).
+
+   Connections handed back to the pool by release() are kept open and
+   handed out again by later connect() calls for the same destination.
+   Idle connections are closed when the peer sends data or closes them, when
+   they've been idle for longer than idle_timeout, and in LRU order when
+   more than idle_max of them are pooled.
+
+   public instance methods:
+      connect(host, port, stream_factory, connect_callback, **kwargs): Get
+         connected stream to specified destination.
+      release(stream): Return stream to pool for reuse.
+      close(): Close all idle connections and stop the sweep timer.
+   """
+   def __init__(self, sa, *, conns_per_host_max:int=8, idle_max:int=256,
+         idle_timeout:float=60, keepidle=(30, 10, 3), sweep_interval:float=4):
+      self._sa = sa
+      self.conns_per_host_max = conns_per_host_max
+      self.idle_max = idle_max
+      self.idle_timeout = idle_timeout
+      self.keepidle = keepidle
+
+      self._conns = {}           # key -> set of open streams
+      self._keys = {}            # stream -> key
+      self._idle = OrderedDict() # stream -> time of release; LRU first
+      self._idle_by_key = {}     # key -> list of idle streams; MRU last
+      self._waiters = {}         # key -> deque of pending connect() args
+      self._handlers = {}        # idle stream -> dict of handlers to restore
+      self._timer = sa.ed.set_timer(sweep_interval, self._sweep, persist=True)
+
+   def connect(self, host, port, stream_factory=AsyncDataStream,
+         connect_callback=None, **kwargs):
+      """Get connected stream to (host, port).
+
+      connect_callback(stream), if specified, is called once the stream is
+      usable. Returns the stream if one could be allocated immediately; if
+      the per-host connection limit has been hit, returns None and hands out
+      a stream through connect_callback once a connection is available (or,
+      without connect_callback, doesn't wait for one at all).
+      Other kwargs are passed to connect_async_sock_bydns() for new
+      connections."""
+      key = (host, port)
+      stream = self._idle_get(key, stream_factory)
+      if not (stream is None):
+         if not (connect_callback is None):
+            self._sa.ed.set_timer(0, connect_callback, args=(stream,),
+               interval_relative=False)
+         return stream
+
+      if (self._count(key) >= self.conns_per_host_max):
+         if (connect_callback is None):
+            # We'd have no way to hand the stream out.
+            return None
+         self._waiters.setdefault(key, deque()).append((stream_factory,
+            connect_callback, kwargs))
+         return None
+
+      return self._connect_new(key, stream_factory, connect_callback, kwargs)
+
+   def release(self, stream):
+      """Return stream to pool for reuse.
+
+      Streams that aren't connected or still have buffered in- or output
+      are closed instead. While the stream is idle, the pool handles its
+      input and close events; process_input and process_close set on the
+      instance are restored when it's handed out again."""
+      key = self._keys.get(stream)
+      if ((key is None) or (not stream) or (not stream.connected) or
+            stream._outbuf or stream._index_in):
+         self._discard(stream)
+         return
+
+      waiters = self._waiters.get(key)
+      if (waiters):
+         (stream_factory, connect_callback, kwargs) = waiters.popleft()
+         if not (waiters):
+            del(self._waiters[key])
+         if not (isinstance(stream, stream_factory)):
+            # Can't use this one; make room for a new connection instead.
+            self._discard(stream)
+            self._connect_new(key, stream_factory, connect_callback, kwargs)
+            return
+         if not (connect_callback is None):
+            # Don't let the waiter get at the pool before we're done here.
+            self._sa.ed.set_timer(0, connect_callback, args=(stream,),
+               interval_relative=False)
+         return
+
+      if (len(self._idle) >= self.idle_max):
+         self._discard(next(iter(self._idle)))
+
+      # Keep any handlers the user set on the instance, for when it's handed
+      # out again.
+      self._handlers[stream] = dict((name, vars(stream)[name]) for name in
+         _IDLE_HANDLERS if (name in vars(stream)))
+      stream.process_input = self._idle_input
+      stream.process_close = self._idle_close
+      self._idle[stream] = time_()
+      self._idle_by_key.setdefault(key, []).append(stream)
+
+   def close(self):
+      """Close all idle connections and stop the sweep timer."""
+      if (self._timer):
+         self._timer.cancel()
+      while (self._idle):
+         self._discard(next(iter(self._idle)))
+      self._idle_by_key.clear()
+      self._waiters.clear()
+
+   def _connect_new(self, key, stream_factory, connect_callback, kwargs):
+      """Open new connection for specified key."""
+      def connect_cb(stream):
+         stream.sock_set_keepalive(1)
+         if not (self.keepidle is None):
+            stream.sock_set_keepidle(*self.keepidle)
+         if not (connect_callback is None):
+            connect_callback(stream)
+
+      stream = stream_factory(run_start=False)
+      self._conns.setdefault(key, set()).add(stream)
+      self._keys[stream] = key
+      stream.close_hook_add(lambda: self._stream_close(stream, key))
+      stream.connect_async_sock_bydns(self._sa, key[0], key[1],
+         connect_callback=connect_cb, **kwargs)
+      return stream
+
+   def _idle_get(self, key, stream_factory):
+      """Pop most recently used healthy idle stream for key, if any."""
+      streams = self._idle_by_key.get(key)
+      while (streams):
+         stream = streams[-1]
+         handlers = self._idle_remove(stream, key)
+         for name in _IDLE_HANDLERS:
+            if (name in handlers):
+               setattr(stream, name, handlers[name])
+            else:
+               # Expose the one defined by the class.
+               delattr(stream, name)
+         if ((not stream) or (not isinstance(stream, stream_factory)) or
+               (not self._sock_check(stream))):
+            self._discard(stream)
+            continue
+         return stream
+      return None
+
+   def _idle_remove(self, stream, key):
+      """Take stream out of the idle pool, and return the handlers saved
+         for it."""
+      del(self._idle[stream])
+      self._idle_by_key[key].remove(stream)
+      return self._handlers.pop(stream)
+
+   @staticmethod
+   def _sock_check(stream):
+      """Check idle stream socket for EOF or unexpected input."""
+      if not (stream.ssl_callback is None):
+         # Can't peek through the TLS layer; rely on idle input handling.
+         return True
+      try:
+         socket.socket.recv(stream.fl, 1, socket.MSG_PEEK)
+      except BlockingIOError:
+         return True
+      except (TypeError, EnvironmentError):
+         return False
+      return False
+
+   def _count(self, key):
+      """Return number of open streams for key, forgetting closed ones."""
+      streams = self._conns.get(key)
+      if (streams is None):
+         return 0
+      # Streams still being set up aren't open yet, but haven't been closed
+      # either; _process_close() drops their output buffer.
+      for stream in [s for s in streams if (s._outbuf is None)]:
+         self._forget(stream)
+      return len(streams)
+
+   def _forget(self, stream):
+      """Drop all bookkeeping for stream."""
+      key = self._keys.pop(stream, None)
+      if (key is None):
+         return
+      streams = self._conns[key]
+      streams.discard(stream)
+      if not (streams):
+         del(self._conns[key])
+
+   def _discard(self, stream):
+      """Close stream and forget about it."""
+      if (stream in self._idle):
+         self._idle_remove(stream, self._keys[stream])
+      self._forget(stream)
+      stream.close()
+
+   def _stream_close(self, stream, key):
+      """Process close of any of our streams, including failed connection
+         attempts: forget about it, and let waiters have the free slot."""
+      if (stream in self._idle):
+         self._idle_remove(stream, key)
+      self._forget(stream)
+      if (key in self._waiters):
+         self._sa.ed.set_timer(0, self._waiters_serve, args=(key,),
+            interval_relative=False)
+
+   def _waiters_serve(self, key):
+      """Open connections for waiters on key, as far as the limit allows."""
+      waiters = self._waiters.get(key)
+      if (waiters is None):
+         return
+      while (waiters and (self._count(key) < self.conns_per_host_max)):
+         (stream_factory, connect_callback, kwargs) = waiters.popleft()
+         self._connect_new(key, stream_factory, connect_callback, kwargs)
+      if not (waiters):
+         del(self._waiters[key])
+
+   def _idle_input(self, data):
+      """Process input on idle connection."""
+      raise CloseFD()
+
+   @staticmethod
+   def _idle_close():
+      """Process close of idle connection; our close hook takes care of
+         it."""
+      pass
+
+   def _sweep(self):
+      """Close timed-out idle connections and serve waiters."""
+      t_min = time_() - self.idle_timeout
+      while (self._idle):
+         (stream, ts) = next(iter(self._idle.items()))
+         if (ts > t_min):
+            break
+         self._discard(stream)
+
+      for key in list(self._waiters):
+         self._waiters_serve(key)
+
+
+def _selftest(out=None):
+   """Exercise pooling, waiters and failed connections on loopback."""
+   from ..service_aggregation import ServiceAggregate
+   if (out is None):
+      import sys
+      out = sys.stdout
+   
+   sa = ServiceAggregate()
+   ed = sa.ed
+   lsock = socket.socket()
+   lsock.bind(('127.0.0.1', 0))
+   lsock.listen(16)
+   port = lsock.getsockname()[1]
+   tmp = socket.socket()
+   tmp.bind(('127.0.0.1', 0))
+   port_dead = tmp.getsockname()[1]
+   tmp.close()
+   
+   pool = ConnectionPool(sa, conns_per_host_max=1)
+   log = []
+   def run(timeout=2):
+      timer = ed.set_timer(timeout, ed.shutdown)
+      ed.event_loop()
+      if (timer):
+         timer.cancel()
+   
+   def cb1(stream):
+      log.append('c1')
+      ed.set_timer(0, release1, args=(stream,), interval_relative=False)
+   def release1(stream):
+      pool.release(stream)
+      log.append('released')
+   def cb2(stream):
+      log.append('c2')
+      ed.shutdown()
+   s1 = pool.connect('127.0.0.1', port, connect_callback=cb1)
+   if not (pool.connect('127.0.0.1', port, connect_callback=cb2) is None):
+      raise Exception('Connection limit not applied.')
+   run()
+   out.write('Waiter: {0}\n'.format(log))
+   if (log != ['c1', 'released', 'c2']):
+      raise Exception('Waiter not handed released stream after release().')
+   
+   def process_input(data):
+      pass
+   s1.process_input = process_input
+   if ((pool.connect('127.0.0.1', port) is not None) or pool._waiters):
+      raise Exception('Waiter without callback queued.')
+   pool.release(s1)
+   if not (pool.connect('127.0.0.1', port) is s1):
+      raise Exception('Idle stream not reused.')
+   if ((s1.process_input is not process_input) or
+         ('process_close' in vars(s1))):
+      raise Exception('Stream handlers not restored on reuse.')
+   s1.close()
+   if (s1 in pool._keys):
+      raise Exception('Closed stream not forgotten.')
+   
+   del(log[:])
+   def cb_dead(stream):
+      log.append('dead')
+   s3 = pool.connect('127.0.0.1', port_dead, connect_callback=cb_dead)
+   s3.process_close = lambda: log.append('s3 closed')
+   pool.connect('127.0.0.1', port_dead,
+      connect_callback=lambda s: log.append('waiter connected'))
+   run(0.5)
+   out.write('Failed connection: {0} {1}\n'.format(log, pool._waiters))
+   if (pool._waiters or (not ('s3 closed' in log))):
+      raise Exception('Waiter not served after failed connection.')
+   
+   pool.close()
+   lsock.close()
+   out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+   import sys
+   _selftest(sys.stdout)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Coroutine interface to streams, driven by the FDM event dispatcher.
+
+import logging
+import sys
+import types
+
+from .exceptions import StreamClosed
+
+_logger = logging.getLogger('gonium.fdm.coro')
+_log = _logger.log
+
+
+@types.coroutine
+def _suspend():
+   """Suspend calling coroutine until StreamCoroutine resumes it."""
+   return (yield)
+
+
+class StreamCoroutine:
+   """Runs a coroutine doing I/O on an AsyncDataStream.
+
+   func(self, *args) is called to build the coroutine, which is run
+   immediately up to its first suspension. It's driven by the stream's
+   event dispatcher, not by asyncio, and may only await the methods of
+   this object (and other coroutines doing so). The coroutine is resumed
+   only once its pending read can be satisfied: readexactly() sets the
+   stream's size_need accordingly, and readuntil() continues scanning
+   where it previously left off.
+
+   Once the stream is closed, pending and later reads and drains raise
+   StreamClosed. An exception from the coroutine other than that is logged
+   and closes the stream.
+
+   The object takes over the stream's process_input handler.
+
+   public instance methods (awaitable):
+      readexactly(n): Return next n bytes of input
+      readuntil(sep, limit): Return input up to and including sep
+      drain(): Wait until pending output is down to write_low bytes, if
+        it exceeds write_high
+   public instance methods:
+      write(data): Queue data for output
+      close(): Close stream
+   Public attributes (intended for reading only):
+      stream: the AsyncDataStream
+      done: whether the coroutine has finished
+      result: return value of the coroutine
+      exception: exception the coroutine finished with, or None
+   Public attributes (r/w):
+      write_high, write_low: see drain()
+   public instance methods intended to be overridden:
+      process_done(): process end of coroutine
+   """
+   def __init__(self, stream, func, *args, write_high:int=65536,
+         write_low:int=16384):
+      self.stream = stream
+      self.write_high = write_high
+      self.write_low = write_low
+      self.done = False
+      self.result = None
+      self.exception = None
+      self._closed = not stream
+      self._running = False
+      # Pending read: None, ('exact', n) or ('until', sep, limit)
+      self._want = None
+      self._scan = 0
+      stream.process_input = self._process_input
+      stream.size_need = sys.maxsize
+      if not (self._closed):
+         stream.close_hook_add(self._process_close)
+      self._coro = func(self, *args)
+      self._step()
+
+   def _step(self, value=None, exc=None):
+      """Resume coroutine."""
+      self._running = True
+      try:
+         if (exc is None):
+            self._coro.send(value)
+         else:
+            self._coro.throw(exc)
+      except StopIteration as exc:
+         self._finish(exc.value, None)
+      except StreamClosed as exc:
+         self._finish(None, exc)
+      except Exception as exc:
+         _log(40, 'Exception in coroutine of {0}:'.format(self), exc_info=True)
+         self._finish(None, exc)
+         self.close()
+      finally:
+         self._running = False
+
+   def _finish(self, result, exc):
+      self.done = True
+      self.result = result
+      self.exception = exc
+      self._want = None
+      if (self.stream):
+         self.stream.size_need = sys.maxsize
+      try:
+         self.process_done()
+      except Exception:
+         _log(40, 'Error in done handler of {0}:'.format(self), exc_info=True)
+
+   def process_done(self):
+      """Process end of coroutine; intended to be overridden by instance
+         users."""
+      pass
+
+   def _take(self):
+      """Return data satisfying pending read and remove it from the stream's
+         buffer, or None if we don't have it yet."""
+      stream = self.stream
+      want = self._want
+      if (want[0] == 'exact'):
+         end = want[1]
+         if (stream._index_in < end):
+            stream.size_need = end
+            return None
+      else:
+         (sep, limit) = want[1:]
+         end = stream._inbuf.find(sep, self._scan, stream._index_in)
+         if (end < 0):
+            # Resume scanning where a match could still start.
+            self._scan = max(stream._index_in - len(sep) + 1, 0)
+            if ((limit is not None) and (self._scan >= limit)):
+               raise ValueError('Separator {0!a} not found in first {1} bytes.'.format(sep, limit))
+            stream.size_need = stream._index_in + 1
+            return None
+         end += len(sep)
+         self._scan = 0
+
+      rv = bytes(stream._inbuf[:end])
+      stream.discard_inbuf_data(end)
+      self._want = None
+      stream.size_need = sys.maxsize
+      return rv
+
+   async def _read(self, want):
+      if (self._closed):
+         raise StreamClosed()
+      self._want = want
+      rv = self._take()
+      if (rv is None):
+         rv = await _suspend()
+      return rv
+
+   def readexactly(self, n:int):
+      """Return next n bytes of input."""
+      return self._read(('exact', n))
+
+   def readuntil(self, sep:bytes, limit:int=None):
+      """Return input up to and including the next occurrence of sep.
+
+      If limit is specified, ValueError is raised if sep doesn't start
+      within the first limit bytes."""
+      return self._read(('until', bytes(sep), limit))
+
+   def write(self, data):
+      """Queue data for output, and try to send it."""
+      if (self._closed):
+         raise StreamClosed()
+      self.stream.send_bytes((data,))
+
+   async def drain(self):
+      """If more than write_high bytes of output are pending, wait until no
+         more than write_low bytes are."""
+      if (self._closed):
+         raise StreamClosed()
+      if (self.stream.output_pending() <= self.write_high):
+         return
+      self.stream.drain_notify(self._process_drain, self.write_low)
+      await _suspend()
+
+   def close(self):
+      """Close stream."""
+      self.stream.close()
+
+   def _process_input(self, data):
+      if ((self._want is None) or self._running):
+         return
+      try:
+         rv = self._take()
+      except ValueError as exc:
+         self._step(exc=exc)
+         return
+      if not (rv is None):
+         self._step(rv)
+
+   def _process_drain(self):
+      if not (self._running):
+         self._step()
+
+   def _process_close(self):
+      self._closed = True
+      if (self.done or self._running):
+         return
+      self.stream.drain_notify(None)
+      self._want = None
+      self._step(exc=StreamClosed())
+
+
+def _selftest(out=None):
+   """Run a small request/response protocol over a socketpair."""
+   import socket
+   import struct
+   from . import ED_get
+   from .stream import AsyncDataStream
+   if (out is None):
+      out = sys.stdout
+   
+   ed = ED_get()()
+   (sock_a, sock_b) = socket.socketpair()
+   for sock in (sock_a, sock_b):
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 16384)
+   stream = AsyncDataStream(ed, sock_a)
+   peer = AsyncDataStream(ed, sock_b)
+   del(sock, sock_a, sock_b)
+   body = bytes(range(256))*64
+   big = bytes(1 << 20)
+   
+   async def serve(co):
+      line = await co.readuntil(b'\n', limit=64)
+      (n,) = struct.unpack('>I', await co.readexactly(4))
+      data = await co.readexactly(n)
+      co.write(line)
+      co.write(data)
+      co.write(big)
+      await co.drain()
+      if (co.stream.output_pending() > co.write_low):
+         raise Exception('drain() returned early.')
+      await co.readexactly(1)
+   
+   co = StreamCoroutine(stream, serve)
+   co.process_done = lambda: ed.set_timer(0.1, ed.shutdown)
+   got = bytearray()
+   def process_input(data):
+      got.extend(data)
+      peer.discard_inbuf_data()
+      if (len(got) == 6 + len(body) + len(big)):
+         peer.close()
+   peer.process_input = process_input
+   # Trickle the request in, to have reads suspend.
+   req = b'hello\n' + struct.pack('>I', len(body)) + body
+   for (i, off) in enumerate(range(0, len(req), 1000)):
+      ed.set_timer(0.01*i, peer.send_bytes, args=((req[off:off+1000],),))
+   ed.set_timer(10, ed.shutdown)
+   ed.event_loop()
+   out.write('done={0} exception={1!a} got {2} bytes\n'.format(co.done,
+      co.exception, len(got)))
+   if not (co.done and isinstance(co.exception, StreamClosed)):
+      raise Exception('Coroutine not ended by stream close.')
+   if (bytes(got) != b'hello\n' + body + big):
+      raise Exception('Coroutine output mismatch.')
+   
+   # Exceeding a readuntil() limit is raised into the coroutine.
+   (sock_a, sock_b) = socket.socketpair()
+   stream = AsyncDataStream(ed, sock_a)
+   del(sock_a)
+   async def limited(co):
+      try:
+         await co.readuntil(b'\n', limit=8)
+      except ValueError:
+         return 'limit'
+   co = StreamCoroutine(stream, limited)
+   sock_b.sendall(b'0123456789')
+   co.process_done = ed.shutdown
+   ed.set_timer(5, ed.shutdown)
+   ed.event_loop()
+   if (co.result != 'limit'):
+      raise Exception('readuntil() limit not enforced.')
+   stream.close()
+   sock_b.close()
+   out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+   _selftest(sys.stdout)
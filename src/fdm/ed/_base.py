@@ -22,6 +22,7 @@ import numbers
 import os
 import threading
 
+from collections import deque
 from collections.abc import Callable
 from errno import EBADF
 from heapq import heappush, heapify
@@ -105,7 +106,12 @@ class _Timer:
 
 
 class EventDispatcherBase:
-   """Base class for event dispatchers."""
+   """Base class for event dispatchers.
+   
+   Public attributes (r/w):
+      autoflush: if set, streams defer pushing output passed to send_bytes()
+         until the end of the current event loop iteration
+   """
    FDC_INITIAL = 16
    def __init__(self, fdc_initial:int=0):
       fdc_initial = fdc_initial or self.FDC_INITIAL
@@ -113,6 +119,8 @@ class EventDispatcherBase:
       self.em_shutdown = EventMultiplexer(self)
       self._shutdown_pending = False
       self._timers = []
+      self.autoflush = False
+      self._flushl = deque()
    
    def fd_wrap(self, fd:int, set_nonblock:bool=True, fl=None):
       """Return FD wrapper based on this ED and specified fd
@@ -147,6 +155,23 @@ class EventDispatcherBase:
          """
       return _Timer(self, *args, **kwargs)
    
+   def flush_defer(self, func:Callable):
+      """Arrange for func() to be called once, after all events of the
+         current event loop iteration have been processed."""
+      self._flushl.append(func)
+   
+   def _flush_run(self):
+      """Call functions passed to flush_defer(), including any deferred by
+         them in turn."""
+      flushl = self._flushl
+      while (flushl):
+         func = flushl.popleft()
+         try:
+            func()
+         except Exception:
+            _log(40, 'Caught exception from deferred flush {0}:'.format(func),
+               exc_info=True)
+   
    def event_loop(self):
       """Run event loop; should be implemented in subclass."""
       raise NotImplementedError()
@@ -206,13 +231,14 @@ def _donothing(*args, **kwargs):
 
 
 class _FDWrap:
-   __slots__ = ('fd', 'process_readability', 'process_writability', 'process_close', '_ed', '_fl')
+   __slots__ = ('fd', 'process_readability', 'process_writability', 'process_close', 'process_error', 'hup_close', '_ed', '_fl')
    """FD associated monitored by a specific ED. Events are returned by calling
       attributes:
       process_readability() for READ
       process_writability() for WRITE
       process_close() for connection close
       process_hup() for hup events
+      process_error() for error events, if set; else the fd is closed
    """
    def __init__(self, ed:EventDispatcherBase, fd:int, fl=None):
       self._ed = ed
@@ -221,10 +247,13 @@ class _FDWrap:
       self.process_readability = None
       self.process_writability = None
       self.process_close = _donothing
+      self.process_error = None
+      self.hup_close = True
    
    def process_hup(self):
-      """Process hup. This implementation closes the fdw, if currently open"""
-      if (self):
+      """Process hup. This implementation closes the fdw, if currently open
+         and hup_close is set."""
+      if (self and self.hup_close):
          self.close()
    
    # For documentation only
@@ -19,6 +19,7 @@ from heapq import heappop, heappush
 import logging
 import select
 import time
+import weakref
 from collections import deque
 
 from ...event_multiplexing import EventMultiplexer
@@ -35,11 +36,19 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
    Timer registering/unregistering is thread-safe; nothing else is.
    Any interaction with instances of this class while its event_loop() is
    running in another thread should be done by setting (expired) timers, and
-   manipulating the instance from their callback handlers."""
+   manipulating the instance from their callback handlers.
+   
+   Filelikes with a vpoll() method are virtual: instead of asking the kernel
+   about them, we call their vpoll() (returning a (readable, writable)
+   tuple) after they've passed their fd to vfd_wake(). They're told about
+   us by a call to their vfd_attach(ed) method, and should call
+   vfd_remove() when closed."""
    def __init__(self, **kwargs):
       EventDispatcherBaseTT.__init__(self, **kwargs)
       self._fdml = [None]*len(self._fdwl)
       self._poll = self.CLS_POLL()
+      self._vfds = weakref.WeakValueDictionary()
+      self._vpending = set()
    
    def _fdl_sizeinc(self, *args, **kwargs):
       """Increase size of fdlists to at least the specified size"""
@@ -50,9 +59,45 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
       """Return FD wrapper based on this ED and specified fd"""
       rv = EventDispatcherBaseTT.fd_wrap(self, fd, *args, **kwargs)
       self._fdml[fd] = 0
+      fl = rv._fl
+      if (hasattr(fl, 'vpoll')):
+         self._vfds[fd] = fl
+         fl.vfd_attach(self)
+      return rv
+   
+   def vfd_wake(self, fd:int):
+      """Have readiness of virtual fd checked in the next loop iteration."""
+      self._vpending.add(fd)
+   
+   def vfd_remove(self, fd:int):
+      """Forget about virtual fd."""
+      self._vfds.pop(fd, None)
+      self._vpending.discard(fd)
+   
+   def _vfd_events(self):
+      """Return (fd, event) list for ready virtual fds."""
+      rv = []
+      pending = list(self._vpending)
+      self._vpending.clear()
+      for fd in pending:
+         fl = self._vfds.get(fd)
+         mask = self._fdml[fd]
+         if ((fl is None) or (not mask)):
+            continue
+         (readable, writable) = fl.vpoll()
+         event = ((self.POLLIN if readable else 0) |
+            (self.POLLOUT if writable else 0)) & mask
+         if (event):
+            rv.append((fd, event))
+            # Level-triggered, like the kernel's readiness.
+            self._vpending.add(fd)
       return rv
    
    def _fdcb_read_r(self,fd):
+      if (fd in self._vfds):
+         self._fdml[fd] |= self.POLLIN
+         self._vpending.add(fd)
+         return
       mask_old = self._fdml[fd]
       self._fdml[fd] |= self.POLLIN
       if (mask_old == 0):
@@ -66,12 +111,18 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
          return
       mask &= ~self.POLLIN
       self._fdml[fd] = mask
+      if (fd in self._vfds):
+         return
       if (mask == 0):
          self._poll.unregister(fd)
          return
       self._poll.modify(fd, mask)
       
    def _fdcb_write_r(self,fd):
+      if (fd in self._vfds):
+         self._fdml[fd] |= self.POLLOUT
+         self._vpending.add(fd)
+         return
       mask_old = self._fdml[fd]
       self._fdml[fd] |= self.POLLOUT
       if (mask_old == 0):
@@ -85,6 +136,8 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
          return
       mask &= ~self.POLLOUT
       self._fdml[fd] = mask
+      if (fd in self._vfds):
+         return
       if (mask == 0):
          self._poll.unregister(fd)
          return
@@ -101,12 +154,20 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
       POLLOUT = self.POLLOUT
       POLLERR = self.POLLERR
       POLLHUP = self.POLLHUP
+      flushl = self._flushl
+      vpending = self._vpending
       self._shutdown_pending = False
       while (not self._shutdown_pending):
+         if (flushl):
+            # Push output deferred by event and timer handlers of the last
+            # iteration.
+            self._flush_run()
          if (timers != []):
             timeout = max(self._timers[0]._expire_ts-ttime(),0)
          else:
             timeout = -1
+         if (vpending):
+            timeout = 0
 
          # FD event processing
          try:
@@ -116,6 +177,8 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
                # EINTR
                continue
             raise
+         if (vpending):
+            events = events + self._vfd_events()
          for (fd, event) in events:
             fdw = fdwl[fd]
             try:
@@ -125,9 +188,11 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
                   fdw.process_writability()
                if (event & POLLHUP):
                   fdw.process_hup()
-               if (event & POLLERR):
-                  if (fdw):
+               if ((event & POLLERR) and fdw):
+                  if (fdw.process_error is None):
                      fdw.close()
+                  else:
+                     fdw.process_error()
             except CloseFD:
                fdw.close()
             except Exception as exc:
@@ -156,6 +221,7 @@ class EventDispatcherPollBase(EventDispatcherBaseTT):
             if (timer):
                heappush(timers,timer)
       
+      self._flush_run()
       self.em_shutdown()
 
 
@@ -23,5 +23,11 @@ class FDMException(Exception):
 class CloseFD(FDMException):
    pass
 
+class PacketQueueFull(FDMException):
+   pass
+
+class StreamClosed(FDMException):
+   pass
+
 
 
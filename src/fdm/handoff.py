@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Passing of connected sockets between processes.
+
+import array
+import logging
+import socket
+import struct
+from collections import deque
+
+from .exceptions import CloseFD
+from .stream import AsyncDataStream
+
+_logger = logging.getLogger('gonium.fdm.handoff')
+_log = _logger.log
+
+
+class FDHandoffChannel:
+   """Unix domain control channel for passing sockets between processes.
+   
+   Each message carries one socket (passed by SCM_RIGHTS), optionally with
+   input already read from it and opaque metadata for the receiver. The
+   channel should be built on a SOCK_SEQPACKET socket, as returned by
+   socketpair().
+   
+   public instance methods:
+      send_sock(sock, data, meta): Pass socket to peer.
+      send_stream(stream, meta): Pass AsyncDataStream's socket and buffered
+         input to peer, and close it locally.
+      close(): Close channel.
+   Public attributes (r/w):
+      stream_factory: callable used to build streams for received sockets
+   public instance methods intended to be overridden:
+      process_sock(sock, data, meta): process received socket; the default
+         implementation builds a stream around it, and passes it to
+         process_stream().
+      process_stream(stream, meta): process stream built around received
+         socket. Called before any handed-off input is processed.
+      process_close(): process channel close
+   """
+   _hdr = struct.Struct('>II')
+   stream_factory = AsyncDataStream
+   def __init__(self, ed, sock, *, msg_size_max:int=131072):
+      self._ed = ed
+      self.sock = sock
+      self.msg_size_max = msg_size_max
+      self._outq = deque()
+      self._fw = ed.fd_wrap(sock.fileno(), fl=sock)
+      self._fw.process_readability = self._process_input
+      self._fw.process_writability = self._output_write
+      self._fw.process_close = self._process_close
+      self._fw.read_r()
+   
+   @staticmethod
+   def socketpair():
+      """Return pair of connected sockets suitable for channels; usually
+         to be split between processes by fork()."""
+      return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+   
+   def send_sock(self, sock, data=b'', meta=b''):
+      """Pass socket to peer, along with input already read from it and
+         metadata. The local socket object is closed once it's been sent."""
+      self._msg_queue(self._msg_build(data, meta), sock)
+   
+   def _msg_build(self, data, meta):
+      msg = self._hdr.pack(len(meta), len(data)) + bytes(meta) + bytes(data)
+      if (len(msg) > self.msg_size_max):
+         raise ValueError('Handoff message of {0} bytes is too long.'.format(len(msg)))
+      return msg
+   
+   def _msg_queue(self, msg, sock):
+      self._outq.append((msg, sock))
+      if (len(self._outq) == 1):
+         self._output_write(False)
+   
+   def send_stream(self, stream, meta=b''):
+      """Pass stream's socket and buffered input to peer, and close it.
+      
+      The stream mustn't use SSL or have pending output."""
+      if ((stream._ssl_obj is not None) or (stream.ssl_callback is not None)):
+         raise ValueError("Can't hand off SSL stream {0!a}.".format(stream))
+      if (stream._outbuf):
+         raise ValueError('Stream {0!a} has pending output.'.format(stream))
+      sock = stream.fl
+      msg = self._msg_build(stream._inbuf[:stream._index_in], meta)
+      # Get it out of our event dispatcher before the fd goes away.
+      stream.close()
+      self._msg_queue(msg, sock)
+   
+   def _output_write(self, _writeregistered=True):
+      """Send queued messages."""
+      q = self._outq
+      while (q):
+         (msg, sock) = q[0]
+         try:
+            self.sock.sendmsg((msg,), ((socket.SOL_SOCKET, socket.SCM_RIGHTS,
+               array.array('i', (sock.fileno(),))),))
+         except BlockingIOError:
+            break
+         q.popleft()
+         sock.close()
+      if (bool(q) != _writeregistered):
+         if (_writeregistered):
+            self._fw.write_u()
+         else:
+            self._fw.write_r()
+   
+   def _process_input(self):
+      """Receive handed-off sockets."""
+      fd_size = array.array('i').itemsize
+      while (self._fw):
+         try:
+            (msg, ancdata, flags, addr) = self.sock.recvmsg(self.msg_size_max,
+               socket.CMSG_SPACE(4*fd_size))
+         except BlockingIOError:
+            break
+         fds = array.array('i')
+         for (level, type_, cdata) in ancdata:
+            if ((level == socket.SOL_SOCKET) and (type_ == socket.SCM_RIGHTS)):
+               fds.frombytes(cdata[:len(cdata) - (len(cdata) % fd_size)])
+         if ((not msg) and (not fds)):
+            raise CloseFD()
+         
+         socks = [socket.socket(fileno=fd) for fd in fds]
+         if ((len(socks) != 1) or (len(msg) < self._hdr.size) or
+               (flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC))):
+            _log(30, '{0} discarding malformed message: {1!a} {2!a}'.format(
+               self, msg, flags))
+            for sock in socks:
+               sock.close()
+            continue
+         
+         (meta_len, data_len) = self._hdr.unpack_from(msg)
+         off = self._hdr.size
+         meta = msg[off:off+meta_len]
+         data = msg[off+meta_len:off+meta_len+data_len]
+         try:
+            self.process_sock(socks[0], data, meta)
+         except Exception:
+            _log(40, '{0} failed to process handed-off socket:'.format(self),
+               exc_info=True)
+   
+   def process_sock(self, sock, data, meta):
+      """Build stream around received socket, pass it to process_stream(),
+         and feed it any handed-off input."""
+      stream = None
+      try:
+         stream = self.stream_factory(self._ed, sock, read_r=False)
+         self.process_stream(stream, meta)
+      except:
+         if not (stream is None):
+            stream.close()
+         sock.close()
+         raise
+      if (stream and data):
+         stream.input_inject(data)
+      if (stream):
+         stream._fw.read_r()
+   
+   def process_stream(self, stream, meta):
+      """Should be overridden by instance user: process received stream."""
+      raise NotImplementedError()
+   
+   def process_close(self):
+      """Process channel close; intended to be overridden by instance
+         users."""
+      pass
+   
+   def _process_close(self):
+      self._fw = None
+      for (msg, sock) in self._outq:
+         sock.close()
+      self._outq.clear()
+      self.process_close()
+   
+   def close(self):
+      """Close channel, if currently open."""
+      if (self._fw):
+         self._fw.close()
+   
+   def __bool__(self) -> bool:
+      """Returns True iff our wrapped FD is still open"""
+      return bool(self._fw)
+
+
+def _selftest(out=None):
+   """Hand a stream with buffered input over a channel pair."""
+   from . import ED_get
+   if (out is None):
+      import sys
+      out = sys.stdout
+   
+   ed = ED_get()()
+   (cs_a, cs_b) = FDHandoffChannel.socketpair()
+   chan_a = FDHandoffChannel(ed, cs_a)
+   chan_b = FDHandoffChannel(ed, cs_b)
+   (peer, sock) = socket.socketpair()
+   stream = AsyncDataStream(ed, sock)
+   del(sock)
+   
+   def process_input_a(data):
+      # Leave it buffered, and pass the stream on.
+      chan_a.send_stream(stream, b'meta')
+   stream.process_input = process_input_a
+   got = []
+   def process_stream(stream_b, meta):
+      got.append(meta)
+      def process_input(data):
+         got.append(bytes(data))
+         stream_b.discard_inbuf_data()
+         if (len(got) == 2):
+            peer.sendall(b' world')
+         else:
+            ed.shutdown()
+      stream_b.process_input = process_input
+   chan_b.process_stream = process_stream
+   peer.sendall(b'hello')
+   ed.set_timer(5, ed.shutdown)
+   ed.event_loop()
+   out.write('Received: {0!a}\n'.format(got))
+   if (got != [b'meta', b'hello', b' world']):
+      raise Exception('Handed-off stream mismatch.')
+   if (stream):
+      raise Exception('Sent stream still open.')
+   
+   # A failing receiver must not leak the socket.
+   out.write('Testing refused handoff; expect a logged ValueError.\n')
+   def process_stream_fail(stream_b, meta):
+      raise ValueError('Refusing stream.')
+   chan_b.process_stream = process_stream_fail
+   (peer, sock) = socket.socketpair()
+   chan_a.send_sock(sock)
+   ed.set_timer(0.1, ed.shutdown)
+   ed.event_loop()
+   peer.settimeout(5)
+   if (peer.recv(1) != b''):
+      raise Exception('Refused socket not closed.')
+   chan_a.close()
+   chan_b.close()
+   out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+   import sys
+   _selftest(sys.stdout)
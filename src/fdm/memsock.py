@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-process stream transport, for profiling and benchmarking protocol code
+# without kernel involvement.
+
+import os
+import socket
+from errno import EAGAIN, EPIPE, EBADF
+
+
+class MemorySocket:
+   """One end of an in-memory stream connection; see pair().
+
+   Provides the subset of the socket interface AsyncDataStream uses.
+   Readiness is reported to the event dispatcher through its virtual fd
+   interface (vpoll()/vfd_attach()), so no syscalls are done for data
+   transfer or event notification. Each end holds a placeholder fd on
+   /dev/null, only to get an fd number that's unique within the process.
+
+   public class methods:
+      pair(bufsize): Return two connected instances
+   Public attributes (r/w):
+      bufsize: maximum amount of data buffered for reading by this end
+   """
+   def __init__(self, bufsize:int=262144):
+      self.bufsize = bufsize
+      self.peer = None
+      self._fd = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
+      self._ed = None
+      self._rbuf = bytearray()
+      self._rpos = 0
+      self._shut_rd = False
+      # Set once the peer won't send any more data.
+      self._eof = False
+
+   @classmethod
+   def pair(cls, bufsize:int=262144):
+      """Return two connected instances."""
+      a = cls(bufsize)
+      b = cls(bufsize)
+      a.peer = b
+      b.peer = a
+      return (a, b)
+
+   def fileno(self):
+      return self._fd
+
+   def gettimeout(self):
+      return 0.0
+
+   def setblocking(self, flag):
+      pass
+
+   def vfd_attach(self, ed):
+      self._ed = ed
+
+   def _wake(self):
+      if not (self._ed is None):
+         self._ed.vfd_wake(self._fd)
+
+   def vpoll(self):
+      """Return (readable, writable) tuple."""
+      readable = (len(self._rbuf) > self._rpos) or self._eof
+      peer = self.peer
+      writable = ((peer is None) or peer._eof or peer._shut_rd or
+         (len(peer._rbuf) - peer._rpos <= peer.bufsize // 2))
+      return (readable, writable)
+
+   def recv_into(self, buf, nbytes:int=0, flags:int=0):
+      if (self._fd is None):
+         raise OSError(EBADF, os.strerror(EBADF))
+      avail = len(self._rbuf) - self._rpos
+      if (avail == 0):
+         if (self._eof):
+            return 0
+         raise BlockingIOError(EAGAIN, os.strerror(EAGAIN))
+      n = min(avail, nbytes or len(buf))
+      buf[:n] = memoryview(self._rbuf)[self._rpos:self._rpos+n]
+      self._rpos += n
+      if (self._rpos == len(self._rbuf)):
+         self._rbuf.clear()
+         self._rpos = 0
+      elif (self._rpos > self.bufsize):
+         del(self._rbuf[:self._rpos])
+         self._rpos = 0
+      # Like the kernel, only report writability to the peer once half of
+      # the buffer is free again; this avoids a wakeup per small read.
+      half = self.bufsize // 2
+      if ((avail > half) and (avail - n <= half) and
+            (self.peer is not None)):
+         self.peer._wake()
+      return n
+
+   def recv(self, bufsize:int, flags:int=0):
+      buf = bytearray(bufsize)
+      return bytes(buf[:self.recv_into(buf)])
+
+   def send(self, data, flags:int=0):
+      if (self._fd is None):
+         raise OSError(EBADF, os.strerror(EBADF))
+      peer = self.peer
+      if ((peer is None) or peer._eof or peer._shut_rd):
+         raise BrokenPipeError(EPIPE, os.strerror(EPIPE))
+      space = peer.bufsize - (len(peer._rbuf) - peer._rpos)
+      if (space <= 0):
+         raise BlockingIOError(EAGAIN, os.strerror(EAGAIN))
+      data = memoryview(data).cast('B')
+      if (len(data) > space):
+         data = data[:space]
+      peer._rbuf += data
+      peer._wake()
+      return len(data)
+
+   def sendmsg(self, buffers, ancdata=(), flags:int=0, address=None):
+      rv = 0
+      for buf in buffers:
+         buf = memoryview(buf).cast('B')
+         try:
+            n = self.send(buf)
+         except BlockingIOError:
+            if (rv):
+               break
+            raise
+         rv += n
+         if (n < len(buf)):
+            break
+      return rv
+
+   def shutdown(self, how):
+      if (how in (socket.SHUT_RD, socket.SHUT_RDWR)):
+         self._shut_rd = True
+      if ((how in (socket.SHUT_WR, socket.SHUT_RDWR)) and
+            (self.peer is not None)):
+         self.peer._eof = True
+         self.peer._wake()
+
+   def close(self):
+      if (self._fd is None):
+         return
+      peer = self.peer
+      if not (peer is None):
+         peer._eof = True
+         peer.peer = None
+         peer._wake()
+         self.peer = None
+      if not (self._ed is None):
+         self._ed.vfd_remove(self._fd)
+         self._ed = None
+      os.close(self._fd)
+      self._fd = None
+
+   def __del__(self):
+      self.close()
+
+
+def _selftest(out=None):
+   """Pass data both ways between streams over a MemorySocket pair."""
+   from . import ED_get
+   from .stream import AsyncDataStream
+   if (out is None):
+      import sys
+      out = sys.stdout
+   
+   ed = ED_get()()
+   (a, b) = MemorySocket.pair(bufsize=4096)
+   sa = AsyncDataStream(ed, a)
+   sb = AsyncDataStream(ed, b)
+   data = os.urandom(1 << 20)
+   got = {sa: bytearray(), sb: bytearray()}
+   for stream in (sa, sb):
+      def process_input(buf, stream=stream):
+         got[stream].extend(buf)
+         stream.discard_inbuf_data()
+         if ((stream is sa) and (len(got[sa]) == len(data))):
+            # Done; EOF has to make it across.
+            a.shutdown(socket.SHUT_WR)
+      stream.process_input = process_input
+   sb_closed = []
+   def process_close():
+      sb_closed.append(True)
+      ed.shutdown()
+   sb.process_close = process_close
+   sb.send_bytes((data,))
+   sa.send_bytes((b'hello',))
+   ed.set_timer(10, ed.shutdown)
+   ed.event_loop()
+   out.write('a got {0} bytes, b got {1!a}, b closed: {2}\n'.format(
+      len(got[sa]), bytes(got[sb]), bool(sb_closed)))
+   if ((got[sa] != data) or (got[sb] != b'hello')):
+      raise Exception('Data mismatch over MemorySocket pair.')
+   if not (sb_closed):
+      raise Exception('EOF not passed on.')
+   
+   sa.close()
+   (a, b) = MemorySocket.pair()
+   a.close()
+   try:
+      b.send(b'x')
+   except BrokenPipeError:
+      pass
+   else:
+      raise Exception('Send to closed peer succeeded.')
+   if (b.recv(16) != b''):
+      raise Exception('Closed peer not reported as EOF.')
+   b.close()
+   out.write('All tests passed.\n')
+
+
+def _benchmark(total:int=1<<28, chunk:int=65536, out=None):
+   """Compare AsyncDataStream throughput over MemorySocket and socketpair()
+      transports, and return (memory, socketpair) rates in bytes/second."""
+   import time
+   from . import ED_get
+   from .stream import AsyncDataStream
+
+   def run(a, b):
+      ed = ED_get()()
+      sa = AsyncDataStream(ed, a, read_r=False)
+      sb = AsyncDataStream(ed, b, inbufsize_start=chunk)
+      data = bytes(chunk)
+      received = 0
+      def process_input(buf):
+         nonlocal received
+         received += len(buf)
+         sb.discard_inbuf_data()
+         if (received >= total):
+            ed.shutdown()
+      sb.process_input = process_input
+      sent = 0
+      def refill():
+         nonlocal sent
+         sa._output_write()
+         while ((sent < total) and (len(sa._outbuf) < 16)):
+            sa.send_bytes((data,), flush=False)
+            sent += chunk
+         if (sa._outbuf):
+            sa._fw.write_r()
+      sa._fw.process_writability = refill
+      ts = time.time()
+      refill()
+      ed.event_loop()
+      rv = total / (time.time() - ts)
+      sa.close()
+      sb.close()
+      return rv
+
+   rv = (run(*MemorySocket.pair()), run(*socket.socketpair()))
+   if not (out is None):
+      out.write('MemorySocket: {0:8.1f} MiB/s, socketpair: {1:8.1f} MiB/s\n'.format(rv[0]/(1<<20), rv[1]/(1<<20)))
+   return rv
+
+
+if (__name__ == '__main__'):
+   import sys
+   _selftest(sys.stdout)
+   _benchmark(out=sys.stdout)
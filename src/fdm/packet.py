@@ -18,38 +18,303 @@
 # FDM classes for handling packet sequences (e.g. on DGRAM sockets).
 
 import collections
-from errno import EAGAIN
+import ctypes
+import itertools
+import logging
+import os
+import socket
+import struct
+from errno import EAGAIN, EINVAL, EIO, ENOPROTOOPT, EOPNOTSUPP
 from socket import error as sockerr, socket as socket_
 
+from .exceptions import PacketQueueFull
+from .stream import _sockaddr_parse
+
+_logger = logging.getLogger('gonium.fdm.packet')
+_log = _logger.log
+
+
+class _iovec(ctypes.Structure):
+   _fields_ = (('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t))
+
+class _msghdr(ctypes.Structure):
+   _fields_ = (
+      ('msg_name', ctypes.c_void_p),
+      ('msg_namelen', ctypes.c_uint32),
+      ('msg_iov', ctypes.POINTER(_iovec)),
+      ('msg_iovlen', ctypes.c_size_t),
+      ('msg_control', ctypes.c_void_p),
+      ('msg_controllen', ctypes.c_size_t),
+      ('msg_flags', ctypes.c_int)
+   )
+
+class _mmsghdr(ctypes.Structure):
+   _fields_ = (('msg_hdr', _msghdr), ('msg_len', ctypes.c_uint))
+
+try:
+   _libc = ctypes.CDLL(None, use_errno=True)
+   _libc_recvmmsg = _libc.recvmmsg
+   _libc_sendmmsg = _libc.sendmmsg
+except (OSError, AttributeError):
+   _libc_recvmmsg = _libc_sendmmsg = None
+else:
+   _libc_recvmmsg.argtypes = (ctypes.c_int, ctypes.POINTER(_mmsghdr),
+      ctypes.c_uint, ctypes.c_int, ctypes.c_void_p)
+   _libc_recvmmsg.restype = ctypes.c_int
+   _libc_sendmmsg.argtypes = (ctypes.c_int, ctypes.POINTER(_mmsghdr),
+      ctypes.c_uint, ctypes.c_int)
+   _libc_sendmmsg.restype = ctypes.c_int
+
+_SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+# UDP segmentation offload socket options, from linux/udp.h
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+_UDP_GSO_SEGS_MAX = 64
+_UDP_GSO_SIZE_MAX = 65507
+
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+_cmsghdr = struct.Struct('={0}ii'.format({4:'I', 8:'Q'}[_CMSG_ALIGN]))
+
+def _gro_segments(data, addr, seg_size):
+   """Split GRO-coalesced data into datagrams."""
+   if ((not seg_size) or (len(data) <= seg_size)):
+      return ((data, addr),)
+   return [(data[i:i+seg_size], addr) for i in range(0, len(data), seg_size)]
+
+def _sockaddr_build(family, addr):
+   """Build struct sockaddr for AF_INET/AF_INET6 address tuple with literal
+      IP address; returns None if that's not possible."""
+   try:
+      if (family == socket.AF_INET):
+         return struct.pack('=H', family) + struct.pack('>H', addr[1]) + \
+            socket.inet_pton(family, addr[0]) + bytes(8)
+      if (family == socket.AF_INET6):
+         (flowinfo, scope_id) = (tuple(addr[2:4]) + (0, 0))[:2]
+         return (struct.pack('=H', family) + struct.pack('>HI', addr[1],
+            flowinfo) + socket.inet_pton(family, addr[0]) +
+            struct.pack('=I', scope_id))
+   except (OSError, TypeError, ValueError, IndexError, struct.error):
+      pass
+   return None
+
+def _buf_ptr(buf):
+   """Return (address, length, keepalive object) for bytes-like buf."""
+   if not (isinstance(buf, bytes)):
+      try:
+         cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+      except TypeError:
+         # Read-only; have to copy.
+         buf = bytes(buf)
+      else:
+         return (ctypes.addressof(cbuf), len(cbuf), cbuf)
+   return (ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value, len(buf),
+      buf)
+
+
+class _MMsgRing:
+   """Preallocated receive buffers and headers for recvmmsg()."""
+   def __init__(self, count, bufsize, control_size=0):
+      self.count = count
+      self.bufsize = bufsize
+      self.control_size = control_size
+      self.control = ctypes.create_string_buffer(max(count*control_size, 1))
+      self.buf = bytearray(count*bufsize)
+      self.mv = memoryview(self.buf)
+      self._cbuf = (ctypes.c_char * len(self.buf)).from_buffer(self.buf)
+      self.names = ctypes.create_string_buffer(count*_SOCKADDR_SIZE)
+      self.iovs = (_iovec * count)()
+      self.hdrs = (_mmsghdr * count)()
+      base = ctypes.addressof(self._cbuf)
+      names = ctypes.addressof(self.names)
+      for i in range(count):
+         self.iovs[i].iov_base = base + i*bufsize
+         self.iovs[i].iov_len = bufsize
+         hdr = self.hdrs[i].msg_hdr
+         hdr.msg_name = names + i*_SOCKADDR_SIZE
+         hdr.msg_iov = ctypes.pointer(self.iovs[i])
+         hdr.msg_iovlen = 1
+         if (control_size):
+            hdr.msg_control = ctypes.addressof(self.control) + i*control_size
+   
+   def reset(self, count):
+      for hdr in self.hdrs[:count]:
+         hdr.msg_hdr.msg_namelen = _SOCKADDR_SIZE
+         hdr.msg_hdr.msg_controllen = self.control_size
+   
+   def get(self, i, family):
+      """Return (data, address) for message i."""
+      off = i*self.bufsize
+      hdr = self.hdrs[i]
+      noff = i*_SOCKADDR_SIZE
+      addr = _sockaddr_parse(family,
+         self.names[noff:noff+hdr.msg_hdr.msg_namelen])
+      return (self.mv[off:off+hdr.msg_len], addr)
+   
+   def get_gro(self, i, family):
+      """Return list of (data, address) for (possibly coalesced) message i."""
+      (data, addr) = self.get(i, family)
+      return _gro_segments(data, addr, self.gro_size(i))
+   
+   def gro_size(self, i):
+      """Return GRO segment size of message i, or None."""
+      off = i*self.control_size
+      end = off + self.hdrs[i].msg_hdr.msg_controllen
+      while (off + _cmsghdr.size <= end):
+         (clen, level, type_) = _cmsghdr.unpack_from(self.control, off)
+         if (clen < _cmsghdr.size):
+            break
+         if ((level == socket.IPPROTO_UDP) and (type_ == UDP_GRO)):
+            return struct.unpack_from('=i', self.control, off +
+               socket.CMSG_LEN(0))[0]
+         off += (clen + _CMSG_ALIGN - 1) // _CMSG_ALIGN * _CMSG_ALIGN
+      return None
+
 
 class AsyncPacketSock:
    """Interface for asynchronously interfacing with DGRAM-like socks
    
+   Where supported, datagrams are read in batches of up to recv_batch
+   by recvmmsg() into preallocated buffers, and sent in batches by sendmmsg().
+   The receive buffers start out with room for a single datagram, and are
+   only grown (up to recv_batch datagrams) while reads keep filling them,
+   so lightly used sockets don't hold recv_batch*bufsize bytes each.
+   
+   With gro, the kernel is asked to coalesce received datagrams of a flow
+   (UDP_GRO); they're split up again before being passed on, so this is
+   transparent to process_inputs(). send_gso() uses UDP_SEGMENT to send
+   runs of equally sized datagrams with one call.
+   
+   Datagrams which can't be sent immediately because the socket buffer is
+   full are queued, and sent once the socket becomes writable. At most
+   sendq_max datagrams are queued; on overflow, sendq_policy decides
+   whether the oldest (DROP_OLDEST) or newest (DROP_NEWEST) datagrams are
+   dropped, or PacketQueueFull is raised for the ones that didn't fit
+   (REJECT). Queued buffers must not be modified by the caller.
+   
    public attributes (read-only):
      fl: wrapped filelike
      bufsize: buffer size passed to recvfrom()
+     tx_sent: number of datagrams sent
+     tx_dropped: number of datagrams dropped or rejected on queue overflow
+     tx_errors: number of queued datagrams dropped due to send errors
+     tx_eagain: number of sends which found the socket buffer full
+     gro: whether UDP GRO is enabled
    public attributes (rw):
      process_input(data, addrinfo): handler for read datagrams
+     process_inputs(msgs): handler for batches of read datagrams, as a
+       sequence of (data, addrinfo) tuples. data are memoryviews into a
+       shared buffer, which are only valid until the handler returns. The
+       default implementation calls process_input() on a copy of each
+       datagram.
    """
    output_encoding = 'ascii'
-   def __init__(self, ed, filelike, *, read_r:bool=True, bufsize=65536):
+   DROP_OLDEST = 'oldest'
+   DROP_NEWEST = 'newest'
+   REJECT = 'reject'
+   # Maximum number of datagrams to pass to one sendmmsg() call
+   send_batch = 64
+   def __init__(self, ed, filelike, *, read_r:bool=True, bufsize=65536,
+         recv_batch:int=16, sendq_max:int=1024, sendq_policy=DROP_OLDEST,
+         gro:bool=False):
+      if not (sendq_policy in (self.DROP_OLDEST, self.DROP_NEWEST,
+            self.REJECT)):
+         raise ValueError('Unknown queue policy {0!a}.'.format(sendq_policy))
       self._ed = ed
       self.fl = filelike
       self._fw = ed.fd_wrap(self.fl.fileno(), fl=filelike)
       self._fw.process_readability = self._process_input0
+      self._fw.process_writability = self._output_write
       self._fw.process_close = self._process_close
+      self._sendq = collections.deque()
+      self.sendq_max = sendq_max
+      self.sendq_policy = sendq_policy
+      self.tx_sent = 0
+      self.tx_dropped = 0
+      self.tx_errors = 0
+      self.tx_eagain = 0
+      self.bufsize = bufsize
+      self._mmsg = (_libc_recvmmsg is not None) and (filelike.family in
+         (socket.AF_INET, socket.AF_INET6))
+      self._ring = None
+      self.recv_batch = recv_batch
+      self._gso = self._mmsg
+      self.gro = False
+      if (gro and self._mmsg):
+         try:
+            filelike.setsockopt(socket.IPPROTO_UDP, UDP_GRO, 1)
+         except sockerr:
+            pass
+         else:
+            # Coalesced datagrams can be up to this long.
+            self.bufsize = max(bufsize, 65536)
+            self.gro = True
       if (read_r):
          self._fw.read_r()
-      self.bufsize = bufsize
    
    def _process_input0(self):
+      if (self._mmsg and (self.recv_batch > 1)):
+         self._process_input0_mmsg()
+         return
       while (self._fw is not None):
          try:
-            (data, addrinfo) = self.fl.recvfrom(self.bufsize)
+            if (self.gro):
+               (data, ancdata, flags, addrinfo) = self.fl.recvmsg(self.bufsize,
+                  socket.CMSG_SPACE(4))
+            else:
+               (data, addrinfo) = self.fl.recvfrom(self.bufsize)
          except sockerr as exc:
             if (exc.errno != EAGAIN):
                raise
             break
+         if (self.gro):
+            seg_size = None
+            for (level, type_, cdata) in ancdata:
+               if ((level == socket.IPPROTO_UDP) and (type_ == UDP_GRO)):
+                  seg_size = struct.unpack('=i', cdata[:4])[0]
+            self.process_inputs(_gro_segments(data, addrinfo, seg_size))
+            continue
+         self.process_inputs(((data, addrinfo),))
+   
+   def _process_input0_mmsg(self):
+      """Read datagrams with recvmmsg()."""
+      ring = self._ring
+      if ((ring is None) or (ring.count > self.recv_batch) or
+            (ring.bufsize != self.bufsize)):
+         ring = self._ring = self._ring_alloc(1)
+      family = self.fl.family
+      while (self._fw is not None):
+         ring.reset(ring.count)
+         rv = _libc_recvmmsg(self._fw.fd, ring.hdrs, ring.count,
+            socket.MSG_DONTWAIT, None)
+         if (rv < 0):
+            err = ctypes.get_errno()
+            if (err == EAGAIN):
+               break
+            raise OSError(err, os.strerror(err))
+         if (self.gro):
+            msgs = []
+            for i in range(rv):
+               msgs.extend(ring.get_gro(i, family))
+         else:
+            msgs = [ring.get(i, family) for i in range(rv)]
+         self.process_inputs(msgs)
+         if (rv < ring.count):
+            break
+         if ((ring.count < self.recv_batch) and (self._ring is ring)):
+            # Busy; read more at a time.
+            ring = self._ring = self._ring_alloc(min(ring.count*2,
+               self.recv_batch))
+   
+   def _ring_alloc(self, count):
+      return _MMsgRing(count, self.bufsize,
+         socket.CMSG_SPACE(4) if self.gro else 0)
+   
+   def process_inputs(self, msgs):
+      """Process batch of datagrams, by calling process_input() on each."""
+      for (data, addrinfo) in msgs:
+         if not (isinstance(data, bytes)):
+            data = bytes(data)
          self.process_input(data, addrinfo)
 
    def send_data(self, buffers:collections.abc.Sequence, target):
@@ -59,15 +324,157 @@ class AsyncPacketSock:
          if (hasattr(buf, 'encode')):
             buf = buf.encode(enc)
          return buf
-      self.send_bytes(map(encode,buffers), *args, **kwargs)
+      self.send_bytes([encode(buf) for buf in buffers], target)
 
    def send_bytes(self, buffers:collections.abc.Sequence, target):
       """Send specified data to specified target"""
-      for buf in buffers:
+      self.send_msgs([(buf, target) for buf in buffers])
+   
+   def send_msgs(self, msgs:collections.abc.Sequence):
+      """Send sequence of (data, target) datagrams, queueing those that can't
+         be sent immediately."""
+      if (self._sendq):
+         # Keep them in order.
+         self._sendq_add(msgs)
+         return
+      i = 0
+      while (i < len(msgs)):
+         try:
+            i += self._send_msgs(msgs, i)
+         except BlockingIOError:
+            self.tx_eagain += 1
+            self._fw.write_r()
+            self._sendq_add(msgs[i:])
+            return
+   
+   def send_gso(self, buffers:collections.abc.Sequence, target):
+      """Send datagrams to target, using UDP segmentation offload.
+      
+      All buffers except the last one must be of the same size, and the
+      last one can't be longer. Up to 64 datagrams at a time are passed to
+      the kernel with one call, which splits them up. Where that isn't
+      supported, this falls back to send_bytes()."""
+      if (len(buffers) < 2):
+         self.send_bytes(buffers, target)
+         return
+      seg_size = len(buffers[0])
+      if ((len(buffers[-1]) > seg_size) or
+            any((len(buf) != seg_size) for buf in buffers[1:-1])):
+         raise ValueError('GSO datagrams must be of equal size.')
+      
+      per_call = max(min(_UDP_GSO_SEGS_MAX, _UDP_GSO_SIZE_MAX // seg_size), 1)
+      cmsgs = [(socket.IPPROTO_UDP, UDP_SEGMENT, struct.pack('=H', seg_size))]
+      for i in range(0, len(buffers), per_call):
+         if ((not self._gso) or self._sendq or (per_call < 2)):
+            self.send_bytes(buffers[i:], target)
+            return
+         chunk = buffers[i:i+per_call]
+         try:
+            self.fl.sendmsg(chunk, cmsgs, 0, target)
+         except BlockingIOError:
+            self.tx_eagain += 1
+            self._fw.write_r()
+            self._sendq_add([(buf, target) for buf in buffers[i:]])
+            return
+         except sockerr as exc:
+            if not (exc.errno in (EINVAL, EIO, ENOPROTOOPT, EOPNOTSUPP)):
+               raise
+            _log(20, '{0} disabling GSO after send error: {1}'.format(self,
+               exc))
+            self._gso = False
+            self.send_bytes(buffers[i:], target)
+            return
+         self.tx_sent += len(chunk)
+   
+   def _sendq_add(self, msgs):
+      """Queue datagrams, applying overflow policy."""
+      q = self._sendq
+      excess = len(q) + len(msgs) - self.sendq_max
+      if (excess <= 0):
+         q.extend(msgs)
+         return
+      if (self.sendq_policy == self.DROP_OLDEST):
+         self.tx_dropped += excess
+         q.extend(msgs)
+         for i in range(excess):
+            q.popleft()
+         return
+      # The queue may already be over a lowered sendq_max; we can't drop
+      # more than the new datagrams here.
+      excess = min(excess, len(msgs))
+      self.tx_dropped += excess
+      q.extend(msgs[:len(msgs)-excess])
+      if (self.sendq_policy == self.REJECT):
+         raise PacketQueueFull('Send queue full; rejected {0} datagrams.'.format(excess))
+   
+   def _output_write(self):
+      """Send queued datagrams."""
+      q = self._sendq
+      while (q):
+         msgs = list(itertools.islice(q, self.send_batch))
+         try:
+            count = self._send_msgs(msgs, 0)
+         except BlockingIOError:
+            self.tx_eagain += 1
+            return
+         except sockerr as exc:
+            # Don't let one bad datagram block the rest.
+            _log(30, '{0} failed to send datagram to {1!a}: {2}'.format(self,
+               msgs[0][1], exc))
+            self.tx_errors += 1
+            count = 1
+         for i in range(count):
+            q.popleft()
+      self._fw.write_u()
+   
+   def _send_msgs(self, msgs, i):
+      """Send datagrams starting at msgs[i]; return number sent."""
+      if ((_libc_sendmmsg is None) or (len(msgs) - i < 2)):
+         (buf, target) = msgs[i]
          self.fl.sendto(buf, target)
+         self.tx_sent += 1
+         return 1
+      
+      family = self.fl.family
+      count = min(len(msgs) - i, self.send_batch)
+      hdrs = (_mmsghdr * count)()
+      iovs = (_iovec * count)()
+      keep = []
+      for j in range(count):
+         (buf, target) = msgs[i+j]
+         sa = _sockaddr_build(family, target)
+         if (sa is None):
+            # Let the socket module deal with this one.
+            count = j
+            break
+         (ptr, length, obj) = _buf_ptr(buf)
+         keep.append(obj)
+         iovs[j].iov_base = ptr
+         iovs[j].iov_len = length
+         hdr = hdrs[j].msg_hdr
+         name = ctypes.create_string_buffer(sa, len(sa))
+         keep.append(name)
+         hdr.msg_name = ctypes.addressof(name)
+         hdr.msg_namelen = len(sa)
+         hdr.msg_iov = ctypes.pointer(iovs[j])
+         hdr.msg_iovlen = 1
+      
+      if (count == 0):
+         (buf, target) = msgs[i]
+         self.fl.sendto(buf, target)
+         self.tx_sent += 1
+         return 1
+      
+      rv = _libc_sendmmsg(self._fw.fd, hdrs, count, 0)
+      if (rv < 0):
+         err = ctypes.get_errno()
+         raise OSError(err, os.strerror(err))
+      self.tx_sent += rv
+      return rv
 
    def _process_close(self):
       self._fw = None
+      self._sendq.clear()
       self.process_close()
    
    def close(self):
@@ -79,3 +486,72 @@ class AsyncPacketSock:
       """Returns True iff our wrapped FD is still open"""
       return bool(self._fw)
 
+
+
+def _selftest(out=None):
+   """Pass datagrams over loopback sockets, with and without UDP GSO/GRO."""
+   from . import ED_get
+   if (out is None):
+      import sys
+      out = sys.stdout
+   
+   ed = ED_get()()
+   count = 200
+   seg_size = 1200
+   bufs = [bytes((i % 256,))*seg_size for i in range(count-1)] + [b'end']
+   for (family, host) in ((socket.AF_INET, '127.0.0.1'),
+         (socket.AF_INET6, '::1')):
+      for gso in (False, True):
+         try:
+            sock_r = socket_(family, socket.SOCK_DGRAM)
+         except sockerr:
+            out.write('{0}: no socket support; skipping.\n'.format(host))
+            break
+         sock_r.bind((host, 0))
+         sock_r.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+         sock_s = socket_(family, socket.SOCK_DGRAM)
+         sock_s.bind((host, 0))
+         ps_r = AsyncPacketSock(ed, sock_r, gro=gso)
+         ps_s = AsyncPacketSock(ed, sock_s, read_r=False)
+         got = []
+         def process_input(data, addrinfo):
+            got.append(data)
+            if (len(got) == count):
+               ed.shutdown()
+         ps_r.process_input = process_input
+         ps_r.process_close = ps_s.process_close = lambda: None
+         target = sock_r.getsockname()
+         if (gso):
+            ps_s.send_gso(bufs, target)
+         else:
+            ps_s.send_bytes(bufs, target)
+         ed.set_timer(5, ed.shutdown)
+         ed.event_loop()
+         out.write('{0} gso/gro={1}: got {2}/{3} datagrams (GSO {4}, GRO {5}), ring size {6}.\n'.format(
+            host, gso, len(got), count, ps_s._gso, ps_r.gro,
+            None if (ps_r._ring is None) else ps_r._ring.count))
+         if (got != bufs):
+            raise Exception('Datagram mismatch over {0} with gso/gro={1}.'.format(host, gso))
+         ps_r.close()
+         ps_s.close()
+   
+   # Queue overflow handling.
+   sock = socket_(socket.AF_INET, socket.SOCK_DGRAM)
+   ps = AsyncPacketSock(ed, sock, read_r=False, sendq_max=4,
+      sendq_policy=AsyncPacketSock.REJECT)
+   ps.process_close = lambda: None
+   ps._sendq.extend([(b'', ('127.0.0.1', 9))]*6)
+   try:
+      ps._sendq_add([(b'', ('127.0.0.1', 9))]*2)
+   except PacketQueueFull:
+      pass
+   else:
+      raise Exception('REJECT policy failed to reject datagrams.')
+   if ((len(ps._sendq) != 6) or (ps.tx_dropped != 2)):
+      raise Exception('Queue overflow mishandled: {0} queued, {1} dropped.'.format(len(ps._sendq), ps.tx_dropped))
+   ps.close()
+   out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+   import sys
+   _selftest(sys.stdout)
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Relaying of data between two streams.
+
+import fcntl
+import logging
+import os
+import socket
+from errno import ECONNRESET, EPIPE, ENOTCONN
+
+from .exceptions import CloseFD
+
+_logger = logging.getLogger('gonium.fdm.relay')
+_log = _logger.log
+
+try:
+   _splice = os.splice
+except AttributeError:
+   # Python < 3.10 or non-Linux.
+   _splice = None
+else:
+   _SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+
+_F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+class _SpliceDirection:
+   """One direction of a splice relay: src socket -> pipe -> dst socket."""
+   def __init__(self, relay, src, dst, head, pipe_size):
+      self._relay = relay
+      self.src = src._fw
+      self.dst = dst._fw
+      self._dst_sock = dst.fl
+      # Data read by the source stream before the relay took over.
+      self.head = head
+      (self.pipe_r, self.pipe_w) = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+      try:
+         fcntl.fcntl(self.pipe_w, _F_SETPIPE_SZ, pipe_size)
+      except EnvironmentError:
+         # Not allowed to go that high; we'll find out the real capacity
+         # through EAGAIN.
+         pass
+      self.pipe_size = pipe_size
+      self.inpipe = 0
+      self.eof = False
+      self.done = False
+      self.bytes = 0
+      self._reading = True
+      self._writing = False
+
+   def close(self):
+      for fd in (self.pipe_r, self.pipe_w):
+         os.close(fd)
+      self.pipe_r = self.pipe_w = None
+
+   def pump(self):
+      """Move as much data as possible without blocking."""
+      src_fd = self.src.fd
+      dst_fd = self.dst.fd
+      pipe_full = False
+      while (True):
+         progress = False
+         if (not (self.eof or pipe_full)):
+            try:
+               n = _splice(src_fd, self.pipe_w, self.pipe_size - self.inpipe,
+                  flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+               # With data in the pipe, this may mean it has run out of
+               # slots instead of the source running dry; stop waiting for
+               # readability until the destination has taken some of it, or
+               # we'd keep getting woken up for data we can't move.
+               n = None
+               pipe_full = (self.inpipe > 0)
+            except EnvironmentError as exc:
+               if (exc.errno in (ECONNRESET, ENOTCONN)):
+                  raise CloseFD()
+               raise
+            if (n == 0):
+               if (self.inpipe):
+                  # Some socket types return this when the pipe has run out
+                  # of slots, rather than failing with EAGAIN.
+                  pipe_full = True
+               else:
+                  self.eof = True
+            elif (n):
+               self.inpipe += n
+               progress = True
+               pipe_full = (self.inpipe >= self.pipe_size)
+
+         if (self.head):
+            try:
+               n = os.write(dst_fd, self.head)
+            except BlockingIOError:
+               break
+            except EnvironmentError as exc:
+               if (exc.errno in (ECONNRESET, EPIPE)):
+                  raise CloseFD()
+               raise
+            self.head = self.head[n:]
+            self.bytes += n
+            progress = True
+         elif (self.inpipe):
+            try:
+               n = _splice(self.pipe_r, dst_fd, self.inpipe,
+                  flags=_SPLICE_FLAGS)
+            except BlockingIOError:
+               n = 0
+            except EnvironmentError as exc:
+               if (exc.errno in (ECONNRESET, EPIPE)):
+                  raise CloseFD()
+               raise
+            if (n):
+               self.inpipe -= n
+               self.bytes += n
+               pipe_full = False
+               progress = True
+
+         if not (progress):
+            break
+
+      pending = bool(self.head) or (self.inpipe > 0)
+      if (self.eof and (not pending) and (not self.done)):
+         self.done = True
+         try:
+            self._dst_sock.shutdown(socket.SHUT_WR)
+         except EnvironmentError:
+            pass
+         self._relay._direction_done()
+         if (self._relay._closed):
+            return
+
+      reading = not (self.eof or pipe_full)
+      if (reading != self._reading):
+         self._reading = reading
+         if (reading):
+            self.src.read_r()
+         else:
+            self.src.read_u()
+      if (pending != self._writing):
+         self._writing = pending
+         if (pending):
+            self.dst.write_r()
+         else:
+            self.dst.write_u()
+
+
+class StreamRelay:
+   """Relays data between two connected AsyncDataStream socket streams.
+
+   Where possible, data is moved through kernel pipes by splice() without
+   being copied into userspace; each direction reads at most pipe_size bytes
+   ahead of what the destination has accepted. EOF in one direction is
+   passed on as a write shutdown of the other socket, once everything read
+   before it has been sent; the relay closes both streams once both
+   directions are finished or either stream is closed. Streams doing SSL,
+   and platforms without splice(), use the streams' normal buffered I/O
+   instead, reading at most bufsize_max bytes ahead; SSL streams send a
+   close_notify alert before shutting down writing.
+
+   The relay takes over I/O event handling (including process_eof()) of
+   both streams, which should not be used for I/O by anything else
+   afterwards; their close hooks and process_close() are still called when
+   they are closed.
+
+   public instance methods:
+      close(): Close both streams.
+   Public attributes (intended for reading only):
+      bytes_ab: number of bytes relayed from stream_a to stream_b
+      bytes_ba: number of bytes relayed from stream_b to stream_a
+      spliced: whether data is relayed by splice()
+   public instance methods intended to be overridden:
+      process_close(): process end of relay
+   """
+   def __init__(self, stream_a, stream_b, *, pipe_size:int=65536,
+         bufsize_max:int=65536):
+      if ((not stream_a) or (not stream_b)):
+         raise ValueError('Both streams need to be open.')
+      self.stream_a = stream_a
+      self.stream_b = stream_b
+      self._closed = False
+      self._dirs = ()
+      self.spliced = (self._splice_possible(stream_a) and
+         self._splice_possible(stream_b))
+      if (self.spliced):
+         self._splice_setup(pipe_size)
+      else:
+         self._buffered_setup(bufsize_max)
+      stream_a.close_hook_add(self.close)
+      stream_b.close_hook_add(self.close)
+
+   @staticmethod
+   def _splice_possible(stream):
+      return ((_splice is not None) and (stream._ssl_obj is None) and
+         (stream.ssl_callback is None) and
+         (stream.ssl_handshake_pending is None) and
+         isinstance(stream.fl, socket.socket) and
+         (not stream._outbuf))
+
+   @property
+   def bytes_ab(self):
+      if (self.spliced):
+         return self._dirs[0].bytes
+      return self._bytes[0]
+
+   @property
+   def bytes_ba(self):
+      if (self.spliced):
+         return self._dirs[1].bytes
+      return self._bytes[1]
+
+   def _splice_setup(self, pipe_size):
+      (a, b) = (self.stream_a, self.stream_b)
+      dirs = []
+      try:
+         for (src, dst) in ((a, b), (b, a)):
+            head = bytes(src._inbuf[:src._index_in])
+            src.discard_inbuf_data()
+            dirs.append(_SpliceDirection(self, src, dst, head, pipe_size))
+      except BaseException:
+         for d in dirs:
+            d.close()
+         raise
+      self._dirs = tuple(dirs)
+      (d_ab, d_ba) = self._dirs
+      a._fw.process_readability = d_ab.pump
+      a._fw.process_writability = d_ba.pump
+      b._fw.process_readability = d_ba.pump
+      b._fw.process_writability = d_ab.pump
+      for fw in (a._fw, b._fw):
+         # A hangup is reported once we've shut down writing to a socket
+         # and read EOF from it, but data read before may still need to
+         # be sent on; we'll notice the EOF and errors ourselves.
+         fw.hup_close = False
+         fw.read_r()
+      for d in self._dirs:
+         if (d.head):
+            d.dst.write_r()
+            d._writing = True
+
+   def _buffered_setup(self, bufsize_max):
+      self._bufsize_max = bufsize_max
+      self._bytes = [0, 0]
+      # Per direction: whether EOF has been read, and whether it's been
+      # passed on.
+      self._eof = [False, False]
+      self._done = [False, False]
+      # Per direction: whether we've stopped reading until the destination
+      # has caught up.
+      self._throttled = [False, False]
+      (a, b) = (self.stream_a, self.stream_b)
+      for (i, src, dst) in ((0, a, b), (1, b, a)):
+         src.process_input = self._buffered_input_func(i, src, dst)
+         src.process_eof = self._buffered_eof_func(i, src, dst)
+         dst._fw.process_writability = self._buffered_output_func(i, src, dst)
+         # As for splicing: input still unread when a hangup is reported
+         # needs passing on.
+         src._fw.hup_close = False
+         if (src._index_in):
+            src._process_input1()
+
+   def _buffered_input_func(self, i, src, dst):
+      def process_input(data):
+         if not (data):
+            return
+         dst.send_bytes((bytes(data),))
+         self._bytes[i] += len(data)
+         src.discard_inbuf_data()
+         if (dst._outbuf and (dst.output_pending() > self._bufsize_max)):
+            self._throttled[i] = True
+            src._fw.read_u()
+         else:
+            # The SSL layer may have had more input buffered, which dst has
+            # managed to send right away; no writability event is coming
+            # to resume reading then.
+            self._buffered_resume(i, src)
+      return process_input
+
+   def _buffered_eof_func(self, i, src, dst):
+      def process_eof():
+         src._fw.read_u()
+         if (self._eof[i]):
+            return
+         self._eof[i] = True
+         if (dst and self._buffered_drained(dst)):
+            try:
+               self._buffered_eof_pass(i, dst)
+            except CloseFD:
+               dst.close()
+      return process_eof
+
+   def _buffered_output_func(self, i, src, dst):
+      def process_writability():
+         dst._output_write()
+         if ((not dst) or (not self._buffered_drained(dst))):
+            return
+         if (self._eof[i] and (not self._done[i])):
+            self._buffered_eof_pass(i, dst)
+            if not (self._done[i]):
+               return
+         if (self._closed):
+            # Output left over from before the relay was closed is out.
+            dst.close()
+         else:
+            self._buffered_resume(i, src)
+      return process_writability
+
+   def _buffered_resume(self, i, src):
+      """Resume reading in direction i, if we stopped doing so."""
+      if (self._throttled[i] and src and (not self._eof[i])):
+         self._throttled[i] = False
+         src._fw.read_r()
+
+   @staticmethod
+   def _buffered_drained(stream):
+      return not (stream._outbuf or stream._ssl_cbuf)
+
+   def _buffered_eof_pass(self, i, dst):
+      """Shut down writing to dst after EOF in direction i, now that
+         everything read before it has been sent."""
+      if not (dst._ssl_obj is None):
+         from ssl import SSLError
+         try:
+            dst._ssl_obj.unwrap()
+         except SSLError:
+            # Waiting for the peer's close_notify, which we don't need.
+            pass
+         dst._ssl_flush()
+         if (dst._ssl_cbuf):
+            dst._fw.write_r()
+            return
+      try:
+         dst.fl.shutdown(socket.SHUT_WR)
+      except EnvironmentError:
+         pass
+      self._done[i] = True
+      if all(self._done):
+         self.close()
+
+   def _direction_done(self):
+      if all(d.done for d in self._dirs):
+         self.close()
+
+   def close(self):
+      """Close both streams."""
+      if (self._closed):
+         return
+      self._closed = True
+      for d in self._dirs:
+         d.close()
+      for stream in (self.stream_a, self.stream_b):
+         if not (stream):
+            continue
+         if ((not self.spliced) and (not self._buffered_drained(stream))):
+            # Let it finish sending what it got from the other side.
+            stream._fw.read_u()
+            continue
+         stream.close()
+      try:
+         self.process_close()
+      except Exception:
+         _log(40, 'Error in close handler of {0}:'.format(self), exc_info=True)
+
+   def process_close(self):
+      """Process end of relay; intended to be overridden by instance users."""
+      pass
+
+
+def _selftest(out=None):
+   """Relay data between socketpairs, spliced and buffered."""
+   import threading
+   from . import ED_get
+   from .stream import AsyncDataStream
+   if (out is None):
+      import sys
+      out = sys.stdout
+   
+   class BufferedRelay(StreamRelay):
+      _splice_possible = staticmethod(lambda stream: False)
+   
+   ed = ED_get()()
+   data = os.urandom(4 << 20)
+   modes = [(BufferedRelay, False)]
+   if not (_splice is None):
+      modes.append((StreamRelay, True))
+   for (cls, spliced) in modes:
+      (c1, a1) = socket.socketpair()
+      (c2, a2) = socket.socketpair()
+      relay = cls(AsyncDataStream(ed, a1), AsyncDataStream(ed, a2))
+      # Closed streams leave closing their sockets to the GC; c2 has to see
+      # EOF.
+      del(a1, a2)
+      relay.process_close = lambda: ed.set_timer(0.1, ed.shutdown)
+      got = {}
+      def recv_all(sock):
+         buf = bytearray()
+         while (True):
+            chunk = sock.recv(65536)
+            if not (chunk):
+               return bytes(buf)
+            buf += chunk
+      def client_a():
+         got['ba'] = c1.recv(5)
+         c1.sendall(data)
+         c1.shutdown(socket.SHUT_WR)
+         # The other direction stays open after our EOF.
+         got['ba'] += recv_all(c1)
+      def client_b():
+         c2.sendall(b'hello')
+         got['ab'] = recv_all(c2)
+         c2.sendall(b' after EOF')
+         c2.close()
+      threads = [threading.Thread(target=f, daemon=True) for f in
+         (client_a, client_b)]
+      for t in threads:
+         t.start()
+      ed.set_timer(20, ed.shutdown)
+      ed.event_loop()
+      for t in threads:
+         t.join(5)
+      c1.close()
+      out.write('spliced={0}: {1} bytes a->b, {2} bytes b->a.\n'.format(
+         relay.spliced, relay.bytes_ab, relay.bytes_ba))
+      if (relay.spliced != spliced):
+         raise Exception('Relay mode mismatch.')
+      if ((got.get('ab') != data) or (got.get('ba') != b'hello after EOF')):
+         raise Exception('Relayed data mismatch (spliced={0}).'.format(spliced))
+      if (relay.stream_a or relay.stream_b):
+         raise Exception('Streams left open after relay end.')
+   out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+   import sys
+   _selftest(sys.stdout)
@@ -18,19 +18,27 @@
 # FDM Stream handling classes.
 
 import collections
+import ctypes
 import errno
+import functools
 import logging
+import mmap
 import os
+import re
 import subprocess
 import socket
+import struct
 import sys
+import weakref
+import zlib
 from collections import deque
 from errno import EAGAIN, ECONNRESET, EPIPE, EINPROGRESS, EINTR, ENOBUFS, \
    ECONNREFUSED, EHOSTUNREACH, ECONNRESET, ENOMEM, ECONNABORTED, ECONNRESET, \
-   ETIMEDOUT
+   ETIMEDOUT, EMFILE, ENFILE
 from select import poll, POLLOUT
 from socket import socket as socket_cls, AF_INET, SOCK_STREAM, SOL_SOCKET, \
    SO_ERROR, error as sockerr
+from time import time as time_
 
 from ..dns_resolving.base import QTYPE_A, QTYPE_AAAA
 from ..ip_address import IPAddressBase, ip_address_build
@@ -39,6 +47,194 @@ from .exceptions import CloseFD
 _logger = logging.getLogger('gonium.fd_management')
 _log = _logger.log
 
+try:
+   _libc_accept4 = ctypes.CDLL(None, use_errno=True).accept4
+except (OSError, AttributeError):
+   _libc_accept4 = None
+else:
+   _libc_accept4.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p,
+      ctypes.c_int)
+   _libc_accept4.restype = ctypes.c_int
+
+def _sockaddr_parse(family, sa):
+   """Parse AF_INET/AF_INET6 struct sockaddr into python address tuple;
+      returns None for other families."""
+   if (family == socket.AF_INET):
+      (port,) = struct.unpack_from('>H', sa, 2)
+      return (socket.inet_ntop(family, sa[4:8]), port)
+   if (family == socket.AF_INET6):
+      (port, flowinfo) = struct.unpack_from('>HI', sa, 2)
+      (scope_id,) = struct.unpack_from('=I', sa, 24)
+      return (socket.inet_ntop(family, sa[8:24]), port, flowinfo, scope_id)
+   return None
+
+try:
+   _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (ValueError, OSError):
+   _IOV_MAX = 1024
+
+# Buffer types we can pass to the kernel directly in vectored writes.
+_BUF_TYPES = (bytes, bytearray, memoryview)
+
+# TCP socket options missing from older python versions, from linux/tcp.h
+TCP_FASTOPEN = getattr(socket, 'TCP_FASTOPEN', 23)
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 30)
+TCP_NOTSENT_LOWAT = getattr(socket, 'TCP_NOTSENT_LOWAT', 25)
+
+# Named sets of socket options for sock_profile_apply(). Options left out
+# are left at system defaults.
+SOCK_PROFILES = {
+   # Interactive request/response traffic: send small writes immediately,
+   # and keep little unsent data queued in the kernel.
+   'latency': {'nodelay': True, 'notsent_lowat': 16384},
+   # Bulk transfers: large socket buffers, and leave Nagle on.
+   'bulk': {'nodelay': False, 'rcvbuf': 4<<20, 'sndbuf': 4<<20},
+}
+
+_SOCK_PROFILE_OPTS = {
+   'nodelay': (socket.IPPROTO_TCP, socket.TCP_NODELAY),
+   'notsent_lowat': (socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT),
+   'rcvbuf': (socket.SOL_SOCKET, socket.SO_RCVBUF),
+   'sndbuf': (socket.SOL_SOCKET, socket.SO_SNDBUF),
+}
+
+def sock_profile_apply(sock, profile):
+   """Set socket options from profile on sock.
+   
+   profile is the name of an entry in SOCK_PROFILES, or a dict mapping
+   option names as used there to values. Options not supported by the
+   platform are skipped."""
+   if (isinstance(profile, str)):
+      profile = SOCK_PROFILES[profile]
+   for (name, val) in profile.items():
+      (level, opt) = _SOCK_PROFILE_OPTS[name]
+      try:
+         sock.setsockopt(level, opt, int(val))
+      except EnvironmentError as exc:
+         _log(20, 'Unable to set socket option {0!a} on {1}: {2}'.format(
+            name, sock, exc))
+
+# MSG_ZEROCOPY support, from linux/socket.h and linux/errqueue.h
+SO_ZEROCOPY = getattr(socket, 'SO_ZEROCOPY', 60)
+MSG_ZEROCOPY = getattr(socket, 'MSG_ZEROCOPY', 0x4000000)
+_SO_EE_ORIGIN_ZEROCOPY = 5
+_SO_EE_CODE_ZEROCOPY_COPIED = 1
+_RECVERR_CMSGS = {(socket.IPPROTO_IP, 11), (socket.IPPROTO_IPV6, 25)}
+_sock_extended_err = struct.Struct('=IBBBBII')
+
+# Positional arguments of the old ssl.wrap_socket(), after sock.
+_SSL_LEGACY_ARGS = ('keyfile', 'certfile', 'server_side', 'cert_reqs',
+   'ssl_version', 'ca_certs')
+
+@functools.lru_cache(maxsize=32)
+def _ssl_context_legacy(server_side, keyfile=None, certfile=None,
+      cert_reqs=None, ssl_version=None, ca_certs=None, ciphers=None):
+   """Return shared SSLContext configured like ssl.wrap_socket() would have
+      with the specified arguments."""
+   import ssl
+   if not (ssl_version is None):
+      ctx = ssl.SSLContext(ssl_version)
+   elif (server_side):
+      ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+   else:
+      ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+   ctx.check_hostname = False
+   if (cert_reqs is None):
+      cert_reqs = ssl.CERT_NONE
+   ctx.verify_mode = cert_reqs
+   if (ca_certs):
+      ctx.load_verify_locations(ca_certs)
+   if (certfile):
+      ctx.load_cert_chain(certfile, keyfile)
+   if (ciphers):
+      ctx.set_ciphers(ciphers)
+   return ctx
+
+
+class SSLSessionCache:
+   """LRU cache of SSL sessions, for resuming outgoing connections.
+   
+   Sessions are only valid with the SSLContext they were created by; don't
+   share instances between contexts."""
+   def __init__(self, size_max:int=256):
+      self.size_max = size_max
+      self._sessions = collections.OrderedDict()
+   
+   def get(self, key):
+      """Return session stored for key, or None."""
+      try:
+         self._sessions.move_to_end(key)
+      except KeyError:
+         return None
+      return self._sessions[key]
+   
+   def __setitem__(self, key, session):
+      self._sessions[key] = session
+      self._sessions.move_to_end(key)
+      if (len(self._sessions) > self.size_max):
+         self._sessions.popitem(last=False)
+
+
+class MmapCache:
+   """LRU cache of read-only file mappings, for send_bytes_from_mmap().
+   
+   Mappings are keyed by the (st_dev, st_ino, st_mtime_ns) of their file,
+   so a modified file is mapped anew. Evicted mappings are unmapped once
+   the last pending output referencing them has been written.
+   Mapped files must not be truncated; sending pages beyond their new end
+   raises SIGBUS."""
+   def __init__(self, size_max:int=256, bytes_max:int=1<<30):
+      self.size_max = size_max
+      self.bytes_max = bytes_max
+      self._maps = collections.OrderedDict()
+      self._bytes = 0
+   
+   def get(self, file):
+      """Return memoryview of read-only mapping of file, which may be a path,
+         fd or object with a fileno() method."""
+      if (isinstance(file, (str, bytes))):
+         st = os.stat(file)
+         fd = None
+      else:
+         if not (isinstance(file, int)):
+            file = file.fileno()
+         st = os.fstat(file)
+         fd = file
+      key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+      try:
+         self._maps.move_to_end(key)
+      except KeyError:
+         pass
+      else:
+         return self._maps[key]
+      
+      if (fd is None):
+         fd = os.open(file, os.O_RDONLY | os.O_CLOEXEC)
+         try:
+            # Might have been replaced since we stat()ed it.
+            st = os.fstat(fd)
+            key = (st.st_dev, st.st_ino, st.st_mtime_ns)
+            rv = self._map(fd, st.st_size)
+         finally:
+            os.close(fd)
+      else:
+         rv = self._map(fd, st.st_size)
+      
+      self._maps[key] = rv
+      self._bytes += len(rv)
+      while ((len(self._maps) > self.size_max) or
+            ((self._bytes > self.bytes_max) and (len(self._maps) > 1))):
+         (k, mv) = self._maps.popitem(last=False)
+         self._bytes -= len(mv)
+      return rv
+   
+   @staticmethod
+   def _map(fd, size):
+      if (size == 0):
+         # Can't mmap() empty files.
+         return memoryview(b'')
+      return memoryview(mmap.mmap(fd, size, access=mmap.ACCESS_READ))
+
 
 class AsyncDataStream:
    """Class for asynchronously accessing streams of bytes of any kind.
@@ -50,9 +246,27 @@ class AsyncDataStream:
    public instance methods:
      send_data(lines, flush): Append data lines to output buffer; if flush
        evaluates to True, also try to send it now.
-     send_bytes(lines, flush): As above, but without trying to encode strings
+     send_bytes(lines, flush, priority): As above, but without trying to
+       encode strings
+     send_bytes_from_mmap(file, off, length, flush, priority): Send data
+       from shared read-only mapping of file
+     output_lanes_set(weights): Set up output priority lanes
      discard_inbuf_data(n): Discard first n bytes of buffered input
+     input_inject(data): Process data as if it had been read from filelike
      close(): Close wrapped filelike, if open
+     close_hook_add(hook): Add callback to call on FD close
+     deadlines_set(idle, first_byte, write_stall): Set up deadlines for
+       stream activity
+     stats_enable(): Start collecting I/O statistics
+     zerocopy_enable(threshold, callback): Send large buffers with
+       MSG_ZEROCOPY
+     stats_get(): Return snapshot of I/O statistics, if enabled
+     rate_limit_set(out, in_): Limit throughput by TokenBucket instances
+     membudget_set(budget): Account buffered data against a MemoryBudget
+     output_pending(): Return number of bytes of pending output
+     drain_notify(callback, level): Call callback once pending output has
+       dropped to level bytes
+     transform_push(stage): Add StreamTransform on top of transform stack
    
    Public attributes (intended for reading only):
       fl: wrapped filelike
@@ -63,6 +277,10 @@ class AsyncDataStream:
          is always written unmodified.
       process_input(data): process newly buffered input
       process_close(): process FD closing
+      process_eof(): process end of input; closes the stream by default
+      process_deadline(kind): process expiry of a deadline
+      mmap_cache: MmapCache used by send_bytes_from_mmap(); shared by all
+         instances by default
    """
    _SOCK_ERRNO_TRANS = {0, EINTR, ENOBUFS, ENOMEM, EAGAIN}
    _SOCK_ERRNO_FATAL = {ECONNREFUSED, ECONNRESET, EHOSTUNREACH, ECONNABORTED,
@@ -71,14 +289,61 @@ class AsyncDataStream:
    CS_UP = 1
    CS_LOOKUP = 2
    CS_CONNECT = 3
+   # Output priority lanes; see output_lanes_set().
+   PRIO_HIGH = 0
+   PRIO_DEFAULT = 1
+   PRIO_BULK = 2
+   _LANE_WEIGHTS = (16, 4, 1)
+   _LANE_QUANTUM = 16384
+   _SSL_RECV_SIZE = 65536
+   _SSL_WRITE_SIZE = 65536
 
    output_encoding = None
+   mmap_cache = MmapCache()
+   # Deadline state; see deadlines_set().
+   _dl = None
+   _dl_sweeper = None
+   _dl_bucket = None
+   # StreamStats instance, if enabled
+   _stats = None
+   # Zerocopy send state; see zerocopy_enable()
+   _zc_threshold = None
+   _zc_pending = None
+   _zc_rest = None
+   # Output priority lanes: deques of (size, buffers) messages not yet moved
+   # to _outbuf, and their weights and byte credits; see output_lanes_set().
+   _lanes = None
+   _lane_weights = None
+   _lane_credits = None
+   # TokenBucket instances limiting output and input, and whether we're
+   # waiting for them to refill; see rate_limit_set().
+   _shape_out = None
+   _shape_in = None
+   _shape_out_wait = False
+   _shape_in_wait = False
+   # MemoryBudget we account our buffers against, bytes accounted for
+   # input and output, and whether it has paused our reading.
+   _membudget = None
+   _mem_in = 0
+   _mem_out = 0
+   _mem_paused = False
+   _mem_read_off = False
+   # (level, callback) set by drain_notify()
+   _drain_notify = None
+   # StreamTransform stages, starting with the one closest to the wire
+   _transforms = None
+   # Write registration state at the time output flushing was deferred to
+   # the end of the current ED iteration, or None if no flush is pending.
+   _flush_wr = None
 
    def __init__(self, *args, run_start=True, **kwargs):
       self.state = self.CS_DOWN
       self._outbuf = deque()
       self.ssl_handshake_pending = None
       self.ssl_callback = None
+      self._ssl_obj = None
+      self._ssl_cbuf = None
+      self._close_hooks = None
       self._fw = None
       
       if (run_start):
@@ -102,9 +367,16 @@ class AsyncDataStream:
          break
       else:
          raise ValueError("Unable to find send/write method on object {0!a}".format(filelike,))
+      self._outv = getattr(filelike, 'sendmsg', None)
       
       self._ed = ed
-      self._fw = ed.fd_wrap(self.fl.fileno(), fl=self.fl)
+      try:
+         # Skip the fcntl() calls if python already made it nonblocking.
+         set_nonblock = (filelike.gettimeout() != 0)
+      except AttributeError:
+         set_nonblock = True
+      self._fw = ed.fd_wrap(self.fl.fileno(), set_nonblock=set_nonblock,
+         fl=self.fl)
       self._fw.process_readability = self._process_input0
       self._fw.process_writability = self._output_write
       self._fw.process_close = self._process_close
@@ -123,69 +395,87 @@ class AsyncDataStream:
    def connected(self):
       return (self.state == self.CS_UP)
    
-   def connect_async_sock_bydns(self, sa, address, port, qtypes=(QTYPE_A, QTYPE_AAAA), AFs=(socket.AF_INET, socket.AF_INET6), dns_timeout=16, **kwargs):
-      """Do a nonblocking DNS lookup and open outgoing SOCK_STREAM/SOCK_SEQPACKET connection."""
+   def connect_async_sock_bydns(self, sa, address, port, qtypes=(QTYPE_A, QTYPE_AAAA), AFs=(socket.AF_INET, socket.AF_INET6), dns_timeout=16, *, attempt_delay:float=0.25, attempt_timeout:float=16, **kwargs):
+      """Do a nonblocking DNS lookup and open outgoing SOCK_STREAM/SOCK_SEQPACKET connection.
+      
+      Connection attempts to the returned addresses are raced as described
+      in RFC 8305 ("Happy Eyeballs"): address families are interleaved,
+      a new attempt is started every attempt_delay seconds until one
+      succeeds, and each attempt is abandoned after attempt_timeout
+      seconds. Since fast open connects can't fail before data is sent, a
+      fastopen argument only takes effect for an attempt not raced against
+      any others, e.g. when address is an IP address literal."""
       self.state = self.CS_LOOKUP
-      def connect(addr):
-         self._dst_ip = addr
-         try:
-            self.connect_async_sock(sa.ed, addr, port, **kwargs)
-         except Exception as exc:
-            _log(30, 'Unable to connect to {!a}: {!a}'.format(addr, str(exc)))
-            sa.ed.set_timer(0, self._process_close, interval_relative=False)
+      he = _HappyEyeballsConnector(self, sa.ed, port, attempt_delay,
+         attempt_timeout, kwargs)
       
-      def process_lookup_results(query, results):
-         if (results is None):
-            answers = None
-         else:
-            answers = results.get_rr_ip_addresses()
-         if not answers:
-            _log(25, 'Unable to connect to {!a}:{!a}: No usable DNS records of types {!a}.'.format(address, port, qtypes))
-            sa.ed.set_timer(0, self._process_close, interval_relative=False)
-            return
-         
-         connect(answers[0])
-
       try:
          ip = ip_address_build(address)
       except ValueError:
-         sa.dnslm.build_simple_query(process_lookup_results, query_name=address, qtypes=qtypes, timeout=dns_timeout)
+         pass
       else:
-         connect(ip)
-         
+         he.addrs_add((ip,), final=True)
+         return
+      
+      qtypes_pending = set(qtypes)
+      def process_lookup_results(qtype, query, results):
+         qtypes_pending.discard(qtype)
+         if (results is None):
+            addrs = ()
+         else:
+            addrs = [a for a in results.get_rr_ip_addresses() if (a.AF in AFs)]
+         if ((not qtypes_pending) and (not he.addrs_seen) and (not addrs)):
+            _log(25, 'Unable to connect to {!a}:{!a}: No usable DNS records of types {!a}.'.format(address, port, qtypes))
+         he.addrs_add(addrs, final=(not qtypes_pending))
+      
+      # Query each type separately, so we can start connecting as soon as the
+      # first answer comes in.
+      for qtype in qtypes:
+         sa.dnslm.build_simple_query(functools.partial(process_lookup_results, qtype), query_name=address, qtypes=(qtype,), timeout=dns_timeout)
    
-   def connect_async_sock(self, ed, addr, port, connect_callback=None, *, type_:int=SOCK_STREAM, proto:int=0, bind_target=None, **kwargs):
-      """Nonblockingly open outgoing SOCK_STREAM/SOCK_SEQPACKET connection."""
+   def connect_async_sock(self, ed, addr, port, connect_callback=None, *, type_:int=SOCK_STREAM, proto:int=0, bind_target=None, sock_profile=None, fastopen:bool=False, **kwargs):
+      """Nonblockingly open outgoing SOCK_STREAM/SOCK_SEQPACKET connection.
+      
+      sock_profile, if specified, is applied to the socket before connecting
+      by sock_profile_apply(). With fastopen, TCP Fast Open is used where
+      the kernel supports it: the SYN is only sent with the first output,
+      which it carries along if the server allows that."""
       def connect_process():
          err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
          if (err):
             _log(25, ('Async stream connection to {!a}:{!a} failed. Error: {!a}({!a})').format(addr, port, err, errno.errorcode[err]))
             self._fw.write_u()
             raise CloseFD()
-         
-         self.state = self.CS_UP
-         if (self.ssl_handshake_pending):
-            (ssl_args, ssl_kwargs) = self.ssl_handshake_pending
-            self._do_ssl_handshake(*ssl_args, **ssl_kwargs)
-         else:
-            self._fw.read_r()
-            # Write output, if we have any pending; else, turn writability
-            # notification off
-            self._fw.process_writability = self._output_write
-            self._output_write(_known_writable=False)
-         
-         if not (connect_callback is None):
-            connect_callback(self)
+         self._process_connect(connect_callback)
       
-      #def try_again():
-      #   return ed.set_timer(0, try_connect, interval_relative=False)
-      
-      #get_next_addr = iter(addresses).next
+      sock = self._sock_connect_start(addr, port, type_, proto, bind_target,
+         sock_profile, fastopen)
+      if (sock is None):
+         return
       
+      self.start(ed, sock, read_r=False, **kwargs)
+      self.state = self.CS_CONNECT   
+      self._fw.process_writability = connect_process
+      self._fw.write_r()
+
+      return self
+   
+   @staticmethod
+   def _sock_connect_start(addr, port, type_, proto, bind_target,
+         sock_profile=None, fastopen=False):
+      """Return new nonblocking socket connecting to addr, or None if the
+         connect failed immediately."""
       sock = socket_cls(addr.AF, type_, proto)
       sock.setblocking(0)
       s_addr = (str(addr), port)
       
+      if not (sock_profile is None):
+         sock_profile_apply(sock, sock_profile)
+      if (fastopen):
+         try:
+            sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+         except EnvironmentError:
+            pass
       if not (bind_target is None):
          sock.bind(bind_target)
       
@@ -195,14 +485,25 @@ class AsyncDataStream:
          if (exc.errno == EINPROGRESS):
             pass
          else:
-            return
+            _log(25, 'Async stream connection to {!a}:{!a} failed. Error: {!a}'.format(addr, port, str(exc)))
+            sock.close()
+            return None
+      return sock
+   
+   def _process_connect(self, connect_callback):
+      """Process successful connect of wrapped socket."""
+      self.state = self.CS_UP
+      if (self.ssl_handshake_pending):
+         self._do_ssl_handshake(*self.ssl_handshake_pending)
+      else:
+         self._fw.read_r()
+         # Write output, if we have any pending; else, turn writability
+         # notification off
+         self._fw.process_writability = self._output_write
+         self._output_write(_known_writable=False)
       
-      self.start(ed, sock, read_r=False, **kwargs)
-      self.state = self.CS_CONNECT   
-      self._fw.process_writability = connect_process
-      self._fw.write_r()
-
-      return self
+      if not (connect_callback is None):
+         connect_callback(self)
    
    def send_data(self, buffers:collections.abc.Sequence, *args, **kwargs):
       """Like send_bytes(), but encodes any strings with self.output_encoding."""
@@ -212,15 +513,48 @@ class AsyncDataStream:
             buf = buf.encode(enc)
          return buf
       
-      self.send_bytes(map(encode, buffers), *args, **kwargs)
+      self.send_bytes([encode(buf) for buf in buffers], *args, **kwargs)
    
-   def send_bytes(self, buffers:collections.abc.Sequence, flush=True):
+   def send_bytes(self, buffers:collections.abc.Sequence, flush=True, *,
+         priority=None):
       """Append set of buffers to pending output and attempt to push.
-         Buffers elements must be bytes, bytearray, memoryview or similar."""
+         Buffers elements must be bytes, bytearray, memoryview or similar.
+         
+         If our ED has autoflush set, pushing is deferred until the end of
+         the current event loop iteration, so output from several calls
+         can be sent together.
+         If priority is specified, the buffers are queued as one message in
+         that output lane; see output_lanes_set()."""
       assert not (isinstance(buffers, (bytes, bytearray)))
+      if not (isinstance(buffers, (list, tuple))):
+         # We go through them more than once (queueing, statistics and
+         # memory accounting), so iterators won't do.
+         buffers = tuple(buffers)
+      if not (self._transforms is None):
+         for stage in reversed(self._transforms):
+            buffers = stage.transform_output(buffers)
       had_pending = bool(self._outbuf)
-      self._outbuf.extend(buffers)
+      if not (self._membudget is None):
+         count = sum(len(buf) for buf in buffers if isinstance(buf, _BUF_TYPES))
+         self._mem_out += count
+         self._membudget.reserve(self, count)
+      if ((priority is None) and (self._lanes is None)):
+         self._outbuf.extend(buffers)
+      else:
+         self._lane_add(priority, buffers, sum(len(buf) for buf in buffers))
+      if not (self._stats is None):
+         self._stats.output_add(buffers)
+      if ((not had_pending) and (self._dl_sweeper is not None)):
+         # Start of a potential write stall.
+         self._ts_out = self._dl_sweeper.now
+         if (self._dl_bucket is None):
+            self._dl_sweeper.stream_add(self)
       if (flush):
+         if (self._ed.autoflush):
+            if (self._flush_wr is None):
+               self._flush_wr = had_pending
+               self._ed.flush_defer(self._flush_deferred)
+            return
          try:
             self._output_write(had_pending, _known_writable=False)
          except CloseFD:
@@ -230,23 +564,75 @@ class AsyncDataStream:
             # safely close it then instead.
             self._fw.write_r()
 
+   def _flush_deferred(self):
+      """Push output buffered by send_bytes() calls since the last flush."""
+      had_pending = self._flush_wr
+      self._flush_wr = None
+      if not (self._fw):
+         return
+      try:
+         self._output_write(had_pending, _known_writable=False)
+      except CloseFD:
+         self.close()
+
    def _bfs_process(self, dtr):
       """Process possibly partial block send."""
       if (self._outbuf is None):
          return
       
       self._unblock_output()
-      if (dtr.get_missing_byte_count() != 0):
+      missing = dtr.get_missing_byte_count()
+      if (missing != 0):
+         if not (self._shape_out is None):
+            # We'll account for this when queueing it again.
+            self._shape_out.consume(-missing)
          self._outbuf.appendleft(dtr)
       
       if (self._outbuf):
          self._fw.write_r()
 
+   def send_bytes_from_mmap(self, file, off:int=0, length:int=None, **kwargs):
+      """Send length bytes (default: up to end of file) of file from offset
+         off, without copying them.
+         
+         file may be a path, fd or object with a fileno() method. The data is
+         queued as a memoryview of a mapping of the file taken from
+         self.mmap_cache, so its pages are read in as they're sent and shared
+         with all other streams sending the same file. Further keyword
+         arguments are passed to send_bytes()."""
+      mv = self.mmap_cache.get(file)
+      if (length is None):
+         length = len(mv) - off
+      if ((off < 0) or (length < 0) or (off + length > len(mv))):
+         raise ValueError('Range ({0}, {1}) exceeds mapped file size {2}.'.format(off, length, len(mv)))
+      if (length == 0):
+         return
+      if (length != len(mv)):
+         mv = mv[off:off+length]
+      self.send_bytes((mv,), **kwargs)
+
    def send_bytes_from_file(self, dtd, file, off, length):
       """Get data from specified file-like using specified dtd, and send it.
-         """
+         
+         If output is rate limited, the data is transferred in chunks sized
+         by the tokens available when each of them is started."""
+      if not (self._transforms is None):
+         raise ValueError("Can't send from file through transform stages.")
+      if (self._shape_out is None):
+         item = self._bfs_dtr(dtd, file, off, length)
+      else:
+         item = _FileSendRange(dtd, file, off, length)
       
-      had_pending = bool(self._outbuf)
+      if (self._lanes is None):
+         self._outbuf.append(item)
+      else:
+         self._lane_add(None, (item,), length)
+      del(item)
+      if not (self._outbuf[0] is None):
+         self._fw.write_r()
+
+   def _bfs_dtr(self, dtd, file, off, length):
+      """Return DTR for sending length bytes from file."""
       if (self.ssl_callback):
          # Can't use direct fd2fd copy here, since we need to push the data
          # through the crypto stack before sending.
@@ -256,6 +642,9 @@ class AsyncDataStream:
                return
             self._unblock_output()
             if (dtr.get_missing_byte_count() == 0):
+               if not (self._membudget is None):
+                  self._mem_out += len(mv)
+                  self._membudget.reserve(self, len(mv))
                self._outbuf.appendleft(mv)
             else:
                self._outbuf.appendleft(dtr)
@@ -265,11 +654,157 @@ class AsyncDataStream:
          dtr = dtd.new_req(file, self.fl, self._bfs_process, length, off, None)
       
       dtr.errno = EAGAIN
+      return dtr
+
+   def output_lanes_set(self, weights=_LANE_WEIGHTS):
+      """Split pending output into priority lanes.
       
-      self._outbuf.append(dtr)
-      del(dtr)
-      if not (self._outbuf[0] is None):
-         self._fw.write_r()
+      weights gives the relative share of output bandwidth of each lane
+      while several have output pending; lane 0 is the most urgent one. The
+      default lanes are PRIO_HIGH, PRIO_DEFAULT and PRIO_BULK.
+      The buffers passed in one send_bytes() call form a message; whenever
+      a message has been written, the next one is taken from the most
+      urgent non-empty lane that hasn't used up its share of the current
+      round. Messages within a lane are sent in order. Output sent without
+      a priority goes into PRIO_DEFAULT.
+      This is done implicitly, with the default weights, by the first
+      send_bytes() call specifying a priority."""
+      if not (self._transforms is None):
+         raise ValueError("Can't reorder output passed through transform stages.")
+      if not (self._lanes is None):
+         if (any(self._lanes)):
+            raise ValueError('Output lanes have pending data.')
+      weights = tuple(weights)
+      if ((len(weights) <= self.PRIO_DEFAULT) or (min(weights) <= 0)):
+         raise ValueError('Invalid lane weights {0!a}.'.format(weights))
+      self._lanes = [deque() for w in weights]
+      self._lane_weights = weights
+      self._lane_credits = [0]*len(weights)
+
+   def _lane_add(self, priority, buffers, size):
+      """Queue message in output lane, and make sure our output buffer
+         isn't empty while there is lane output pending."""
+      if (self._lanes is None):
+         self.output_lanes_set()
+      if (priority is None):
+         priority = self.PRIO_DEFAULT
+      self._lanes[priority].append((size, buffers))
+      if not (self._outbuf):
+         self._lane_next()
+
+   def _lane_next(self):
+      """Move next message from output lanes into output buffer, and return
+         whether there was one."""
+      lanes = self._lanes
+      credits = self._lane_credits
+      while (True):
+         pending = False
+         for (i, lane) in enumerate(lanes):
+            if not (lane):
+               continue
+            pending = True
+            if (credits[i] > 0):
+               (size, buffers) = lane.popleft()
+               credits[i] -= size
+               self._outbuf.extend(buffers)
+               return True
+         if not (pending):
+            return False
+         # Every lane with output has used up its share; start next round.
+         quantum = self._LANE_QUANTUM
+         for (i, lane) in enumerate(lanes):
+            if (lane):
+               credits[i] += self._lane_weights[i] * quantum
+            else:
+               credits[i] = 0
+
+   def input_inject(self, data):
+      """Buffer and process data as if it had been read from our filelike.
+      
+      If that hits our input buffer limit, or processing raises CloseFD, the
+      stream is closed."""
+      start = self._index_in
+      need = start + len(data)
+      if ((self._inbuf_size_max > 0) and (need > self._inbuf_size_max)):
+         _log(30, 'Closing {0} because buffer limit {0._inbuf_size_max} has been hit.'.format(self))
+         self.close()
+         return
+      try:
+         if (need > self._inbuf_size):
+            self._inbuf_resize(need)
+         self._inbuf[self._index_in:need] = data
+         self._index_in = need
+         if not (self._transforms is None):
+            self._transform_process(start)
+         elif (self._index_in >= self.size_need):
+            self._process_input1()
+      except CloseFD:
+         self.close()
+
+   def transform_push(self, stage):
+      """Add transform stage (a StreamTransform) on top of our stack.
+      
+      Output passed to send_bytes() is transformed by the topmost stage
+      first; input is transformed by the bottom one first, and reaches
+      process_input() after having been through all of them. Input already
+      buffered is passed through the new stage. Output and input of SSL
+      streams is transformed above the SSL layer.
+      Transform stages can't be combined with output lanes or
+      send_bytes_from_file()."""
+      if not (self._lanes is None):
+         raise ValueError("Can't transform output of stream with output lanes.")
+      if (self._transforms is None):
+         self._transforms = []
+      self._transforms.append(stage)
+      if (self._index_in):
+         self._transform_input(0, (stage,))
+
+   def _transform_input(self, start, stages):
+      """Pass input buffered beyond start through stages, replacing it with
+         the result.
+         
+         Returns whether any stage is holding back output because our input
+         buffer limit left no room for it."""
+      if (self._inbuf_size_max > 0):
+         max_length = self._inbuf_size_max - start
+         if (max_length <= 0):
+            return any(stage.input_pending() for stage in stages)
+      else:
+         max_length = 0
+      data = orig = memoryview(self._inbuf)[start:self._index_in]
+      for stage in stages:
+         data = stage.transform_input(data, max_length)
+      if (data is orig):
+         orig.release()
+         return False
+      if (isinstance(data, memoryview)):
+         # Might overlap with where we're going to put it.
+         data = data.tobytes()
+      # Resizing the buffer in place fails while it's exported.
+      orig.release()
+      self._index_in = start
+      need = start + len(data)
+      if (need > self._inbuf_size):
+         self._inbuf_resize(need)
+      self._inbuf[start:need] = data
+      self._index_in = need
+      return any(stage.input_pending() for stage in stages)
+
+   def _transform_process(self, start):
+      """Transform input buffered beyond start, and process the result;
+         repeat while transform stages hold back output for lack of room."""
+      while (True):
+         pending = self._transform_input(start, self._transforms)
+         if (self._index_in == start):
+            # Nothing to pass on yet.
+            return
+         if (self._index_in >= self.size_need):
+            self._process_input1()
+         if not (pending and self._fw):
+            return
+         if (self._index_in >= self._inbuf_size):
+            self._inbuf_resize()
+         start = self._index_in
 
    def discard_inbuf_data(self, count:int=None):
       """Discard <count> bytes of in-buffered data.
@@ -290,6 +825,312 @@ class AsyncDataStream:
          self._out = None
          self._in = None
 
+   def close_hook_add(self, hook):
+      """Arrange for hook() to be called once our FD has been closed.
+      
+      Unlike process_close, this is meant for use by the code managing the
+      stream instead of its user; any number of hooks can be added."""
+      if (self._close_hooks is None):
+         self._close_hooks = []
+      self._close_hooks.append(hook)
+   
+   def deadlines_set(self, *, idle:float=None, first_byte:float=None,
+         write_stall:float=None, sweeper=None):
+      """Set deadlines for activity on this stream, in seconds.
+      
+      idle: maximum time without any data being read or written
+      first_byte: maximum time from now until the first data is read
+      write_stall: maximum time output can stay pending without any of it
+         being written
+      
+      Unspecified or None deadlines are disabled. Deadlines are checked by
+      sweeper, which defaults to the shared StreamDeadlineSweeper of our
+      event dispatcher; they'll fire late by up to its granularity. On
+      expiry, process_deadline() is called. If that leaves the stream open,
+      its deadlines stay tracked; an expired one fires again on each sweep
+      until stream activity or another deadlines_set() call moves it."""
+      if (sweeper is None):
+         sweeper = StreamDeadlineSweeper.get(self._ed)
+      if not (self._dl_sweeper is None):
+         self._dl_sweeper.stream_remove(self)
+      
+      if ((idle is None) and (first_byte is None) and (write_stall is None)):
+         self._dl = None
+         self._dl_sweeper = None
+         return
+      
+      now = sweeper.now
+      self._dl = (idle, first_byte, write_stall)
+      self._dl_sweeper = sweeper
+      self._ts_start = now
+      self._ts_in = None
+      self._ts_out = now
+      if ((self._close_hooks is None) or
+            (self._deadline_close not in self._close_hooks)):
+         self.close_hook_add(self._deadline_close)
+      sweeper.stream_add(self)
+   
+   def _deadline_close(self):
+      """Stop tracking deadlines of closed stream."""
+      if not (self._dl_sweeper is None):
+         self._dl_sweeper.stream_remove(self)
+   
+   def rate_limit_set(self, out=None, in_=None):
+      """Limit throughput of this stream.
+      
+      out and in_ are TokenBucket instances to take tokens for output and
+      input from, or None for no limit. While a bucket is out of tokens, the
+      stream doesn't wait for writability or readability, respectively."""
+      self._shape_out = out
+      self._shape_in = in_
+      if ((out is None) and self._shape_out_wait):
+         self._shape_out_resume()
+      if ((in_ is None) and self._shape_in_wait):
+         self._shape_in_resume()
+   
+   def _shape_out_suspend(self):
+      if not (self._shape_out_wait):
+         self._shape_out_wait = True
+         self._shape_out.wait(self._shape_out_resume)
+   
+   def _shape_out_resume(self):
+      if not (self._shape_out_wait):
+         return
+      self._shape_out_wait = False
+      if (self._fw and self._outbuf):
+         self._fw.write_r()
+   
+   def _shape_in_suspend(self):
+      if not (self._shape_in_wait):
+         self._shape_in_wait = True
+         self._fw.read_u()
+         self._shape_in.wait(self._shape_in_resume)
+   
+   def _shape_in_resume(self):
+      if not (self._shape_in_wait):
+         return
+      self._shape_in_wait = False
+      if not (self._fw):
+         return
+      if (self._mem_paused):
+         # Our memory budget gets to turn reading back on.
+         self._mem_read_off = True
+         return
+      self._input_resume()
+   
+   def _input_resume(self):
+      """Turn reading back on after we turned it off."""
+      self._fw.read_r()
+      if ((self._ssl_obj is not None) and (self._ssl_obj.pending() or
+            self._ssl_in.pending)):
+         # Input already pulled out of the socket won't make it readable.
+         try:
+            self._fw.process_readability()
+         except CloseFD:
+            self.close()
+   
+   def output_pending(self):
+      """Return number of bytes of pending output, not counting data to be
+         sent from files."""
+      rv = sum(len(buf) for buf in self._outbuf if isinstance(buf, _BUF_TYPES))
+      for lane in (self._lanes or ()):
+         for (size, buffers) in lane:
+            rv += sum(len(buf) for buf in buffers
+               if isinstance(buf, _BUF_TYPES))
+      return rv
+   
+   def drain_notify(self, callback, level:int=0):
+      """Call callback() once, when no more than level bytes of output are
+         pending after a write. A callback of None cancels notification."""
+      if (callback is None):
+         self._drain_notify = None
+      else:
+         self._drain_notify = (level, callback)
+   
+   def membudget_set(self, budget):
+      """Account our input buffer and pending output against budget (a
+         MemoryBudget), or stop doing so if budget is None."""
+      if not (self._membudget is None):
+         self._membudget.stream_remove(self)
+      if (budget is None):
+         return
+      self._mem_in = self._inbuf_size
+      self._mem_out = self.output_pending()
+      budget.stream_add(self)
+   
+   def _mem_pause(self):
+      # Reading is turned off on the next readability event, so we'll only
+      # turn it back on if we turned it off, instead of overriding whoever
+      # else did.
+      self._mem_paused = True
+   
+   def _mem_resume(self):
+      self._mem_paused = False
+      if not (self._mem_read_off):
+         return
+      self._mem_read_off = False
+      if (self._fw and (not self._shape_in_wait)):
+         self._input_resume()
+   
+   def stats_enable(self):
+      """Start collecting I/O statistics for this stream."""
+      if (self._stats is None):
+         self._stats = StreamStats()
+      return self._stats
+   
+   def stats_get(self):
+      """Return dict snapshot of I/O statistics, or None if not enabled."""
+      if (self._stats is None):
+         return None
+      return self._stats.snapshot()
+   
+   def zerocopy_enable(self, threshold:int=65536, callback=None):
+      """Send output buffers of at least threshold bytes with MSG_ZEROCOPY.
+      
+      Instead of being copied into the kernel, such buffers stay in use
+      until the kernel reports completion of their transmission, and must
+      not be modified until then. callback(buf), if specified, is called
+      for each buffer passed to send_bytes() once that has happened for
+      all of it, however many sends it took. Returns False if the socket
+      doesn't support zerocopy sends.
+      
+      Attributes zc_sent and zc_copied count zerocopy sends, and those the
+      kernel ended up copying anyway (always the case on loopback)."""
+      try:
+         self.fl.setsockopt(SOL_SOCKET, SO_ZEROCOPY, 1)
+      except (EnvironmentError, AttributeError):
+         return False
+      self._zc_threshold = threshold
+      self._zc_callback = callback
+      self._zc_pending = deque()
+      self._zc_seq = 0
+      self.zc_sent = 0
+      self.zc_copied = 0
+      self._fw.process_error = self._process_errqueue
+      return True
+   
+   def _zc_track(self, buf):
+      """Start tracking zerocopy sends of buf, which is being sent in parts
+         from the start of our output buffer.
+         
+         Tracking records are lists of the buffer, the number of its
+         zerocopy sends not completed yet, and the number of its bytes not
+         sent yet. While one is set as self._zc_rest, the start of our
+         output buffer holds the rest of its buffer."""
+      if (self._zc_rest is None):
+         self._zc_rest = [buf, 0, len(buf)]
+   
+   def _zc_send(self, buf):
+      """Send buf, or the part of the buffer tracked by self._zc_rest it is,
+         with MSG_ZEROCOPY."""
+      self._zc_track(buf)
+      rec = self._zc_rest
+      if (len(buf) < self._zc_threshold):
+         # Not worth it for a small remainder.
+         rv = self._out(buf)
+      else:
+         try:
+            rv = self.fl.send(buf, MSG_ZEROCOPY)
+         except sockerr as exc:
+            if (exc.errno != ENOBUFS):
+               raise
+            # Hit the limit on pinned memory; copy this one.
+            rv = self._out(buf)
+         else:
+            rec[1] += 1
+            self._zc_pending.append((self._zc_seq, rec))
+            self._zc_seq = (self._zc_seq + 1) & 0xffffffff
+            self.zc_sent += 1
+      rec[2] -= rv
+      if (rec[2] <= 0):
+         self._zc_rest = None
+         if (rec[1] == 0):
+            # All of it was copied.
+            self._zc_done(rec)
+      return rv
+   
+   def _zc_done(self, rec):
+      """Report buffer of tracking record as no longer used by the kernel."""
+      if not (self._zc_callback is None):
+         self._zc_callback(rec[0])
+   
+   def _process_errqueue(self):
+      """Process zerocopy completion notifications, and report socket
+         errors."""
+      errs = []
+      while (True):
+         try:
+            (data, ancdata, flags, addr) = self.fl.recvmsg(0, 256,
+               socket.MSG_ERRQUEUE)
+         except sockerr:
+            break
+         for (level, type_, cdata) in ancdata:
+            if not ((level, type_) in _RECVERR_CMSGS):
+               continue
+            (ee_errno, origin, ee_type, code, pad, lo, hi) = \
+               _sock_extended_err.unpack_from(cdata)
+            if (origin != _SO_EE_ORIGIN_ZEROCOPY):
+               errs.append(ee_errno)
+               continue
+            self._zc_complete(lo, hi, code & _SO_EE_CODE_ZEROCOPY_COPIED)
+      if not (self._fw):
+         # Closed by a completion callback.
+         return
+      
+      err = self.fl.getsockopt(SOL_SOCKET, SO_ERROR)
+      if ((not err) and errs):
+         err = errs[0]
+      if (err):
+         _log(25, 'Closing {0} on socket error {1!a}({2!a}).'.format(self,
+            err, errno.errorcode.get(err)))
+         raise CloseFD()
+   
+   def _zc_complete(self, lo, hi, copied):
+      """Release buffers of zerocopy sends lo to hi (inclusive)."""
+      count = ((hi - lo) & 0xffffffff) + 1
+      if (copied):
+         self.zc_copied += count
+      q = self._zc_pending
+      done = []
+      while (q and (((q[0][0] - lo) & 0xffffffff) < count)):
+         done.append(q.popleft()[1])
+      if (len(done) < count) and q:
+         # Out of order completion; rare.
+         rest = deque()
+         for (seq, rec) in q:
+            if (((seq - lo) & 0xffffffff) < count):
+               done.append(rec)
+            else:
+               rest.append((seq, rec))
+         self._zc_pending = rest
+      for rec in done:
+         rec[1] -= 1
+         if ((rec[1] == 0) and (rec[2] <= 0)):
+            self._zc_done(rec)
+   
+   def _deadline_next(self):
+      """Return (time, kind) of next deadline, or None if there isn't one."""
+      (idle, first_byte, write_stall) = self._dl
+      rv = None
+      if not (idle is None):
+         t = max(self._ts_start, self._ts_out, self._ts_in or 0) + idle
+         rv = (t, 'idle')
+      if ((first_byte is not None) and (self._ts_in is None)):
+         t = self._ts_start + first_byte
+         if ((rv is None) or (t < rv[0])):
+            rv = (t, 'first_byte')
+      if ((write_stall is not None) and self._outbuf):
+         t = self._ts_out + write_stall
+         if ((rv is None) or (t < rv[0])):
+            rv = (t, 'write_stall')
+      return rv
+   
+   def process_deadline(self, kind:str):
+      """Process expiry of deadline of specified kind ('idle', 'first_byte' or
+         'write_stall'). The default implementation closes the stream."""
+      _log(20, 'Closing {0} on expiry of {1} deadline.'.format(self, kind))
+      self.close()
+   
    def process_lookup_failure(self):
       """Process FD not opening due to DNS lookup failure. The default implementation calls process_close()."""
       return self.process_close()
@@ -297,6 +1138,13 @@ class AsyncDataStream:
    def process_close(self):
       """Process FD closing; intended to be overwritten by instance user"""
       pass
+   
+   def process_eof(self):
+      """Process end of input. The default implementation closes the stream.
+      
+      Replacements that leave the stream open should stop reading from it
+      (self._fw.read_u()), or they'll keep getting called."""
+      raise CloseFD()
 
    def __bool__(self) -> bool:
       """Returns True iff our wrapped FD is still open"""
@@ -311,6 +1159,9 @@ class AsyncDataStream:
          new_size = self._inbuf_size * 2
       if (self._inbuf_size_max > 0):
          new_size = min(new_size, self._inbuf_size_max)
+      if not (self._membudget is None):
+         self._mem_in += new_size - self._inbuf_size
+         self._membudget.reserve(self, new_size - self._inbuf_size)
       self._inbuf_size = new_size
       inbuf_new = bytearray(new_size)
       inbuf_new[:self._index_in] = self._inbuf[:self._index_in]
@@ -318,29 +1169,62 @@ class AsyncDataStream:
 
    def _process_close(self):
       """Internal method for processing FD closing"""
+      if not (self._ssl_obj is None):
+         self._ssl_session_store()
+         self._ssl_obj = None
+         self._ssl_cbuf = None
+      if not (self._membudget is None):
+         self._membudget.stream_remove(self)
       self._fw = None
       self._in = None
       self._out = None
+      self._outv = None
       self._outbuf = None
+      self._lanes = None
       self.fl = None
+      if not (self._close_hooks is None):
+         (hooks, self._close_hooks) = (self._close_hooks, None)
+         for hook in hooks:
+            hook()
       self.process_close()
 
+   def _output_gather(self, buf):
+      """Return list of buf and the plain buffers following it in our output
+         buffer, removing the latter, for writing in one syscall."""
+      bufs = [buf]
+      outbuf = self._outbuf
+      zc_threshold = self._zc_threshold
+      while (outbuf and (len(bufs) < _IOV_MAX)):
+         buf = outbuf[0]
+         if not (isinstance(buf, _BUF_TYPES)):
+            break
+         if ((zc_threshold is not None) and (len(buf) >= zc_threshold)):
+            break
+         bufs.append(outbuf.popleft())
+      return bufs
+
    def _block_output(self):
       self._outbuf.appendleft(None)
    
    def _unblock_output(self):
       self._outbuf.popleft()
+      if ((not self._outbuf) and (self._lanes is not None)):
+         self._lane_next()
 
    def _output_write(self, _writeregistered:bool=True,
       _known_writable:bool=True):
       """Write output and manage writability notification (un)registering"""
       if (self._out is None):
          return
+      if (self._ssl_cbuf):
+         self._ssl_flush()
       
       while (True):
          try:
             buf = self._outbuf.popleft()
          except IndexError:
+            if ((self._lanes is not None) and self._lane_next()):
+               continue
             break
          
          if (buf is None):
@@ -351,9 +1235,42 @@ class AsyncDataStream:
                self._fw.write_u()
             return
          
+         shape = self._shape_out
+         if not (shape is None):
+            allow = shape.available()
+            if (allow <= 0):
+               self._outbuf.appendleft(buf)
+               if (_writeregistered):
+                  self._fw.write_u()
+               self._shape_out_suspend()
+               return
+            if (isinstance(buf, _BUF_TYPES) and (len(buf) > allow)):
+               if ((self._zc_threshold is not None) and
+                     (len(buf) >= self._zc_threshold)):
+                  # Report completion of all of it, not of the parts.
+                  self._zc_track(buf)
+               self._outbuf.appendleft(memoryview(buf)[allow:])
+               buf = memoryview(buf)[:allow]
+         
+         if (isinstance(buf, _FileSendRange)):
+            # Start transferring as much of it as we have tokens for.
+            l = buf.length
+            if not (shape is None):
+               l = min(l, max(allow, 4096))
+            dtr = self._bfs_dtr(buf.dtd, buf.file, buf.off, l)
+            if (l < buf.length):
+               buf.length -= l
+               if not (buf.off is None):
+                  buf.off += l
+               self._outbuf.appendleft(buf)
+            buf = dtr
+         
          if (hasattr(buf, 'queue')):
             # It's actually a DTR object with an unfinished transfer.
             if (buf.errno in self._SOCK_ERRNO_TRANS):
+               if ((shape is not None) and (not self.ssl_callback)):
+                  # Data read for SSL is counted when written out.
+                  shape.consume(buf.get_missing_byte_count())
                buf.queue()
                self._block_output()
                continue
@@ -361,15 +1278,30 @@ class AsyncDataStream:
                raise CloseFD()
             buf.get_errors()
 
-         from ssl import SSLWantWriteError
+         stats = self._stats
+         bufs = None
          try:
-            rv = self._out(buf)
-         except SSLWantWriteError as exc:
-            self._outbuf.appendleft(buf)
-            break
+            if ((self._zc_threshold is not None) and
+                  isinstance(buf, _BUF_TYPES) and
+                  ((len(buf) >= self._zc_threshold) or
+                   (self._zc_rest is not None)) and
+                  (self._ssl_obj is None)):
+               rv = self._zc_send(buf)
+            elif (self._outbuf and (self._outv is not None) and
+                  (self._ssl_obj is None) and (shape is None) and
+                  isinstance(buf, _BUF_TYPES)):
+               bufs = self._output_gather(buf)
+               rv = self._outv(bufs)
+            else:
+               rv = self._out(buf)
          except sockerr as exc:
-            self._outbuf.appendleft(buf)
+            if (bufs is None):
+               self._outbuf.appendleft(buf)
+            else:
+               self._outbuf.extendleft(reversed(bufs))
             if (exc.errno in self._SOCK_ERRNO_TRANS):
+               if not (stats is None):
+                  stats.write_blocked(True)
                break
             if (exc.errno in self._SOCK_ERRNO_FATAL):
                raise CloseFD()
@@ -377,57 +1309,108 @@ class AsyncDataStream:
          
          if (0 == rv):
             # Low-level stream file-likes won't do this.
-            # ssl.SSLSocket uses this to indicate EAGAIN.
-            self._outbuf.appendleft(buf)
+            # _ssl_write() uses this to indicate EAGAIN.
+            if (bufs is None):
+               self._outbuf.appendleft(buf)
+            else:
+               self._outbuf.extendleft(reversed(bufs))
+            if not (stats is None):
+               stats.write_blocked(True)
             break
          
+         if not (self._dl_sweeper is None):
+            self._ts_out = self._dl_sweeper.now
+         if not (shape is None):
+            shape.consume(rv)
+         if not (self._membudget is None):
+            self._mem_out -= rv
+            self._membudget.release(self, rv)
+         
+         if not (bufs is None):
+            # Put back whatever didn't make it out.
+            rest = rv
+            for (i, buf) in enumerate(bufs):
+               if (rest < len(buf)):
+                  break
+               rest -= len(buf)
+            else:
+               if not (stats is None):
+                  stats.write_done(rv)
+               continue
+            self._outbuf.extendleft(reversed(bufs[i+1:]))
+            self._outbuf.appendleft(memoryview(buf)[rest:])
+            if not (stats is None):
+               stats.write_blocked(False, rv)
+            break
          if (rv < len(buf)):
             self._outbuf.appendleft(memoryview(buf)[rv:])
+            if not (stats is None):
+               stats.write_blocked(False, rv)
             break
+         if not (stats is None):
+            stats.write_done(rv)
       
-      if (bool(self._outbuf) != _writeregistered):
+      if ((bool(self._outbuf) or bool(self._ssl_cbuf)) != _writeregistered):
          if (_writeregistered):
             self._fw.write_u()
          else:
             self._fw.write_r()
+      
+      if not (self._drain_notify is None):
+         (level, callback) = self._drain_notify
+         if (self.output_pending() <= level):
+            self._drain_notify = None
+            callback()
    
-   def _read_data(self):
-      """Read and buffer input from wrapped file-like object"""
+   def _read_data(self, limit=None):
+      """Read and buffer up to limit bytes of input from wrapped file-like
+         object"""
+      buf = memoryview(self._inbuf)[self._index_in:]
+      if not (limit is None):
+         buf = buf[:limit]
       try:
-         br = self._in(memoryview(self._inbuf)[self._index_in:])
+         br = self._in(buf)
       except IOError as exc:
          if (exc.errno in self._SOCK_ERRNO_TRANS):
+            if not (self._stats is None):
+               self._stats.reads += 1
+               self._stats.reads_eagain += 1
             return
          if (exc.errno in self._SOCK_ERRNO_FATAL):
             raise CloseFD()
          raise
       if (br == 0):
-         raise CloseFD()
+         self.process_eof()
+         return
       self._index_in += br
+      if not (self._stats is None):
+         self._stats.read_done(br, self._index_in)
+      if not (self._dl_sweeper is None):
+         self._ts_in = self._dl_sweeper.now
       return br
    
    def getpeercert(self, *args, **kwargs):
-      """Return peer certificate for SSL socket."""
-      try:
-         gpc = self.fl.getpeercert
-      except AttributError:
+      """Return peer certificate for SSL stream."""
+      if (self._ssl_obj is None):
          return None
-      
-      return gpc(*args, **kwargs)
+      return self._ssl_obj.getpeercert(*args, **kwargs)
    
-   def _do_ssl_handshake(self, *ssl_args, **ssl_kwargs):
-      """Perform SSL handshake, directly. Not for public use; it's racy when
-         called from an IO handler for this stream."""
+   def _do_ssl_handshake(self, ssl_context, server_side, server_hostname,
+         session_cache):
+      """Start SSL handshake, directly."""
       if (not self):
          # Never mind, then.
          return
       import ssl
-      from socket import dup
       
-      for bufel in self._outbuf:
+      bufels = list(self._outbuf)
+      for lane in (self._lanes or ()):
+         for (size, buffers) in lane:
+            bufels.extend(buffers)
+      for bufel in bufels:
          if (hasattr(bufel, 'queue')):
             try:
-               raise ValueError("DTR {0!a} in queue; our fd isn't safe to dup.".format(bufel))
+               raise ValueError("DTR {0!a} in queue; its data would bypass SSL.".format(bufel))
             except:
                self.close()
                raise
@@ -435,119 +1418,228 @@ class AsyncDataStream:
       self.ssl_handshake_pending = None
       self._in = None
       self._out = None
-      # Since r80515, ssl.SSLSocket is even harder to deal with than before, since just passing the fileno of an existing
-      # connection to the constructor doesn't work correctly anymore.
-      # We hack around this API issue here. This now results in two unnecessary dups and closes, but should at least work.
-      skwargs = {'fileno': dup(self.fl.fileno())}
-      try:
-         skwargs['family'] = self.fl.family
-         skwargs['type'] = self.fl.type
-         skwargs['proto'] = self.fl.proto
-      except AttributeError:
-         pass
-      
-      try:
-         sock_tmp = socket.socket(**skwargs)
-      except:
-         os.close(skwargs['fileno'])
-         raise
-      sock_tmp.setblocking(0)
-      self._fw.process_close = lambda: None
-      self._fw.close()
-      self.fl.close()
-      self.fl = None
-      try:
-         ssl_sock = ssl.wrap_socket(sock=sock_tmp, *ssl_args, do_handshake_on_connect=False, **ssl_kwargs)
-      finally:
-         sock_tmp.close()
       
-      ssl_sock.setblocking(0)
-      self.fl = ssl_sock
+      # We run the SSL protocol in memory, and do all the socket IO on the
+      # plain socket ourselves.
+      self._ssl_in = ssl.MemoryBIO()
+      self._ssl_out = ssl.MemoryBIO()
+      self._ssl_eof = False
+      self._ssl_cbuf = deque()
+      self._ssl_session_cache = session_cache
+      if (server_side or (session_cache is None)):
+         self._ssl_session_key = None
+         session = None
+      else:
+         self._ssl_session_key = (server_hostname, self.fl.getpeername()[:2])
+         session = session_cache.get(self._ssl_session_key)
+      self._ssl_obj = ssl_context.wrap_bio(self._ssl_in, self._ssl_out,
+         server_side=server_side, server_hostname=server_hostname,
+         session=session)
       
-      self._fw = self._ed.fd_wrap(ssl_sock.fileno(), fl=ssl_sock)
       self._fw.read_r()
-      
-      self._fw.process_close = self._process_close
       self._fw.process_writability = self._ssl_handshake_step
       self._fw.process_readability = self._ssl_handshake_step
       self._ssl_handshake_step()
    
-   @staticmethod
-   def _make_ssl_wrap(ssl_sock):
-      # Python bug 3890 (<http://bugs.python.org/issue3890>):
-      # SSL sockets from python stdlib versions with this bug are really stupid about recv() and recv_into() ... basically,
-      # trying to use it on nonblocking sockets is a _bad idea_.
-      # read() works fine, though, and does the same if you know how to call it.
-      from ssl import SSLError, SSL_ERROR_WANT_READ
-      from errno import EAGAIN
-      from builtins import IOError
-      def ssl_read(buf):
-         try:
-            rv = ssl_sock.read(-1, buf)
-         except SSLError as exc:
-            if (exc.args[0] == SSL_ERROR_WANT_READ):
-               raise IOError(EAGAIN, '')
-            raise
-         return rv
-      return ssl_read
-   
    def _ssl_handshake_step(self):
-      from ssl import SSLError, SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE
+      from ssl import SSLWantReadError
       try:
-         self.fl.do_handshake()
-      except SSLError as exc:
-         if (exc.args[0] == SSL_ERROR_WANT_READ):
-            self._fw.write_u()
-            return
-         if (exc.args[0] == SSL_ERROR_WANT_WRITE):
+         self._ssl_recv()
+         self._ssl_obj.do_handshake()
+      except SSLWantReadError:
+         self._ssl_flush()
+         if (self._ssl_cbuf):
             self._fw.write_r()
-            return
-         raise
+         else:
+            self._fw.write_u()
+         return
+      self._ssl_flush()
+      self._ssl_session_store()
       
-      self._in = self._make_ssl_wrap(self.fl)
-      # XXX: Is this safe? The ssl code suggests that it may return 0 because
-      # it wants a socket *read* before willing to write more. Does this
-      # actually happen in practice?
-      # If so, we should write our own wrapper around fl.write() instead.
-      self._out = self.fl.send
+      self._in = self._ssl_read
+      self._out = self._ssl_write
       
       self._fw.process_writability = self._output_write
-      self._fw.process_readability = self._process_input0
+      self._fw.process_readability = self._ssl_process_input0
       
       self._unblock_output()
-      if (self._outbuf):
+      if (self._outbuf or self._ssl_cbuf):
          self._fw.write_r()
+      else:
+         self._fw.write_u()
       
       self.ssl_callback()
       self.ssl_callback = True
-      
-   def do_ssl_handshake(self, callback, *ssl_args, **ssl_kwargs):
-      """Perform SSL handshake."""
-      # If we don't have the module, better to find that out now.
-      import ssl
-      
-      if not (self.ssl_callback is None):
-         raise Exception('SSL handshake requested previously.')
-      
-      self.ssl_callback = callback
-      self._block_output()
-      
-      if not (self.connected):
-         # We'll let the connect handler do this, then.
-         self._out = None
-         self.ssl_handshake_pending = (ssl_args, ssl_kwargs)
+      if ((self._ssl_obj is not None) and (self._ssl_obj.pending() or
+            self._ssl_in.pending or self._ssl_eof)):
+         # Application data (or EOF) that came in along with the end of the
+         # handshake won't make the socket readable again.
+         try:
+            self._ssl_process_input0()
+         except CloseFD:
+            self.close()
+   
+   def _ssl_session_store(self):
+      """Remember SSL session for resumption, if we have somewhere to put it."""
+      if ((self._ssl_session_key is None) or
+            (self._ssl_obj.session is None)):
          return
-      
-      self._ed.set_timer(0, self._do_ssl_handshake, interval_relative=False,
-         args=ssl_args, kwargs=ssl_kwargs)
+      self._ssl_session_cache[self._ssl_session_key] = self._ssl_obj.session
    
-   def sock_set_keepalive(self, v):
-      """Set keepalive status on wrapped socket."""
-      try:
-         from socket import SOL_SOCKET, SO_KEEPALIVE
-         self.fl.setsockopt(SOL_SOCKET, SO_KEEPALIVE, v)
-      except (ImportError, EnvironmentError):
-         return False
+   def _ssl_recv(self):
+      """Move any available ciphertext from socket into SSL input BIO.
+      
+      Returns whether any data was read. EOF is only reported once we've
+      been called again after having read it, so the SSL object gets to
+      process any data we received before it."""
+      rv = False
+      while not (self._ssl_eof):
+         try:
+            data = self.fl.recv(self._SSL_RECV_SIZE)
+         except sockerr as exc:
+            if (exc.errno in self._SOCK_ERRNO_TRANS):
+               return rv
+            if (exc.errno in self._SOCK_ERRNO_FATAL):
+               raise CloseFD()
+            raise
+         if (not data):
+            self._ssl_eof = True
+            if (rv):
+               return rv
+            break
+         self._ssl_in.write(data)
+         rv = True
+         if (len(data) < self._SSL_RECV_SIZE):
+            return rv
+      
+      if not (self.ssl_callback is True):
+         # EOF in the middle of the handshake.
+         raise CloseFD()
+      self.process_eof()
+      return False
+   
+   def _ssl_flush(self):
+      """Push pending ciphertext to socket, with as few syscalls as we can."""
+      data = self._ssl_out.read()
+      cbuf = self._ssl_cbuf
+      if (data):
+         cbuf.append(data)
+      while (cbuf):
+         try:
+            sent = self.fl.sendmsg(cbuf)
+         except sockerr as exc:
+            if (exc.errno in self._SOCK_ERRNO_TRANS):
+               return
+            if (exc.errno in self._SOCK_ERRNO_FATAL):
+               raise CloseFD()
+            raise
+         while (sent):
+            l = len(cbuf[0])
+            if (sent < l):
+               cbuf[0] = memoryview(cbuf[0])[sent:]
+               break
+            cbuf.popleft()
+            sent -= l
+         if (cbuf):
+            return
+   
+   def _ssl_read(self, buf):
+      """Read decrypted data into buf."""
+      from ssl import SSLWantReadError, SSLZeroReturnError
+      while (True):
+         try:
+            return self._ssl_obj.read(len(buf), buf)
+         except SSLWantReadError:
+            pass
+         except SSLZeroReturnError:
+            return 0
+         if not (self._ssl_recv()):
+            raise IOError(EAGAIN, 'No SSL data available.')
+   
+   def _ssl_write(self, buf):
+      """Encrypt and send (part of) buf. Returns amount of data consumed, with
+         0 indicating EAGAIN."""
+      from ssl import SSLWantReadError
+      if (self._ssl_cbuf):
+         self._ssl_flush()
+         if (self._ssl_cbuf):
+            return 0
+      try:
+         rv = self._ssl_obj.write(memoryview(buf)[:self._SSL_WRITE_SIZE])
+      except SSLWantReadError:
+         return 0
+      self._ssl_flush()
+      return rv
+   
+   def _ssl_process_input0(self):
+      """Input processing stage 0 for SSL streams.
+      
+      Data already pulled out of the socket won't cause further readability
+      events, so keep going until the SSL layer runs dry."""
+      while (self._in is not None):
+         if not (self._process_input0()):
+            break
+         if (self._ssl_obj is None):
+            # Closed by input processing.
+            return
+         if not (self._ssl_obj.pending() or self._ssl_in.pending or
+               self._ssl_eof):
+            break
+      
+      if ((self._ssl_cbuf is not None) and self._ssl_out.pending):
+         # Reading caused protocol output (e.g. a TLS 1.3 key update).
+         self._ssl_flush()
+         if (self._ssl_cbuf):
+            self._fw.write_r()
+   
+   def do_ssl_handshake(self, callback, *ssl_args, ssl_context=None,
+         server_hostname=None, session_cache=None, **ssl_kwargs):
+      """Perform SSL handshake.
+      
+      ssl_context should be an ssl.SSLContext shared between many streams.
+      For outgoing connections, session_cache (e.g. an SSLSessionCache used
+      only with this context) is used to look up and store sessions for
+      resumption. Without ssl_context, one is built from ssl_args and
+      ssl_kwargs as understood by the old ssl.wrap_socket(), and shared with
+      any streams using the same arguments."""
+      # If we don't have the module, better to find that out now.
+      import ssl
+      
+      if not (self.ssl_callback is None):
+         raise Exception('SSL handshake requested previously.')
+      
+      legacy_kwargs = dict(zip(_SSL_LEGACY_ARGS, ssl_args))
+      legacy_kwargs.update(ssl_kwargs)
+      server_side = legacy_kwargs.pop('server_side', False)
+      if (ssl_context is None):
+         ssl_context = _ssl_context_legacy(server_side, **legacy_kwargs)
+      elif (legacy_kwargs):
+         raise TypeError('Got SSL context and legacy arguments {!a}.'.format(legacy_kwargs))
+      
+      self.ssl_callback = callback
+      self._block_output()
+      
+      hs_args = (ssl_context, server_side, server_hostname, session_cache)
+      if not (self.connected):
+         # We'll let the connect handler do this, then.
+         self._out = None
+         self.ssl_handshake_pending = hs_args
+         return
+      
+      self._do_ssl_handshake(*hs_args)
+   
+   def sock_set_profile(self, profile):
+      """Apply socket option profile to wrapped socket; see
+         sock_profile_apply()."""
+      sock_profile_apply(self.fl, profile)
+   
+   def sock_set_keepalive(self, v):
+      """Set keepalive status on wrapped socket."""
+      try:
+         from socket import SOL_SOCKET, SO_KEEPALIVE
+         self.fl.setsockopt(SOL_SOCKET, SO_KEEPALIVE, v)
+      except (ImportError, EnvironmentError):
+         return False
       return True
    
    def sock_set_keepidle(self, idle, intvl, cnt):
@@ -567,53 +1659,833 @@ class AsyncDataStream:
    
    def _process_input0(self):
       """Input processing stage 0: read and buffer bytes"""
-      self._read_data()
-      if (self._index_in >= self.size_need):
+      if (self._mem_paused):
+         self._mem_read_off = True
+         self._fw.read_u()
+         return 0
+      shape = self._shape_in
+      if (shape is None):
+         br = self._read_data()
+      else:
+         allow = shape.available()
+         if (allow <= 0):
+            self._shape_in_suspend()
+            return 0
+         br = self._read_data(allow)
+         if (br):
+            shape.consume(br)
+      if ((self._transforms is not None) and br):
+         self._transform_process(self._index_in - br)
+      elif (self._index_in >= self.size_need):
          self._process_input1()
       if (self._index_in >= self._inbuf_size):
          self._inbuf_resize()
+      return br
 
    def _process_input1(self):
       """Override in subclass to insert more handlers"""
       self.process_input(memoryview(self._inbuf)[:self._index_in])
 
 
+class StreamTransform:
+   """Base class for stream transform stages; see
+      AsyncDataStream.transform_push().
+   
+   Stages should keep any state needed across calls, and may return
+   (memoryviews of) buffers they reuse, but should not keep references to
+   the data they're passed after returning.
+   
+   public instance methods intended to be overridden:
+      transform_input(data, max_length): Transform memoryview of newly
+        received data, returning a bytes-like of (possibly no) data to pass
+        on; if max_length is non-zero, at most that much, holding back the
+        rest for the following calls
+      input_pending(): Return whether output is being held back
+      transform_output(buffers): Transform sequence of buffers from one
+        send_bytes() call, returning a sequence of buffers to pass on
+   """
+   def transform_input(self, data, max_length:int=0):
+      return data
+   
+   def input_pending(self):
+      return False
+   
+   def transform_output(self, buffers):
+      return buffers
+
+
+class ZlibTransform(StreamTransform):
+   """Transform stage doing streaming zlib compression of output, and
+      decompression of input.
+   
+   Output from each send_bytes() call is flushed with flush_mode, so it can
+   be decompressed by the peer without waiting for more. wbits is passed on
+   to zlib; negative values select raw deflate streams, and values of 16
+   more select gzip framing."""
+   def __init__(self, level:int=6, wbits:int=zlib.MAX_WBITS, *,
+         flush_mode:int=zlib.Z_SYNC_FLUSH):
+      self._c = zlib.compressobj(level, zlib.DEFLATED, wbits)
+      self._d = zlib.decompressobj(wbits)
+      self._d_full = False
+      self.flush_mode = flush_mode
+   
+   def transform_input(self, data, max_length:int=0):
+      d = self._d
+      if (d.unconsumed_tail):
+         data = d.unconsumed_tail + data
+      rv = d.decompress(data, max_length)
+      # zlib may also have output left over from input it consumed.
+      self._d_full = (max_length > 0) and (len(rv) >= max_length)
+      return rv
+   
+   def input_pending(self):
+      return bool(self._d.unconsumed_tail) or self._d_full
+   
+   def transform_output(self, buffers):
+      c = self._c
+      rv = [c.compress(buf) for buf in buffers]
+      rv.append(c.flush(self.flush_mode))
+      return [buf for buf in rv if buf]
+
+
+class StreamStats:
+   """I/O counters of one AsyncDataStream.
+   
+   Counts are of calls on the wrapped file-like; for SSL streams, write
+   counts and sizes are of plaintext data. Byte counts of pending output
+   don't cover data sent from files."""
+   __slots__ = ('bytes_in', 'bytes_out', 'reads', 'reads_eagain', 'writes',
+      'writes_eagain', 'writes_partial', 'inbuf_peak', 'outbuf_pending',
+      'outbuf_peak', 'write_blocked_time', '_ts_wblock', 'tcp_info')
+   def __init__(self):
+      self.bytes_in = self.bytes_out = 0
+      self.reads = self.reads_eagain = 0
+      self.writes = self.writes_eagain = self.writes_partial = 0
+      self.inbuf_peak = self.outbuf_pending = self.outbuf_peak = 0
+      self.write_blocked_time = 0
+      self._ts_wblock = None
+      self.tcp_info = None
+   
+   def read_done(self, count, inbuf_size):
+      self.reads += 1
+      self.bytes_in += count
+      if (inbuf_size > self.inbuf_peak):
+         self.inbuf_peak = inbuf_size
+   
+   def output_add(self, buffers):
+      for buf in buffers:
+         if ((buf is None) or hasattr(buf, 'queue')):
+            continue
+         self.outbuf_pending += len(buf)
+      if (self.outbuf_pending > self.outbuf_peak):
+         self.outbuf_peak = self.outbuf_pending
+   
+   def write_done(self, count):
+      self.writes += 1
+      self.bytes_out += count
+      self.outbuf_pending = max(self.outbuf_pending - count, 0)
+      if not (self._ts_wblock is None):
+         self.write_blocked_time += time_() - self._ts_wblock
+         self._ts_wblock = None
+   
+   def write_blocked(self, eagain, count=0):
+      if (eagain):
+         self.writes += 1
+         self.writes_eagain += 1
+      else:
+         self.writes_partial += 1
+         self.write_done(count)
+      if (self._ts_wblock is None):
+         self._ts_wblock = time_()
+   
+   def snapshot(self):
+      """Return dict of current values."""
+      rv = {k:getattr(self, k) for k in self.__slots__ if not k.startswith('_')}
+      if not (self._ts_wblock is None):
+         rv['write_blocked_time'] += time_() - self._ts_wblock
+      return rv
+
+
+TCPInfo = collections.namedtuple('TCPInfo', ('state', 'ca_state',
+   'retransmits', 'rto', 'snd_mss', 'unacked', 'lost', 'retrans', 'rtt',
+   'rttvar', 'snd_ssthresh', 'snd_cwnd', 'total_retrans'))
+
+
+class TCPInfoSampler:
+   """Periodically samples TCP_INFO of a set of streams with one timer.
+   
+   Samples are stored as TCPInfo tuples in the tcp_info field of the
+   streams' statistics; rtt, rttvar and rto are in microseconds. Streams are
+   dropped once they're closed."""
+   # Leading part of struct tcp_info, as of Linux 2.6.
+   _TCP_INFO = struct.Struct('8B24I')
+   def __init__(self, ed, interval:float=10):
+      self._streams = weakref.WeakSet()
+      self._timer = ed.set_timer(interval, self.sample, persist=True)
+   
+   def stream_add(self, stream):
+      """Start sampling stream; enables its statistics."""
+      stream.stats_enable()
+      self._streams.add(stream)
+   
+   def close(self):
+      """Stop sampling."""
+      self._timer.cancel()
+      self._streams.clear()
+   
+   @classmethod
+   def tcp_info_get(cls, sock):
+      """Return TCPInfo for specified socket."""
+      v = cls._TCP_INFO.unpack(sock.getsockopt(socket.IPPROTO_TCP,
+         socket.TCP_INFO, cls._TCP_INFO.size))
+      return TCPInfo(v[0], v[1], v[2], v[8], v[10], v[12], v[14], v[15], v[23],
+         v[24], v[25], v[26], v[31])
+   
+   def sample(self):
+      """Sample TCP_INFO of all streams now."""
+      for stream in list(self._streams):
+         if not (stream):
+            self._streams.discard(stream)
+            continue
+         try:
+            stream._stats.tcp_info = self.tcp_info_get(stream.fl)
+         except (EnvironmentError, AttributeError, struct.error):
+            self._streams.discard(stream)
+
+
+class StreamDeadlineSweeper:
+   """Checks deadlines of many AsyncDataStreams with one coarse timer.
+   
+   Streams are kept in buckets of granularity seconds, by the time their
+   earliest deadline would expire if they saw no further activity. Activity
+   on a stream only updates a timestamp; only streams in buckets which have
+   come due are looked at, and moved to a later bucket if they've been
+   active in the meantime."""
+   _instances = weakref.WeakKeyDictionary()
+   def __init__(self, ed, granularity:float=1):
+      self.granularity = granularity
+      self.now = time_()
+      self._buckets = {}
+      self._timer = ed.set_timer(granularity, self._sweep, persist=True)
+   
+   @classmethod
+   def get(cls, ed):
+      """Return shared instance for specified event dispatcher."""
+      try:
+         return cls._instances[ed]
+      except KeyError:
+         rv = cls._instances[ed] = cls(ed)
+         return rv
+   
+   def stream_add(self, stream):
+      """Start tracking deadlines of stream."""
+      dl = stream._deadline_next()
+      if (dl is None):
+         stream._dl_bucket = None
+         return
+      b = int(dl[0] // self.granularity)
+      stream._dl_bucket = b
+      try:
+         self._buckets[b].add(stream)
+      except KeyError:
+         self._buckets[b] = {stream}
+   
+   def stream_remove(self, stream):
+      """Stop tracking deadlines of stream."""
+      b = stream._dl_bucket
+      if (b is None):
+         return
+      stream._dl_bucket = None
+      # The bucket may be missing if it's currently being swept.
+      streams = self._buckets.get(b)
+      if (streams is None):
+         return
+      streams.discard(stream)
+      if not (streams):
+         del(self._buckets[b])
+   
+   def close(self):
+      """Stop checking deadlines."""
+      self._timer.cancel()
+      self._buckets.clear()
+   
+   def _sweep(self):
+      now = self.now = time_()
+      b_now = int(now // self.granularity)
+      for b in [b for b in self._buckets if (b <= b_now)]:
+         for stream in self._buckets.pop(b):
+            if not (stream):
+               # Closed by the deadline handler of another stream.
+               continue
+            stream._dl_bucket = None
+            dl = stream._deadline_next()
+            if (dl is None):
+               continue
+            if (dl[0] > now):
+               self.stream_add(stream)
+               continue
+            try:
+               stream.process_deadline(dl[1])
+            except Exception:
+               _log(40, 'Error in deadline handler of {0}:'.format(stream), exc_info=True)
+            if (stream and (stream._dl_sweeper is self) and
+                  (stream._dl_bucket is None)):
+               # Left open by the handler; keep tracking it.
+               self.stream_add(stream)
+
+
+class TokenBucket:
+   """Token bucket rate limiter for AsyncDataStream I/O.
+   
+   Tokens are bytes; they accumulate at rate per second up to burst. A
+   bucket with a parent also takes tokens from it (and so on up), so one
+   bucket per stream can share a common limit with others. Transfers are
+   allowed while all buckets involved have tokens left, and may overdraw
+   them; the debt is paid off before the next one. Streams waiting for
+   tokens are resumed by one timer per bucket.
+   
+   public instance methods:
+      available(): Return number of bytes that may be transferred now
+      consume(count): Take count tokens from this bucket and its ancestors
+      wait(callback): Call callback() once tokens are available again
+      close(): Stop refill timer and forget waiting callbacks
+   Public attributes (r/w):
+      rate: tokens added per second; must be positive
+      burst: maximum number of tokens; at least 1
+      parent: TokenBucket to also take tokens from, or None
+   """
+   def __init__(self, ed, rate:float, burst:float=None, *, parent=None,
+         interval_min:float=0.01):
+      if (rate <= 0):
+         raise ValueError('Invalid rate {0!a}; must be positive.'.format(rate))
+      if (burst is None):
+         burst = rate
+      if (burst < 1):
+         raise ValueError('Invalid burst {0!a}; must be at least 1.'.format(burst))
+      self._ed = ed
+      self.rate = rate
+      self.burst = burst
+      self.parent = parent
+      self.interval_min = interval_min
+      self.tokens = burst
+      self._ts = time_()
+      self._waiters = []
+      self._timer = None
+   
+   def _refill(self, now):
+      self.tokens = min(self.burst, self.tokens + (now - self._ts)*self.rate)
+      self._ts = now
+   
+   def available(self):
+      """Return number of bytes that may be transferred now."""
+      now = time_()
+      rv = self.burst
+      b = self
+      while not (b is None):
+         b._refill(now)
+         rv = min(rv, b.tokens)
+         b = b.parent
+      return max(int(rv), 0)
+   
+   def consume(self, count):
+      """Take count tokens from this bucket and its ancestors."""
+      b = self
+      while not (b is None):
+         b.tokens -= count
+         b = b.parent
+   
+   def wait(self, callback):
+      """Call callback() once available() is likely to be positive again."""
+      # Queue on whichever bucket in the chain takes longest to recover.
+      now = time_()
+      (delay, target) = (0, self)
+      b = self
+      while not (b is None):
+         b._refill(now)
+         d = (1 - b.tokens) / b.rate
+         if (d > delay):
+            (delay, target) = (d, b)
+         b = b.parent
+      target._waiters.append(callback)
+      if (target._timer is None):
+         target._timer = target._ed.set_timer(max(delay, target.interval_min),
+            target._wake)
+   
+   def _wake(self):
+      self._timer = None
+      (waiters, self._waiters) = (self._waiters, [])
+      for callback in waiters:
+         try:
+            callback()
+         except Exception:
+            _log(40, 'Error in TokenBucket waiter {0}:'.format(callback),
+               exc_info=True)
+   
+   def close(self):
+      """Stop refill timer and forget waiting callbacks."""
+      if not (self._timer is None):
+         self._timer.cancel()
+         self._timer = None
+      self._waiters = []
+
+
+class _FileSendRange:
+   """Part of a file still to be sent by a rate limited AsyncDataStream,
+      which splits DTRs off it as tokens become available."""
+   __slots__ = ('dtd', 'file', 'off', 'length')
+   def __init__(self, dtd, file, off, length):
+      self.dtd = dtd
+      self.file = file
+      self.off = off
+      self.length = length
+
+
+class MemoryBudget:
+   """Process-wide budget for data buffered by AsyncDataStreams.
+   
+   Attached streams account the size of their input buffer and their
+   pending output. Once usage exceeds limit, reading is paused on the
+   streams holding the most data (until the paused ones hold enough that
+   usage would drop to resume_level if they were drained), and attached
+   AsyncSockServers stop accepting connections. Everything is resumed once
+   usage has dropped below resume_level again.
+   
+   public instance methods:
+      stream_add(stream): Start accounting stream's buffers
+      stream_remove(stream): Stop accounting stream's buffers
+      server_add(server): Pause accepting on server while over budget
+      usage_by_class(): Return dict mapping stream classes to usage
+   Public attributes (intended for reading only):
+      used: number of bytes currently accounted for
+      over: whether we're currently enforcing the limit
+   Public attributes (r/w):
+      limit: number of bytes streams may buffer in total
+      resume_level: usage below which paused streams are resumed
+   """
+   def __init__(self, limit:int, *, resume_level:int=None):
+      self.limit = limit
+      if (resume_level is None):
+         resume_level = limit * 3 // 4
+      self.resume_level = resume_level
+      self.used = 0
+      self.over = False
+      self._class_used = collections.defaultdict(int)
+      self._streams = set()
+      self._paused = []
+      self._servers = weakref.WeakSet()
+      # Usage at which we'll next look for streams to pause.
+      self._check_level = limit
+   
+   def stream_add(self, stream):
+      """Start accounting stream's buffers."""
+      self._streams.add(stream)
+      stream._membudget = self
+      self.reserve(stream, stream._mem_in + stream._mem_out)
+   
+   def stream_remove(self, stream):
+      """Stop accounting stream's buffers."""
+      self._streams.discard(stream)
+      stream._membudget = None
+      self.release(stream, stream._mem_in + stream._mem_out)
+      stream._mem_in = stream._mem_out = 0
+      if (stream._mem_paused):
+         self._paused.remove(stream)
+         stream._mem_resume()
+   
+   def server_add(self, server):
+      """Have server stop accepting connections while over budget."""
+      self._servers.add(server)
+      if (self.over):
+         server._accept_pause()
+   
+   def usage_by_class(self):
+      """Return dict mapping stream classes to the number of bytes accounted
+         for streams of that class."""
+      return {cls: v for (cls, v) in self._class_used.items() if v}
+   
+   def reserve(self, stream, count):
+      """Account count more bytes buffered by stream."""
+      self.used += count
+      self._class_used[type(stream)] += count
+      if (self.used > self._check_level):
+         self._enforce()
+   
+   def release(self, stream, count):
+      """Account count fewer bytes buffered by stream."""
+      self.used -= count
+      self._class_used[type(stream)] -= count
+      if (self.over and (self.used < self.resume_level)):
+         self._relax()
+   
+   def _enforce(self):
+      if not (self.over):
+         _log(30, '{0} over limit of {1} bytes; pausing input of heaviest streams.'.format(self, self.limit))
+         self.over = True
+         for server in self._servers:
+            server._accept_pause()
+      
+      excess = self.used - self.resume_level
+      excess -= sum(s._mem_in + s._mem_out for s in self._paused)
+      if (excess > 0):
+         for stream in sorted(self._streams,
+               key=lambda s: s._mem_in + s._mem_out, reverse=True):
+            if (excess <= 0):
+               break
+            if (stream._mem_paused or (not stream)):
+               continue
+            stream._mem_pause()
+            self._paused.append(stream)
+            excess -= stream._mem_in + stream._mem_out
+      # Don't look again until usage has grown noticeably.
+      self._check_level = self.used + max(self.limit // 16, 1)
+   
+   def _relax(self):
+      _log(20, '{0} back below {1} bytes; resuming input.'.format(self, self.resume_level))
+      self.over = False
+      self._check_level = self.limit
+      (paused, self._paused) = (self._paused, [])
+      for stream in paused:
+         stream._mem_resume()
+      for server in list(self._servers):
+         if (server._accept_allowed()):
+            server._accept_resume()
+
+
+class _HappyEyeballsConnector:
+   """Races staggered connection attempts to a set of addresses (RFC 8305)
+      on behalf of an AsyncDataStream."""
+   RESOLUTION_DELAY = 0.05
+   def __init__(self, stream, ed, port, attempt_delay, attempt_timeout,
+         kwargs):
+      self._stream = stream
+      self._ed = ed
+      self._port = port
+      self._attempt_delay = attempt_delay
+      self._attempt_timeout = attempt_timeout
+      self._connect_callback = kwargs.pop('connect_callback', None)
+      self._sock_args = tuple(kwargs.pop(name, default) for (name, default)
+         in (('type_', SOCK_STREAM), ('proto', 0), ('bind_target', None),
+         ('sock_profile', None)))
+      self._fastopen = kwargs.pop('fastopen', False)
+      self._start_kwargs = kwargs
+      
+      self.addrs_seen = False
+      self._addrs = {}          # AF -> deque of addresses not yet tried
+      self._af_last = None
+      self._attempts = {}       # fw -> (sock, addr, timeout timer)
+      self._timer_next = None
+      self._lookup_done = False
+      self._done = False
+   
+   def addrs_add(self, addrs, final:bool=False):
+      """Add addresses to try connecting to.
+      
+      final: no further addresses will be added after these."""
+      if (self._done):
+         return
+      for addr in addrs:
+         self._addrs.setdefault(addr.AF, deque()).append(addr)
+         self.addrs_seen = True
+      if (final):
+         self._lookup_done = True
+      
+      if (any(self._addrs.values()) and (not self._attempts)):
+         if ((self._af_last is None) and (not self._lookup_done) and
+               (socket.AF_INET6 not in self._addrs)):
+            # Give the (preferred) IPv6 answer a moment to arrive.
+            if (self._timer_next is None):
+               self._timer_next = self._ed.set_timer(self.RESOLUTION_DELAY,
+                  self._attempt_next)
+         else:
+            self._attempt_next()
+      self._fail_check()
+   
+   def _addr_next(self):
+      """Pop next address to try, alternating between address families."""
+      afs = [af for (af, addrs) in self._addrs.items() if addrs]
+      if not (afs):
+         return None
+      if (socket.AF_INET6 in afs):
+         af = socket.AF_INET6
+      else:
+         af = afs[0]
+      if ((af == self._af_last) and (len(afs) > 1)):
+         afs.remove(af)
+         af = afs[0]
+      self._af_last = af
+      return self._addrs[af].popleft()
+   
+   def _attempt_next(self):
+      """Start next connection attempt, and schedule the one after that."""
+      if not (self._timer_next is None):
+         self._timer_next.cancel()
+         self._timer_next = None
+      
+      while (True):
+         addr = self._addr_next()
+         if (addr is None):
+            self._fail_check()
+            return
+         # A fast open connect() succeeds before anything is sent, so such an
+         # attempt would always win; only use it if there's nothing to race.
+         fastopen = (self._fastopen and self._lookup_done and
+            (not self._attempts) and (not any(self._addrs.values())))
+         sock = AsyncDataStream._sock_connect_start(addr, self._port,
+            *self._sock_args, fastopen)
+         if not (sock is None):
+            break
+      
+      fw = self._ed.fd_wrap(sock.fileno(), fl=sock)
+      timer = self._ed.set_timer(self._attempt_timeout, self._attempt_fail,
+         args=(fw,))
+      self._attempts[fw] = (sock, addr, timer)
+      fw.process_writability = functools.partial(self._attempt_writable, fw)
+      fw.write_r()
+      
+      if (any(self._addrs.values()) or (not self._lookup_done)):
+         self._timer_next = self._ed.set_timer(self._attempt_delay,
+            self._attempt_next)
+   
+   def _attempt_writable(self, fw):
+      """Process writability of a connecting socket."""
+      (sock, addr, timer) = self._attempts[fw]
+      err = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+      if (err):
+         _log(25, ('Async stream connection to {!a}:{!a} failed. Error: {!a}({!a})').format(addr, self._port, err, errno.errorcode[err]))
+         self._attempt_fail(fw)
+         return
+      
+      # We have a winner.
+      self._done = True
+      timer.cancel()
+      del(self._attempts[fw])
+      self._attempts_abort()
+      
+      stream = self._stream
+      stream._dst_ip = addr
+      fw.unregister()
+      stream.start(self._ed, sock, read_r=False, **self._start_kwargs)
+      stream._fw.write_r()
+      stream._process_connect(self._connect_callback)
+   
+   def _attempt_fail(self, fw):
+      """Abandon connection attempt and move on to the next address."""
+      (sock, addr, timer) = self._attempts.pop(fw)
+      if (timer):
+         timer.cancel()
+      fw.close()
+      if (any(self._addrs.values())):
+         self._attempt_next()
+      else:
+         self._fail_check()
+   
+   def _attempts_abort(self):
+      """Abort all pending connection attempts."""
+      if not (self._timer_next is None):
+         self._timer_next.cancel()
+         self._timer_next = None
+      for (fw, (sock, addr, timer)) in self._attempts.items():
+         timer.cancel()
+         fw.close()
+      self._attempts.clear()
+      self._addrs.clear()
+   
+   def _fail_check(self):
+      """Close stream if we've run out of things to try."""
+      if (self._done or (not self._lookup_done) or self._attempts or
+            self._timer_next or any(self._addrs.values())):
+         return
+      self._done = True
+      self._ed.set_timer(0, self._stream._process_close,
+         interval_relative=False)
+
+
 class AsyncLineStream(AsyncDataStream):
-   """Class for asynchronously accessing line-based bytestreams"""
+   """Class for asynchronously accessing line-based bytestreams
+   
+   Public attributes (r/w):
+      process_lines(lines): If set, called once per read with a list of
+         memoryviews of all lines completed by it, instead of calling
+         process_input() for each line. The views are only valid until the
+         call returns.
+   """
+   process_lines = None
    def __init__(self, ed=None, filelike=None, lineseps:collections.abc.Set=(b'\n',), **kwargs):
       AsyncDataStream.__init__(self, ed, filelike, **kwargs)
       self._inbuf_index_l = 0
       self._ls = lineseps
       self._ls_maxlen = max([len(s) for s in lineseps])
+      self._ls_re = self._ls_re_build(lineseps)
+      self._ls_multi = (len(set(lineseps)) > 1)
+   
+   @staticmethod
+   def _ls_re_build(lineseps):
+      """Build regex matching any of the specified line separators.
       
+      Shorter separators are tried first, so that of several separators
+      starting at the same offset the one ending earliest wins; matches
+      starting later but ending earlier still need to be looked for."""
+      seps = sorted(set(lineseps), key=len)
+      return re.compile(b'|'.join([re.escape(s) for s in seps]))
+   
    def _process_input1(self):
       """Input processing stage 1: split data into lines"""
       # Make sure we don't skip over seperators partially read earlier
       index_l = max(0, self._inbuf_index_l-self._ls_maxlen+1)
+      search = self._ls_re.search
+      multi = self._ls_multi
+      if (self.process_lines is None):
+         lines = None
+      else:
+         lines = []
       line_start = 0
       while (True):
-         line_end = None
-         for sep in self._ls:
-            i = self._inbuf.find(sep, index_l, self._index_in)
-            if (i == -1):
-               continue
-            if (line_end is None):
-               line_end = i+len(sep)
-               continue
-            line_end = min(line_end,i+len(sep))
-         
-         if (line_end is None):
+         m = search(self._inbuf, index_l, self._index_in)
+         if (m is None):
             break
-         self._process_input2(memoryview(self._inbuf)[line_start:line_end])
+         line_end = m.end()
+         while (multi):
+            # Lines end at the earliest end of any separator, which might
+            # start inside the one we found.
+            m = search(self._inbuf, m.start()+1, line_end-1)
+            if (m is None):
+               break
+            line_end = m.end()
+         line = memoryview(self._inbuf)[line_start:line_end]
+         if (lines is None):
+            self._process_input2(line)
+         else:
+            lines.append(line)
          line_start = index_l = line_end
       
+      if (lines):
+         self.process_lines(lines)
       if (line_start):
          self.discard_inbuf_data(line_start)
+      self._inbuf_index_l = self._index_in
    
    def _process_input2(self, *args, **kwargs):
       self.process_input(*args, **kwargs)
 
 
+class AsyncFramedStream(AsyncDataStream):
+   """Class for asynchronously accessing length-prefixed message streams
+   
+   Each frame on the wire consists of an unsigned integer length prefix,
+   an optional fixed-size header and a body. The length prefix counts all
+   bytes following it, including the header.
+   
+   Constructor arguments (in addition to those of AsyncDataStream):
+      len_fmt: struct format of the length prefix; one of B/H/I/L/Q,
+         optionally preceded by a byte order character ('>' or '<').
+      hdr_fmt: struct format of the frame header, or None for no header.
+      frame_size_max: maximum length value to accept, or 0 for no limit.
+   
+   Public attributes (r/w):
+      process_frames(frames): process list of frames completed by a read.
+        Without a header format, each frame is a memoryview of its body;
+        else, it's a (header tuple, body memoryview) pair. The views are
+        only valid until the call returns. The default implementation calls
+        process_input() once for each frame.
+   """
+   def __init__(self, *args, len_fmt:str='>H', hdr_fmt:str=None,
+         frame_size_max:int=0, **kwargs):
+      code = len_fmt[1:] if (len_fmt[:1] in ('@', '=', '<', '>', '!')) else len_fmt
+      if not (code in ('B', 'H', 'I', 'L', 'Q')):
+         raise ValueError('Length format {!a} is not a single unsigned integer.'.format(len_fmt))
+      self._len_struct = struct.Struct(len_fmt)
+      if (hdr_fmt is None):
+         self._hdr_struct = None
+         hdr_size = 0
+      else:
+         self._hdr_struct = struct.Struct(hdr_fmt)
+         hdr_size = self._hdr_struct.size
+      self._hdr_size = hdr_size
+      self.frame_size_max = frame_size_max
+      AsyncDataStream.__init__(self, *args, **kwargs)
+   
+   def start(self, *args, **kwargs):
+      AsyncDataStream.start(self, *args, **kwargs)
+      self.size_need = self._len_struct.size
+   
+   def send_frames(self, frames:collections.abc.Sequence, flush=True):
+      """Frame specified data and append it to pending output.
+      
+      Without a header format, frames elements are bytes-like frame bodies;
+      else they are (header values, body) pairs."""
+      pack_len = self._len_struct.pack
+      hs = self._hdr_struct
+      bufs = []
+      for frame in frames:
+         if (hs is None):
+            body = frame
+            hdr = None
+         else:
+            (hdr_vals, body) = frame
+            hdr = hs.pack(*hdr_vals)
+         
+         l = self._hdr_size + len(body)
+         if (0 < self.frame_size_max < l):
+            raise ValueError('Frame of length {} exceeds limit {}.'.format(l, self.frame_size_max))
+         try:
+            bufs.append(pack_len(l))
+         except struct.error as exc:
+            raise ValueError('Too much data.') from exc
+         if not (hdr is None):
+            bufs.append(hdr)
+         bufs.append(body)
+      
+      self.send_bytes(bufs, flush)
+   
+   def process_frames(self, frames):
+      """Process list of received frames."""
+      for frame in frames:
+         self.process_input(frame)
+   
+   def _process_input1(self):
+      """Input processing stage 1: split data into frames"""
+      buf = memoryview(self._inbuf)
+      unpack_len = self._len_struct.unpack_from
+      ls = self._len_struct.size
+      hs = self._hdr_struct
+      hl = self._hdr_size
+      lmax = self.frame_size_max
+      end = self._index_in
+      off = 0
+      frames = []
+      need = ls
+      while (end - off >= ls):
+         (l,) = unpack_len(buf, off)
+         if (0 < lmax < l):
+            _log(30, 'Closing {0} because frame length {1} exceeds limit {2}.'.format(self, l, lmax))
+            raise CloseFD()
+         if (l < hl):
+            _log(30, 'Closing {0} because frame length {1} is smaller than header size {2}.'.format(self, l, hl))
+            raise CloseFD()
+         
+         frame_end = off + ls + l
+         if (frame_end > end):
+            need = frame_end - off
+            break
+         if (hs is None):
+            frames.append(buf[off+ls:frame_end])
+         else:
+            frames.append((hs.unpack_from(buf, off+ls), buf[off+ls+hl:frame_end]))
+         off = frame_end
+      
+      if (frames):
+         self.process_frames(frames)
+      del(frames)
+      if (off):
+         self.discard_inbuf_data(off)
+      
+      # Don't bother us again until the next frame is complete, and make sure
+      # there's space for all of it.
+      self.size_need = need
+      if (need > self._inbuf_size):
+         self._inbuf_resize(need)
+
+
 class AsyncPopen(subprocess.Popen):
    """Popen subclass that automatically creates stdio Async*Stream instances
       for stdio streams of subprocess"""
@@ -630,33 +2502,1054 @@ class AsyncSockServer:
    """Asynchronous listening SOCK_STREAM/SOCK_SEQPACKET sockets.
    
    self.connect_process(sock, addressinfo) should be overridden by the instance
-     user; it will be called once for each accepted connection.
+     user; it will be called once for each accepted connection. Accepted
+     sockets are already nonblocking.
+   
+   If sock is specified, it should be a bound and listening socket, and will
+   be used instead of building a new one from the other arguments.
+   
+   Admission control: conn_count tracks the number of open accepted
+   connections for which connect_process() returned an open object with a
+   close_hook_add() method (e.g. an AsyncDataStream); they're counted until
+   that's closed. Other connections aren't counted. While conns_max > 0
+   connections are counted, no further ones are accepted; they queue up in
+   the listen backlog instead.
+   
+   If membudget (a MemoryBudget) is specified, no connections are
+   accepted while it's over its limit, and streams returned by
+   connect_process() are accounted against it.
+   
+   Public attributes (r/w):
+      conns_max: maximum number of concurrent connections; 0 for no limit
+      accept_batch: maximum number of connections to accept per readiness
+         event, so a connection flood can't starve other fds
    """
+   # From linux/asm-generic/socket.h; not exported by the socket module.
+   SO_ATTACH_REUSEPORT_CBPF = 51
+   ACCEPT_RETRY_DELAY = 0.1
+   _ACCEPT_ERRNO_RESOURCE = {EMFILE, ENFILE, ENOBUFS, ENOMEM}
    def __init__(self, ed, address, *, family:int=AF_INET, proto:int=0,
-         type_:int=SOCK_STREAM, backlog:int=16):
-      self.sock = socket_cls(family, type_, proto)
-      self.sock.setblocking(0)
-      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-      self.sock.bind(address)
-      self.sock.listen(backlog)
+         type_:int=SOCK_STREAM, backlog:int=socket.SOMAXCONN,
+         reuseport:bool=False, defer_accept:int=0, conns_max:int=0,
+         accept_batch:int=64, sock_profile=None, fastopen:int=0,
+         membudget=None, sock=None):
+      if (sock is None):
+         sock = self.build_listen_sock(address, family=family, proto=proto,
+            type_=type_, backlog=backlog, reuseport=reuseport,
+            defer_accept=defer_accept, sock_profile=sock_profile,
+            fastopen=fastopen)
+      self.sock = sock
+      self.conns_max = conns_max
+      self.accept_batch = accept_batch
+      self.conn_count = 0
+      self._accept_paused = False
+      self._ed = ed
+      self.membudget = membudget
+      if (_libc_accept4 is None):
+         self._addrbuf = None
+      else:
+         self._addrbuf = ctypes.create_string_buffer(128)
+         self._addrlen = ctypes.c_uint32()
+         self._addrlen_p = ctypes.byref(self._addrlen)
       self._fw = ed.fd_wrap(self.sock.fileno(), fl=self.sock)
       self._fw.process_readability = self._connect_process
       self._fw.read_r()
+      if not (membudget is None):
+         membudget.server_add(self)
+   
+   @staticmethod
+   def build_listen_sock(address, *, family:int=AF_INET, proto:int=0,
+         type_:int=SOCK_STREAM, backlog:int=socket.SOMAXCONN,
+         reuseport:bool=False, defer_accept:int=0, sock_profile=None,
+         fastopen:int=0):
+      """Build nonblocking socket listening on address.
+      
+      With reuseport, SO_REUSEPORT is set so that several sockets (usually
+      in different processes) can listen on the same address, and have the
+      kernel spread incoming connections over them.
+      With defer_accept > 0, TCP_DEFER_ACCEPT is set, so connections are
+      only reported once the client has sent data (or after defer_accept
+      seconds).
+      sock_profile is applied by sock_profile_apply(); accepted connections
+      inherit most of these options from the listening socket.
+      With fastopen > 0, TCP Fast Open is enabled with a queue of that many
+      pending fast-open requests."""
+      sock = socket_cls(family, type_, proto)
+      sock.setblocking(0)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      if (reuseport):
+         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      if (defer_accept > 0):
+         sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_DEFER_ACCEPT,
+            defer_accept)
+      if not (sock_profile is None):
+         sock_profile_apply(sock, sock_profile)
+      if (fastopen > 0):
+         sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN, fastopen)
+      sock.bind(address)
+      sock.listen(backlog)
+      return sock
+   
+   @classmethod
+   def sock_attach_cpu_steering(cls, sock, cpus=None):
+      """Attach classic BPF program to SO_REUSEPORT group of sock that hands
+         each incoming connection to the group member serving the CPU it
+         was received on.
+      
+      Group member indices follow the order the sockets were bound in.
+      cpus[i] is the CPU member i serves; the process using it should be
+      pinned to that CPU. If a CPU is listed more than once, its first
+      member gets its connections. Connections received on CPUs not listed
+      are balanced by the kernel as usual. Without cpus, member i serves
+      CPU i."""
+      SKF_AD_CPU = -0x1000 + 36
+      # ld #cpu
+      insns = [(0x20, 0, 0, SKF_AD_CPU & 0xffffffff)]
+      if (cpus is None):
+         # ret a
+         insns.append((0x16, 0, 0, 0))
+      else:
+         for (i, cpu) in enumerate(cpus):
+            # jeq #cpu, 0, 1; ret #i
+            insns.append((0x15, 0, 1, cpu))
+            insns.append((0x06, 0, 0, i))
+         # Out-of-range indices make the kernel fall back to its own
+         # selection.
+         insns.append((0x06, 0, 0, 0xffffffff))
+      prog = ctypes.create_string_buffer(b''.join(struct.pack('=HBBI', *insn)
+         for insn in insns))
+      fprog = struct.pack('HP', len(insns), ctypes.addressof(prog))
+      sock.setsockopt(SOL_SOCKET, cls.SO_ATTACH_REUSEPORT_CBPF, fprog)
    
    def connect_process(self, sock:socket_cls, addressinfo):
       """Should be overridden by instance user: process new incoming connection"""
       raise NotImplementedError()
    
-   def _connect_process(self):
-      """Internal method: process new incoming connection"""
-      while (True):
+   def conn_closed(self):
+      """Process close of a counted connection."""
+      self.conn_count -= 1
+      if (self._accept_paused and self._accept_allowed()):
+         self._accept_resume()
+   
+   def _accept_allowed(self):
+      if (0 < self.conns_max <= self.conn_count):
+         return False
+      return ((self.membudget is None) or (not self.membudget.over))
+   
+   def _accept_pause(self):
+      self._accept_paused = True
+      self._fw.read_u()
+   
+   def _accept_resume(self):
+      if (self._accept_paused and self._fw):
+         self._accept_paused = False
+         self._fw.read_r()
+   
+   def _accept_retry(self):
+      """Resume accepting after resource exhaustion, unless other limits
+         still prevent it; we'll be resumed once they stop doing so."""
+      if (self._accept_allowed()):
+         self._accept_resume()
+   
+   def _accept(self):
+      """Accept one connection. Returns (sock, addressinfo), or None if no
+         connection is pending."""
+      if (self._addrbuf is None):
          try:
             (sock, addressinfo) = self.sock.accept()
          except sockerr as exc:
-            if (exc.errno == EAGAIN):
-               return
+            if (exc.errno in (EAGAIN, ECONNABORTED)):
+               return None
             raise
-         self.connect_process(sock, addressinfo)
+         sock.setblocking(0)
+         return (sock, addressinfo)
+      
+      # Have the kernel give us a nonblocking, close-on-exec socket directly.
+      self._addrlen.value = len(self._addrbuf)
+      fd = _libc_accept4(self._fw.fd, self._addrbuf, self._addrlen_p,
+         socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC)
+      if (fd < 0):
+         err = ctypes.get_errno()
+         if (err in (EAGAIN, ECONNABORTED)):
+            return None
+         raise OSError(err, os.strerror(err))
+      
+      ls = self.sock
+      sock = socket_cls(ls.family, ls.type | socket.SOCK_NONBLOCK, ls.proto,
+         fileno=fd)
+      addressinfo = _sockaddr_parse(ls.family,
+         self._addrbuf.raw[:self._addrlen.value])
+      if (addressinfo is None):
+         addressinfo = sock.getpeername()
+      return (sock, addressinfo)
+   
+   def _connect_process(self):
+      """Internal method: process new incoming connections"""
+      if ((self.membudget is not None) and self.membudget.over):
+         self._accept_pause()
+         return
+      for i in range(self.accept_batch):
+         try:
+            conn = self._accept()
+         except EnvironmentError as exc:
+            if not (exc.errno in self._ACCEPT_ERRNO_RESOURCE):
+               raise
+            # Out of fds or memory; back off for a bit, instead of spinning
+            # on the listener.
+            _log(30, '{0} unable to accept connection: {1!a}; retrying in {2} seconds.'.format(self, str(exc), self.ACCEPT_RETRY_DELAY))
+            self._accept_pause()
+            self._ed.set_timer(self.ACCEPT_RETRY_DELAY, self._accept_retry)
+            return
+         
+         if (conn is None):
+            return
+         rv = self.connect_process(*conn)
+         if (hasattr(rv, 'close_hook_add') and rv):
+            self.conn_count += 1
+            rv.close_hook_add(self.conn_closed)
+         if ((self.membudget is not None) and hasattr(rv, 'membudget_set')
+               and (rv._membudget is None)):
+            rv.membudget_set(self.membudget)
+         if (0 < self.conns_max <= self.conn_count):
+            self._accept_pause()
+            return
+
+
+def _zerocopy_benchmark(sizes=(4096, 16384, 65536, 262144, 1048576),
+      total=1<<28, out=sys.stdout):
+   """Compare throughput of copying and MSG_ZEROCOPY sends over loopback TCP,
+      for a range of buffer sizes."""
+   import threading
+   import time
+   from . import ED_get
+   
+   def run(size, zc):
+      ed = ED_get()()
+      l = socket_cls(AF_INET, SOCK_STREAM)
+      l.bind(('127.0.0.1', 0))
+      l.listen(1)
+      c = socket.create_connection(l.getsockname())
+      (s, addr) = l.accept()
+      l.close()
+      def drain():
+         buf = bytearray(1<<20)
+         n = 0
+         while (n < total):
+            n += c.recv_into(buf)
+      def check():
+         if not (t.is_alive()):
+            ed.shutdown()
+      # Completion notifications are only reported for registered fds.
+      stream = AsyncDataStream(ed, s)
+      stream.process_input = lambda data: None
+      if (zc and not stream.zerocopy_enable(threshold=0)):
+         return None
+      data = bytes(size)
+      count = total // size
+      sent = 0
+      def refill():
+         nonlocal sent
+         while ((sent < count) and (len(stream._outbuf) < 64)):
+            stream.send_bytes((data,), flush=False)
+            sent += 1
+         stream._output_write()
+         if (sent < count):
+            stream._fw.write_r()
+      stream._fw.process_writability = refill
+      t = threading.Thread(target=drain)
+      timer = ed.set_timer(0.01, check, persist=True)
+      ts = time.time()
+      t.start()
+      stream._fw.write_r()
+      ed.event_loop()
+      timer.cancel()
+      t.join()
+      rv = total / (time.time() - ts)
+      stream.close()
+      c.close()
+      return rv
+   
+   rv = []
+   for size in sizes:
+      (r_copy, r_zc) = (run(size, False), run(size, True))
+      rv.append((size, r_copy, r_zc))
+      if not (out is None):
+         out.write('{0:>9} bytes: copy {1:8.1f} MiB/s, zerocopy {2}\n'.format(
+            size, r_copy/(1<<20), 'n/a' if (r_zc is None) else
+            '{0:8.1f} MiB/s'.format(r_zc/(1<<20))))
+   return rv
+
+
+def _selftest_loop(ed, timeout:float=5):
+   """Run event loop until shut down, or for at most timeout seconds."""
+   timer = ed.set_timer(timeout, ed.shutdown)
+   ed.event_loop()
+   if (timer):
+      timer.cancel()
+
+def _selftest_ssl(ed, out):
+   """SSL handshake, input following the handshake and session resumption."""
+   import ssl
+   import tempfile
+   import threading
+   with tempfile.TemporaryDirectory() as tmpdir:
+      cert = os.path.join(tmpdir, 'cert.pem')
+      try:
+         subprocess.check_call(('openssl', 'req', '-x509', '-newkey',
+            'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', cert, '-out', cert), stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+      except (EnvironmentError, subprocess.CalledProcessError):
+         out.write("Can't generate certificate; skipping.\n")
+         return
+      ctx_s = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+      ctx_s.load_cert_chain(cert)
+      ctx_c = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+      ctx_c.load_verify_locations(cert)
+   
+   # A TLS 1.3 client's first data tends to come in with its Finished
+   # message.
+   (sock_s, sock_c) = socket.socketpair()
+   stream = AsyncDataStream(ed, sock_s)
+   del(sock_s)
+   got = []
+   def process_input(data):
+      got.append(bytes(data))
+      stream.discard_inbuf_data()
+      ed.shutdown()
+   stream.process_input = process_input
+   def client():
+      with ctx_c.wrap_socket(sock_c, server_hostname='localhost') as c:
+         c.sendall(b'hello')
+         c.recv(1)
+   t = threading.Thread(target=client, daemon=True)
+   t.start()
+   stream.do_ssl_handshake(lambda: None, ssl_context=ctx_s, server_side=True)
+   _selftest_loop(ed)
+   out.write('{0}: got {1!a}\n'.format(stream._ssl_obj.version(), got))
+   if (got != [b'hello']):
+      raise Exception('Input sent along with end of handshake was lost.')
+   stream.close()
+   t.join(5)
+   
+   cache = SSLSessionCache()
+   reused = []
+   for i in range(2):
+      (sock_s, sock_c) = socket.socketpair()
+      server = AsyncDataStream(ed, sock_s)
+      client = AsyncDataStream(ed, sock_c)
+      del(sock_s, sock_c)
+      server.process_input = lambda data: None
+      server.do_ssl_handshake(lambda: server.send_bytes((b'x',)),
+         ssl_context=ctx_s, server_side=True)
+      def process_input(data, client=client):
+         # Session tickets come in after the handshake; make sure we've
+         # seen them.
+         reused.append(client._ssl_obj.session_reused)
+         client.close()
+         ed.shutdown()
+      client.process_input = process_input
+      client.do_ssl_handshake(lambda: None, ssl_context=ctx_c,
+         server_hostname='localhost', session_cache=cache)
+      _selftest_loop(ed)
+      server.close()
+   out.write('Session reused: {0}\n'.format(reused))
+   if (reused != [False, True]):
+      raise Exception('SSL session not resumed.')
+
+def _selftest_lines(ed, out):
+   """AsyncLineStream separator scanning and line batching."""
+   (sock_a, sock_b) = socket.socketpair()
+   stream = AsyncLineStream(ed, sock_a, lineseps=(b'\n', b'\r\n', b'abc', b'b'))
+   lines = []
+   stream.process_input = lambda line: lines.append(bytes(line))
+   # Separators split across reads, and overlapping ones: lines end at the
+   # earliest end of any separator.
+   for data in (b'one\r', b'\ntwo\n', b'xa', b'bcy\r\n', b'tail'):
+      sock_b.send(data)
+      stream._fw.process_readability()
+   out.write('Lines: {0!a}\n'.format(lines))
+   if (lines != [b'one\r\n', b'two\n', b'xab', b'cy\r\n']):
+      raise Exception('Line splitting mismatch.')
+   
+   batches = []
+   def process_lines(lines):
+      batches.append([bytes(line) for line in lines])
+   stream.process_lines = process_lines
+   sock_b.send(b'1\n2\n3\r\n4')
+   stream._fw.process_readability()
+   out.write('Batches: {0!a}\n'.format(batches))
+   if (batches != [[b'tail1\n', b'2\n', b'3\r\n']]):
+      raise Exception('Line batching mismatch.')
+   stream.close()
+   sock_b.close()
+
+def _selftest_frames(ed, out):
+   """AsyncFramedStream framing, headers and limits."""
+   for fmt in ('>h', '>HH', '>f', '>>H'):
+      try:
+         AsyncFramedStream(run_start=False, len_fmt=fmt)
+      except ValueError:
+         continue
+      raise Exception('Length format {0!a} accepted.'.format(fmt))
+   
+   (sock_a, sock_b) = socket.socketpair()
+   kwargs = dict(len_fmt='>I', hdr_fmt='>BH', frame_size_max=1<<20)
+   sa = AsyncFramedStream(ed, sock_a, **kwargs)
+   sb = AsyncFramedStream(ed, sock_b, **kwargs)
+   del(sock_a, sock_b)
+   bodies = [b'', b'x', os.urandom(300000), b'last']
+   frames = [((i, len(body) % 65536), body) for (i, body) in enumerate(bodies)]
+   got = []
+   def process_frames(frames):
+      for (hdr, body) in frames:
+         got.append((hdr, bytes(body)))
+      if (len(got) == len(bodies)):
+         # Over the limit; the receiver should hang up.
+         sa.send_bytes((struct.pack('>I', (1<<20) + 1),))
+   sb.process_frames = process_frames
+   sa.process_input = lambda data: None
+   sb.process_close = ed.shutdown
+   sa.send_frames(frames)
+   _selftest_loop(ed)
+   out.write('Got {0} frames; receiver open: {1}\n'.format(len(got), bool(sb)))
+   if (got != frames):
+      raise Exception('Frame mismatch.')
+   if (sb):
+      raise Exception('Oversized frame accepted.')
+   sa.close()
+
+def _selftest_happy_eyeballs(ed, out):
+   """Happy Eyeballs connection racing."""
+   class Results:
+      def __init__(self, addrs):
+         self.addrs = [ip_address_build(a) for a in addrs]
+      def get_rr_ip_addresses(self):
+         return self.addrs
+   class LookupManager:
+      # Answers AAAA queries after A ones.
+      answers = {QTYPE_A: (0.01, ('127.0.0.2', '127.0.0.1')),
+         QTYPE_AAAA: (0.02, ('::1',))}
+      def build_simple_query(self, callback, query_name, qtypes, timeout):
+         (delay, addrs) = self.answers[qtypes[0]]
+         ed.set_timer(delay, callback, args=(None, Results(addrs)))
+   class SA:
+      pass
+   sa = SA()
+   sa.ed = ed
+   sa.dnslm = LookupManager()
+   
+   # Only 127.0.0.1 accepts connections.
+   l = socket_cls(AF_INET, SOCK_STREAM)
+   l.bind(('127.0.0.1', 0))
+   l.listen(4)
+   port = l.getsockname()[1]
+   log = []
+   stream = AsyncDataStream(run_start=False)
+   stream.process_close = lambda: (log.append('closed'), ed.shutdown())
+   def connect_callback(stream):
+      log.append(str(stream._dst_ip))
+      ed.shutdown()
+   stream.connect_async_sock_bydns(sa, 'test.invalid', port,
+      connect_callback=connect_callback, attempt_delay=0.05)
+   _selftest_loop(ed)
+   out.write('Connected to {0}\n'.format(log))
+   if (log != ['127.0.0.1']):
+      raise Exception('Connection race failed.')
+   stream.close()
+   l.close()
+   
+   del(log[:])
+   stream = AsyncDataStream(run_start=False)
+   stream.process_close = lambda: (log.append('closed'), ed.shutdown())
+   stream.connect_async_sock_bydns(sa, 'test.invalid', port,
+      connect_callback=connect_callback, attempt_delay=0.05)
+   _selftest_loop(ed)
+   out.write('With nothing listening: {0}\n'.format(log))
+   if (log != ['closed']):
+      raise Exception('Failed connection race not reported.')
+
+def _selftest_server(ed, out):
+   """AsyncSockServer accepting and admission control."""
+   server = AsyncSockServer(ed, ('127.0.0.1', 0), conns_max=2)
+   address = server.sock.getsockname()
+   streams = []
+   peers = []
+   def connect_process(sock, addressinfo):
+      if (sock.getblocking() or os.get_inheritable(sock.fileno())):
+         raise Exception('Accepted socket is blocking or inheritable.')
+      peers.append(addressinfo)
+      stream = AsyncDataStream(ed, sock)
+      stream.process_input = lambda data: None
+      streams.append(stream)
+      if (len(streams) == 2):
+         # Give the third connection a chance to be accepted.
+         ed.set_timer(0.1, ed.shutdown)
+      elif (len(streams) == 3):
+         ed.shutdown()
+      return stream
+   server.connect_process = connect_process
+   
+   clients = [socket_cls(AF_INET, SOCK_STREAM) for i in range(3)]
+   for c in clients:
+      c.connect(address)
+   _selftest_loop(ed)
+   out.write('Accepted {0} of {1} with conns_max={2}.\n'.format(len(streams),
+      len(clients), server.conns_max))
+   if (peers != [c.getsockname() for c in clients[:2]]):
+      raise Exception('Peer address mismatch: {0}'.format(peers))
+   if (server.conn_count != 2):
+      raise Exception('Connection limit not applied.')
+   
+   streams[0].close()
+   _selftest_loop(ed)
+   out.write('After one close: accepted {0}.\n'.format(len(streams)))
+   if ((len(streams) != 3) or (peers[2] != clients[2].getsockname())):
+      raise Exception('Accepting not resumed after close.')
+   for stream in streams:
+      stream.close()
+   for c in clients:
+      c.close()
+   server._fw.close()
+
+def _selftest_deadlines(ed, out):
+   """Stream deadlines."""
+   sweeper = StreamDeadlineSweeper(ed, granularity=0.02)
+   t0 = time_()
+   fired = []
+   peers = []
+   def stream_build(**kwargs):
+      (sock_a, sock_b) = socket.socketpair()
+      stream = AsyncDataStream(ed, sock_a)
+      del(sock_a)
+      stream.process_input = lambda data: None
+      def process_deadline(kind):
+         fired.append((kind, time_() - t0))
+         stream.close()
+         if (len(fired) == 3):
+            ed.shutdown()
+      stream.process_deadline = process_deadline
+      stream.deadlines_set(sweeper=sweeper, **kwargs)
+      peers.append(sock_b)
+      return (stream, sock_b)
+   
+   stream_build(first_byte=0.1)
+   (stream, peer) = stream_build(write_stall=0.2)
+   # Fill up the socket buffers; our peer doesn't read.
+   stream.send_bytes((bytes(1<<23),))
+   (stream, peer) = stream_build(idle=0.2)
+   def activity(n):
+      # Keep the idle stream busy until 0.3s in.
+      peer.send(b'x')
+      if (n > 1):
+         ed.set_timer(0.1, activity, args=(n-1,))
+   activity(4)
+   _selftest_loop(ed)
+   sweeper.close()
+   for sock in peers:
+      sock.close()
+   out.write('Fired: {0}\n'.format(', '.join('{0} after {1:.2f}s'.format(*f)
+      for f in fired)))
+   if ([f[0] for f in fired] != ['first_byte', 'write_stall', 'idle']):
+      raise Exception('Deadline mismatch.')
+   if (fired[2][1] < 0.4):
+      raise Exception('Idle deadline fired despite activity.')
+
+def _selftest_stats(ed, out):
+   """Stream statistics and TCP_INFO sampling."""
+   (sock_a, sock_b) = socket.socketpair()
+   sa = AsyncDataStream(ed, sock_a)
+   sb = AsyncDataStream(ed, sock_b)
+   del(sock_a, sock_b)
+   if not (sa.stats_get() is None):
+      raise Exception('Statistics enabled by default.')
+   sa.stats_enable()
+   sb.stats_enable()
+   size = 1<<22
+   def process_input(data):
+      if (len(data) >= size):
+         ed.shutdown()
+   sb.process_input = process_input
+   sa.process_input = lambda data: None
+   sa.send_bytes((bytes(size),))
+   if (sa.stats_get()['outbuf_peak'] < size//2):
+      raise Exception('Pending output not counted.')
+   _selftest_loop(ed)
+   (st_a, st_b) = (sa.stats_get(), sb.stats_get())
+   out.write('Sender: {0}\nReceiver: {1}\n'.format(st_a, st_b))
+   if ((st_a['bytes_out'] != size) or (st_a['outbuf_pending'] != 0) or
+         (st_b['bytes_in'] != size) or (st_b['inbuf_peak'] != size) or
+         (st_b['reads'] < 2)):
+      raise Exception('Statistics mismatch.')
+   # That's more than fits into the socket buffers.
+   if ((st_a['writes_partial'] + st_a['writes_eagain'] == 0) or
+         (st_a['write_blocked_time'] <= 0)):
+      raise Exception('Blocked writes not counted.')
+   sa.close()
+   sb.close()
+   
+   l = socket_cls(AF_INET, SOCK_STREAM)
+   l.bind(('127.0.0.1', 0))
+   l.listen(1)
+   stream = AsyncDataStream(ed, socket.create_connection(l.getsockname()))
+   sampler = TCPInfoSampler(ed, interval=0.01)
+   sampler.stream_add(stream)
+   ed.set_timer(0.05, ed.shutdown)
+   _selftest_loop(ed)
+   ti = stream.stats_get()['tcp_info']
+   out.write('TCP_INFO: {0}\n'.format(ti))
+   # 1: TCP_ESTABLISHED
+   if ((ti is None) or (ti.state != 1) or (ti.snd_mss <= 0)):
+      raise Exception('TCP_INFO not sampled.')
+   stream.close()
+   sampler.sample()
+   if (len(sampler._streams)):
+      raise Exception('Closed stream still sampled.')
+   sampler.close()
+   l.close()
+
+def _selftest_sock_profiles(ed, out):
+   """Socket profiles and TCP Fast Open connections."""
+   def opts(sock):
+      return (sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+         sock.getsockopt(socket.IPPROTO_TCP, TCP_NOTSENT_LOWAT))
+   server = AsyncSockServer(ed, ('127.0.0.1', 0), sock_profile='latency',
+      fastopen=16)
+   got = []
+   def connect_process(sock, addressinfo):
+      got.append(opts(sock))
+      stream = AsyncDataStream(ed, sock)
+      def process_input(data):
+         got.append(bytes(data))
+         ed.shutdown()
+      stream.process_input = process_input
+      return stream
+   server.connect_process = connect_process
+   
+   client = AsyncDataStream(run_start=False)
+   client.connect_async_sock(ed, ip_address_build('127.0.0.1'),
+      server.sock.getsockname()[1], sock_profile={'nodelay': True,
+      'notsent_lowat': 4096}, fastopen=True)
+   # With TCP_FASTOPEN_CONNECT, the SYN goes out along with this.
+   client.send_bytes((b'hello',))
+   _selftest_loop(ed)
+   tfo = client.fl.getsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT)
+   out.write('Client options: {0}; fast open: {1}\nServer got: {2}\n'.format(
+      opts(client.fl), tfo, got))
+   if (opts(client.fl) != (1, 4096)):
+      raise Exception('Client socket profile not applied.')
+   if (got != [(1, 16384), b'hello']):
+      raise Exception('Server socket profile not applied, or data lost.')
+   client.close()
+   server._fw.close()
+
+def _selftest_autoflush(ed, out):
+   """Deferred output flushing."""
+   (sock_a, sock_b) = socket.socketpair()
+   sa = AsyncDataStream(ed, sock_a)
+   sb = AsyncDataStream(ed, sock_b)
+   del(sock_a, sock_b)
+   sa.process_input = lambda data: None
+   stats = sa.stats_enable()
+   got = []
+   def process_input(data):
+      got.append(bytes(data))
+      sb.discard_inbuf_data()
+      ed.shutdown()
+   sb.process_input = process_input
+   writes = []
+   def send():
+      for data in (b'one', b'two', b'three'):
+         sa.send_bytes((data,))
+      writes.append(stats.writes)
+   ed.autoflush = True
+   ed.set_timer(0, send)
+   _selftest_loop(ed)
+   out.write('Writes: {0} during iteration, {1} after; got {2!a}\n'.format(
+      writes[0], stats.writes, got))
+   if ((writes != [0]) or (stats.writes != 1) or (got != [b'onetwothree'])):
+      raise Exception('Output not flushed at end of loop iteration.')
+   sa.close()
+   sb.close()
+
+def _selftest_lanes(ed, out):
+   """Output priority lanes."""
+   (sock_a, sock_b) = socket.socketpair()
+   sa = AsyncDataStream(ed, sock_a)
+   sb = AsyncDataStream(ed, sock_b)
+   del(sock_a, sock_b)
+   sa.process_input = lambda data: None
+   for weights in ((1,), (4, 0, 1)):
+      try:
+         sa.output_lanes_set(weights)
+      except ValueError:
+         continue
+      raise Exception('Lane weights {0!a} accepted.'.format(weights))
+   
+   size = sa._LANE_QUANTUM
+   # Fill up the socket buffers, so everything after this gets queued.
+   sa.send_bytes((b'B'*(1<<22),), priority=sa.PRIO_BULK)
+   for i in range(40):
+      sa.send_bytes((b'H'*size,), priority=sa.PRIO_HIGH)
+   for i in range(10):
+      sa.send_bytes((b'D'*size,))
+   total = (1<<22) + 50*size
+   got = []
+   def process_input(data):
+      if (len(data) >= total):
+         got.append(bytes(data))
+         ed.shutdown()
+   sb.process_input = process_input
+   _selftest_loop(ed)
+   data = got[0]
+   order = data[1<<22::size].decode('ascii')
+   out.write('Message order: {0}\n'.format(order))
+   if (order != 'H'*16 + 'D'*4 + 'H'*16 + 'D'*4 + 'H'*8 + 'D'*2):
+      raise Exception('Lane scheduling mismatch.')
+   if (data != b''.join(bytes((c,))*size for c in data[::size])):
+      raise Exception('Messages interleaved.')
+   sa.close()
+   sb.close()
+
+def _selftest_rate_limit(ed, out):
+   """Token bucket rate limiting."""
+   for (rate, burst) in ((0, None), (100, 0.5)):
+      try:
+         TokenBucket(ed, rate, burst)
+      except ValueError:
+         continue
+      raise Exception('TokenBucket({0!a}, {1!a}) accepted.'.format(rate, burst))
+   
+   rate = 400000
+   size = 100000
+   def run(buckets_out, bucket_in=None):
+      """Send size bytes over each of a set of socketpairs, and return how
+         long that took."""
+      done = []
+      streams = []
+      for b in buckets_out:
+         (sock_a, sock_b) = socket.socketpair()
+         sa = AsyncDataStream(ed, sock_a)
+         sb = AsyncDataStream(ed, sock_b)
+         del(sock_a, sock_b)
+         sa.process_input = lambda data: None
+         sa.rate_limit_set(out=b)
+         sb.rate_limit_set(in_=bucket_in)
+         got = [0]
+         def process_input(data, sb=sb, got=got):
+            got[0] += len(data)
+            sb.discard_inbuf_data()
+            if (got[0] == size):
+               done.append(True)
+               if (len(done) == len(buckets_out)):
+                  ed.shutdown()
+         sb.process_input = process_input
+         streams.extend((sa, sb))
+         sa.send_bytes((bytes(size),))
+      t0 = time_()
+      _selftest_loop(ed)
+      rv = time_() - t0
+      for stream in streams:
+         stream.close()
+      if (len(done) != len(buckets_out)):
+         raise Exception('Rate-limited transfer incomplete.')
+      return rv
+   
+   # Two streams with their own generous limits sharing a common one.
+   parent = TokenBucket(ed, rate, rate/10)
+   buckets = [TokenBucket(ed, rate*10, parent=parent) for i in range(2)]
+   t = run(buckets)
+   out.write('Shared output limit: {0} bytes in {1:.2f}s\n'.format(2*size, t))
+   # (2*size - burst) / rate
+   if (t < 0.35):
+      raise Exception('Output rate limit not applied.')
+   
+   t = run([None], TokenBucket(ed, rate/2, rate/20))
+   out.write('Input limit: {0} bytes in {1:.2f}s\n'.format(size, t))
+   if (t < 0.35):
+      raise Exception('Input rate limit not applied.')
+
+def _selftest_membudget(ed, out):
+   """Memory budget enforcement."""
+   budget = MemoryBudget(1<<20)
+   server = AsyncSockServer(ed, ('127.0.0.1', 0), membudget=budget)
+   (sock_a, sock_b) = socket.socketpair()
+   stream = AsyncDataStream(ed, sock_a)
+   # Our peer doesn't read at first.
+   peer = AsyncDataStream(ed, sock_b, read_r=False)
+   del(sock_a, sock_b)
+   peer.process_input = lambda data: peer.discard_inbuf_data()
+   
+   log = []
+   def done_check():
+      if (len(log) == 2):
+         ed.shutdown()
+   def connect_process(sock, addressinfo):
+      log.append('accepted')
+      done_check()
+   server.connect_process = connect_process
+   def process_input(data):
+      log.append(bytes(data))
+      stream.discard_inbuf_data()
+      done_check()
+   stream.process_input = process_input
+   
+   stream.membudget_set(budget)
+   stream.send_bytes((bytes(2<<20),))
+   peer.send_bytes((b'ping',))
+   client = socket.create_connection(server.sock.getsockname())
+   paused = []
+   def drain():
+      paused.append((budget.usage_by_class().get(AsyncDataStream), list(log)))
+      peer._fw.read_r()
+   ed.set_timer(0.1, drain)
+   _selftest_loop(ed)
+   (usage, log_paused) = paused[0]
+   out.write('Usage over budget: {0}; events: {1!a}\n'.format(usage, log))
+   if (usage <= budget.limit):
+      raise Exception('Budget not exceeded.')
+   if (log_paused):
+      raise Exception('Heaviest stream or server not paused.')
+   if (len(log) != 2):
+      raise Exception('Streams and servers not resumed.')
+   if (budget.over or (budget.used >= budget.resume_level)):
+      raise Exception('Resumed while over budget.')
+   stream.close()
+   if (budget.used != 0):
+      raise Exception('Closed stream still accounted.')
+   peer.close()
+   client.close()
+   server._fw.close()
+
+def _selftest_transforms(ed, out):
+   """Stream transform stages."""
+   class XorTransform(StreamTransform):
+      table = bytes(i ^ 0x5a for i in range(256))
+      def transform_input(self, data, max_length=0):
+         return bytes(data).translate(self.table)
+      def transform_output(self, buffers):
+         return [bytes(buf).translate(self.table) for buf in buffers]
+   
+   (sock_a, sock_b) = socket.socketpair()
+   sa = AsyncDataStream(ed, sock_a)
+   # Small enough to make the decompressor hold back output.
+   sb = AsyncDataStream(ed, sock_b, inbufsize_max=65536)
+   del(sock_a, sock_b)
+   for stream in (sa, sb):
+      stream.transform_push(ZlibTransform())
+      stream.transform_push(XorTransform())
+   try:
+      sa.output_lanes_set()
+   except ValueError:
+      pass
+   else:
+      raise Exception('Output lanes set up on transformed stream.')
+   
+   msgs = [b'hello', bytes(1<<20), os.urandom(100000), b'bye']
+   total = sum(len(m) for m in msgs)
+   got = []
+   def process_input(data):
+      got.append(bytes(data))
+      sb.discard_inbuf_data()
+      if (sum(len(d) for d in got) >= total):
+         ed.shutdown()
+   sb.process_input = process_input
+   sa.process_input = lambda data: None
+   stats = sa.stats_enable()
+   for msg in msgs:
+      sa.send_bytes((msg,))
+   _selftest_loop(ed)
+   out.write('Sent {0} bytes as {1}; received in {2} chunks of up to {3}.\n'
+      .format(total, stats.bytes_out, len(got), max(len(d) for d in got)))
+   if (b''.join(got) != b''.join(msgs)):
+      raise Exception('Transformed data mismatch.')
+   if (stats.bytes_out > 200000):
+      raise Exception('Output not compressed.')
+   if (max(len(d) for d in got) > 65536):
+      raise Exception('Input buffer limit exceeded.')
+   if not (sb):
+      raise Exception('Receiver closed on decompressed data.')
+   sa.close()
+   sb.close()
+
+def _selftest_mmap(ed, out):
+   """Sending from file mappings."""
+   import tempfile
+   with tempfile.TemporaryDirectory() as tmpdir:
+      paths = [os.path.join(tmpdir, name) for name in ('a', 'b', 'empty')]
+      contents = [os.urandom(300000), os.urandom(5000), b'']
+      for (path, data) in zip(paths, contents):
+         with open(path, 'wb') as f:
+            f.write(data)
+      
+      cache = MmapCache(size_max=1)
+      (sock_a, sock_b) = socket.socketpair()
+      sa = AsyncDataStream(ed, sock_a)
+      sb = AsyncDataStream(ed, sock_b)
+      del(sock_a, sock_b)
+      sa.mmap_cache = cache
+      sa.process_input = lambda data: None
+      
+      with open(paths[0], 'rb') as f:
+         if not (cache.get(f) is cache.get(paths[0])):
+            raise Exception('Mapping not reused.')
+         sa.send_bytes_from_mmap(f, 1000, 2000)
+      sa.send_bytes_from_mmap(paths[2])
+      try:
+         sa.send_bytes_from_mmap(paths[1], 4000, 2000)
+      except ValueError:
+         pass
+      else:
+         raise Exception('Range beyond end of file accepted.')
+      # Evicts the mapping of the first file, which is still being sent.
+      sa.send_bytes_from_mmap(paths[1])
+      sa.send_bytes_from_mmap(paths[0])
+      expect = contents[0][1000:3000] + contents[1] + contents[0]
+      
+      received = []
+      def process_input(data):
+         if (len(data) >= len(expect)):
+            received.append(bytes(data))
+            ed.shutdown()
+      sb.process_input = process_input
+      _selftest_loop(ed)
+      got = b''.join(received)
+      out.write('Sent {0} bytes from mappings; {1} cached.\n'.format(len(got),
+         len(cache._maps)))
+      if (got != expect):
+         raise Exception('Mapped data mismatch.')
+      sa.close()
+      sb.close()
+      
+      mv = cache.get(paths[0])
+      with open(paths[0], 'r+b') as f:
+         f.write(b'x')
+      os.utime(paths[0], ns=(0, 0))
+      if ((cache.get(paths[0]) is mv) or
+            (bytes(cache.get(paths[0])[:1]) != b'x')):
+         raise Exception('Modified file not mapped anew.')
+
+def _selftest_cpu_steering(ed, out):
+   """SO_REUSEPORT CPU steering."""
+   affinity = os.sched_getaffinity(0)
+   cpu = min(affinity)
+   # Loopback connections are received on the CPU that opens them.
+   os.sched_setaffinity(0, (cpu,))
+   try:
+      for (cpus, member) in (([cpu + 1, cpu], 1), ([cpu, cpu + 1], 0)):
+         socks = []
+         address = ('127.0.0.1', 0)
+         for i in range(2):
+            socks.append(AsyncSockServer.build_listen_sock(address,
+               reuseport=True))
+            address = socks[-1].getsockname()
+         AsyncSockServer.sock_attach_cpu_steering(socks[0], cpus)
+         got = []
+         for i in range(4):
+            c = socket.create_connection(address)
+            for (j, sock) in enumerate(socks):
+               try:
+                  sock.accept()[0].close()
+               except BlockingIOError:
+                  continue
+               got.append(j)
+            c.close()
+         for sock in socks:
+            sock.close()
+         out.write('CPU map {0}: members {1}\n'.format(cpus, got))
+         if (got != [member]*4):
+            raise Exception('Connections not steered by CPU map.')
+   finally:
+      os.sched_setaffinity(0, affinity)
+
+def _selftest_zerocopy(ed, out):
+   """MSG_ZEROCOPY sends and socket error reporting."""
+   l = socket_cls(AF_INET, SOCK_STREAM)
+   l.bind(('127.0.0.1', 0))
+   l.listen(1)
+   sa = AsyncDataStream(ed, socket.create_connection(l.getsockname()))
+   # Don't read at first, so the big buffers take several sends.
+   sb = AsyncDataStream(ed, l.accept()[0], read_r=False)
+   bufs = [bytearray(os.urandom(1<<22)), b'x', bytes(200000)]
+   total = sum(len(buf) for buf in bufs)
+   got = []
+   done = []
+   def done_check():
+      if (got and (len(done) == 2)):
+         ed.shutdown()
+   def process_input(data):
+      if (len(data) >= total):
+         got.append(bytes(data))
+         done_check()
+   def zc_callback(buf):
+      done.append(buf)
+      done_check()
+   if not (sa.zerocopy_enable(callback=zc_callback)):
+      out.write('Zerocopy not supported; skipping.\n')
+      return
+   sa.process_input = lambda data: None
+   sb.process_input = process_input
+   for buf in bufs:
+      sa.send_bytes((buf,))
+   ed.set_timer(0.05, sb._fw.read_r)
+   _selftest_loop(ed)
+   out.write('{0} zerocopy sends, {1} copied; completed {2}.\n'.format(
+      sa.zc_sent, sa.zc_copied, [len(buf) for buf in done]))
+   if (got != [b''.join(bufs)]):
+      raise Exception('Zerocopy data mismatch.')
+   if ((len(done) != 2) or (done[0] is not bufs[0]) or
+         (done[1] is not bufs[2])):
+      raise Exception('Completion not reported per buffer.')
+   if (sa.zc_sent < 3):
+      raise Exception('Big buffer sent in one go; test ineffective.')
+   
+   # Have the peer reset the connection; we'll only hear about that
+   # through the error check.
+   sa._fw.read_u()
+   sb.fl.setsockopt(SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+   sb.close()
+   del(sb)
+   ed.set_timer(0.05, ed.shutdown)
+   _selftest_loop(ed)
+   try:
+      sa._process_errqueue()
+   except CloseFD:
+      pass
+   else:
+      raise Exception('Socket error not reported.')
+   sa.close()
+   l.close()
+
+_SELFTEST_CHECKS = [
+   _selftest_ssl,
+   _selftest_lines,
+   _selftest_frames,
+   _selftest_happy_eyeballs,
+   _selftest_server,
+   _selftest_cpu_steering,
+   _selftest_deadlines,
+   _selftest_stats,
+   _selftest_sock_profiles,
+   _selftest_autoflush,
+   _selftest_lanes,
+   _selftest_rate_limit,
+   _selftest_membudget,
+   _selftest_transforms,
+   _selftest_mmap,
+   _selftest_zerocopy,
+]
+
+def _selftest_local(out=None):
+   """Run non-interactive checks of stream functionality on socketpairs and
+      loopback connections; raises an exception on failure."""
+   from . import ED_get
+   if (out is None):
+      out = sys.stdout
+   
+   for check in _SELFTEST_CHECKS:
+      out.write('==== {0} ====\n'.format(check.__doc__))
+      check(ED_get()(), out)
+   out.write('All local tests passed.\n')
 
 
 def _selftest(out=None):
@@ -736,4 +3629,5 @@ def _selftest(out=None):
    sp.kill()
 
 if (__name__ == '__main__'):
+   _selftest_local(sys.stdout)
    _selftest(sys.stdout)
@@ -45,6 +45,17 @@ def _urlsplit2hostport(us):
   return (host, port)
     
 _EOL = b'\x0d\x0a'
+_HDR_END = _EOL*2
+
+def _hdrs_parse(hdr_data):
+  """Split HTTP header block into start line and dict of headers."""
+  hdr_split = hdr_data.split(_EOL)
+  hdrs = {}
+  for line in hdr_split[1:]:
+    (k, v) = line.split(b':', 1)
+    hdrs[k.lower().strip()] = v.lstrip()
+  return (hdr_split[0], hdrs)
+
 class Query:
   PROTO_VER = b'HTTP/1.1'
   def __init__(self, url, method=b'GET', hdrs={}):
@@ -87,20 +98,15 @@ class AsyncHTTPStream(AsyncDataStream):
 
   def _process_input1(self):
     # Find end of HTTP headers.
-    off = bytes(self._inbuf[self.__hdr_offset:self._index_in]).find(b'\x0d\x0a\x0d\x0a')
+    off = self._inbuf.find(_HDR_END, self.__hdr_offset, self._index_in)
     if off < 0:
       self.__hdr_offset = max(self._index_in-3, 0)
       return
-    off += self.__hdr_offset
     hdr_data = bytes(self._inbuf[:off])
     self.discard_inbuf_data(off+4)
     # Parse HTTP header data.
-    hdr_split = hdr_data.split(b'\x0d\x0a')
-    status_code = int(hdr_split[0].split()[1])
-    hdrs = {}
-    for line in hdr_split[1:]:
-      (k, v) = line.split(b':', 1)
-      hdrs[k.lower().strip()] = v.lstrip()
+    (status_line, hdrs) = _hdrs_parse(hdr_data)
+    status_code = int(status_line.split()[1])
     self.process_hdrs(status_code, hdrs)
     # Restore non-header handler
     s = super()._process_input1
@@ -110,14 +116,15 @@ class AsyncHTTPStream(AsyncDataStream):
       s()
     
   @classmethod
-  def build_by_query(cls, sa, query):
+  def build_by_query(cls, sa, query, ssl_context=None):
     self = cls(sa.ed, run_start=False)
 
     def connect_cb(*args):
       self.send_request(query)
     
     if (query.is_ssl):
-      self.do_ssl_handshake(connect_cb)
+      self.do_ssl_handshake(connect_cb, ssl_context=ssl_context,
+        server_hostname=query.host.decode('ascii'))
       connect_cb = None
 
     def start():
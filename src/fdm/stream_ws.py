@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+#Copyright 2019 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# WebSocket (RFC 6455) streams.
+
+import base64
+import hashlib
+import logging
+import os
+import struct
+
+from .stream import AsyncDataStream
+from .stream_http import Query, _EOL, _HDR_END, _hdrs_parse
+
+_logger = logging.getLogger('gonium.fdm.stream_ws')
+_log = _logger.log
+
+_WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONT = 0
+OP_TEXT = 1
+OP_BINARY = 2
+OP_CLOSE = 8
+OP_PING = 9
+OP_PONG = 10
+
+# Close status codes
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_INVALID_DATA = 1007
+CLOSE_TOO_BIG = 1009
+
+_HDR_LEN16 = struct.Struct('>BBH')
+_HDR_LEN64 = struct.Struct('>BBQ')
+
+
+def _ws_accept_key(key):
+  return base64.b64encode(hashlib.sha1(key + _WS_GUID).digest())
+
+def _ws_mask(data, key):
+  """XOR data with repeated 4-byte key, as one wide integer operation."""
+  n = len(data)
+  if (n == 0):
+    return b''
+  k = (key * ((n >> 2) + 1))[:n]
+  return (int.from_bytes(data, 'little') ^ int.from_bytes(k, 'little')).to_bytes(n, 'little')
+
+
+class AsyncWebSocketStream(AsyncDataStream):
+  """WebSocket connection over an AsyncDataStream.
+
+  With server_side, the stream expects a client's upgrade request; else it
+  sends one (see build_by_url()). Once the handshake is done, process_open()
+  is called, and messages can be sent and received. Fragmented messages
+  are reassembled; pings are answered automatically. With ping_interval,
+  a ping is sent that often, and the connection is closed if the previous
+  one hasn't been answered by then.
+
+  public class methods:
+    build_by_url(sa, url, ssl_context, **kwargs): Build client stream and
+      a function to start connecting
+  public instance methods:
+    send_message(data): Send str as text, bytes-like as binary message
+    ping(data): Send ping
+    ws_close(code, reason): Start closing handshake
+  Public attributes (intended for reading only):
+    ws_open: whether the handshake has been completed
+    protocol: negotiated subprotocol, or None
+  Public attributes (r/w):
+    process_open(): Process completion of handshake
+    process_message(data): Process received message; str for text, bytes
+      for binary messages
+    process_close(): See parent.
+  """
+  def __init__(self, *args, server_side=False, protocols=(),
+      ping_interval=0, msg_size_max=1<<24, **kwargs):
+    self.ws_open = False
+    self.protocol = None
+    self._ws_server = server_side
+    self._ws_protocols = tuple(protocols)
+    self._ws_ping_interval = ping_interval
+    self._ws_msg_size_max = msg_size_max
+    self._ws_key = None
+    self._ws_hdr_offset = 0
+    self._ws_frags = None
+    self._ws_frag_op = None
+    self._ws_close_sent = False
+    self._ws_ping_pending = False
+    self._ws_timer = None
+    super().__init__(*args, **kwargs)
+
+  def process_open(self):
+    pass
+
+  def _ws_request_send(self, query):
+    self._ws_key = base64.b64encode(os.urandom(16))
+    f = [
+      b'GET ', query.lp, b' HTTP/1.1', _EOL,
+      b'Host: ', query.host, _EOL,
+      b'Upgrade: websocket', _EOL,
+      b'Connection: Upgrade', _EOL,
+      b'Sec-WebSocket-Key: ', self._ws_key, _EOL,
+      b'Sec-WebSocket-Version: 13', _EOL,
+    ]
+    if (self._ws_protocols):
+      f.extend((b'Sec-WebSocket-Protocol: ',
+        ', '.join(self._ws_protocols).encode('ascii'), _EOL))
+    for k,v in query.hdrs.items():
+      f.extend([k, b': ', v, _EOL])
+    f.append(_EOL)
+    self.send_bytes((b''.join(f),))
+
+  @classmethod
+  def build_by_url(cls, sa, url, ssl_context=None, **kwargs):
+    """Return (stream, start) for a ws:// or wss:// URL; calling start()
+      looks up the host and connects."""
+    if isinstance(url, str):
+      url = url.encode('ascii')
+    # Query understands the equivalent HTTP URLs.
+    if url.startswith(b'ws'):
+      url = b'http' + url[2:]
+    query = Query(url)
+    self = cls(sa.ed, run_start=False, **kwargs)
+
+    def connect_cb(*args):
+      self._ws_request_send(query)
+
+    if (query.is_ssl):
+      self.do_ssl_handshake(connect_cb, ssl_context=ssl_context,
+        server_hostname=query.host.decode('ascii'))
+      connect_cb = None
+
+    def start():
+      self.connect_async_sock_bydns(sa, query.host, query.port, connect_callback=connect_cb)
+    return self, start
+
+  def _process_input1(self):
+    if (self.ws_open):
+      self._ws_frames_process()
+      return
+    off = self._inbuf.find(_HDR_END, self._ws_hdr_offset, self._index_in)
+    if off < 0:
+      self._ws_hdr_offset = max(self._index_in-3, 0)
+      return
+    hdr_data = bytes(self._inbuf[:off])
+    self.discard_inbuf_data(off+4)
+    try:
+      (start_line, hdrs) = _hdrs_parse(hdr_data)
+    except ValueError:
+      (start_line, hdrs) = (None, {})
+    if (self._ws_server):
+      ok = self._ws_handshake_server(start_line, hdrs)
+    else:
+      ok = self._ws_handshake_client(start_line, hdrs)
+    if not (ok):
+      return
+
+    self.ws_open = True
+    if (self._ws_ping_interval):
+      self._ws_timer = self._ed.set_timer(self._ws_ping_interval,
+        self._ws_keepalive, persist=True)
+      self.close_hook_add(self._ws_timer.cancel)
+    self.process_open()
+    if (self._index_in and self):
+      self._ws_frames_process()
+
+  def _ws_handshake_server(self, start_line, hdrs):
+    key = None
+    if ((start_line is not None) and start_line.startswith(b'GET ') and
+        (hdrs.get(b'upgrade', b'').lower() == b'websocket') and
+        (hdrs.get(b'sec-websocket-version') == b'13')):
+      key = hdrs.get(b'sec-websocket-key')
+    if (key is None):
+      _log(25, '{0}: Bad WebSocket upgrade request {1!a}.'.format(self, start_line))
+      self.send_bytes((b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n',))
+      self._ws_close_flushed()
+      return False
+
+    f = [
+      b'HTTP/1.1 101 Switching Protocols', _EOL,
+      b'Upgrade: websocket', _EOL,
+      b'Connection: Upgrade', _EOL,
+      b'Sec-WebSocket-Accept: ', _ws_accept_key(key), _EOL,
+    ]
+    offered = [p.strip().decode('ascii', 'replace') for p in
+      hdrs.get(b'sec-websocket-protocol', b'').split(b',')]
+    for p in self._ws_protocols:
+      if (p in offered):
+        self.protocol = p
+        f.extend((b'Sec-WebSocket-Protocol: ', p.encode('ascii'), _EOL))
+        break
+    f.append(_EOL)
+    self.send_bytes((b''.join(f),))
+    return True
+
+  def _ws_handshake_client(self, start_line, hdrs):
+    status = None
+    if (start_line is not None):
+      try:
+        status = int(start_line.split()[1])
+      except (IndexError, ValueError):
+        pass
+    if ((status != 101) or
+        (hdrs.get(b'sec-websocket-accept') != _ws_accept_key(self._ws_key))):
+      _log(25, '{0}: WebSocket upgrade refused: {1!a}.'.format(self, start_line))
+      self.close()
+      return False
+    p = hdrs.get(b'sec-websocket-protocol')
+    if not (p is None):
+      self.protocol = p.decode('ascii', 'replace')
+    return True
+
+  def _ws_frames_process(self):
+    buf = self._inbuf
+    pos = 0
+    # Parse as many complete frames as we have, then discard them all at
+    # once, instead of moving the remaining data after every frame.
+    while (self.ws_open and self):
+      avail = self._index_in - pos
+      need = 2
+      if (avail >= 2):
+        (b0, b1) = (buf[pos], buf[pos+1])
+        ln = b1 & 0x7f
+        if (ln == 126):
+          need = 4
+          if (avail >= need):
+            ln = _HDR_LEN16.unpack_from(buf, pos)[2]
+        elif (ln == 127):
+          need = 10
+          if (avail >= need):
+            ln = _HDR_LEN64.unpack_from(buf, pos)[2]
+        masked = bool(b1 & 0x80)
+        if (masked):
+          need += 4
+        if (avail >= need):
+          if (ln > self._ws_msg_size_max):
+            self._ws_fail(CLOSE_TOO_BIG)
+            break
+          need += ln
+      if (avail < need):
+        self.size_need = need
+        break
+
+      payload = memoryview(buf)[pos+need-ln:pos+need]
+      if (masked):
+        payload = _ws_mask(payload, bytes(buf[pos+need-ln-4:pos+need-ln]))
+      else:
+        payload = payload.tobytes()
+      pos += need
+      self._ws_frame_process(b0, masked, payload)
+
+    if (pos and self):
+      self.discard_inbuf_data(pos)
+
+  def _ws_frame_process(self, b0, masked, payload):
+    opcode = b0 & 0x0f
+    fin = bool(b0 & 0x80)
+    if ((b0 & 0x70) or (masked != self._ws_server)):
+      self._ws_fail(CLOSE_PROTOCOL_ERROR)
+      return
+
+    if (opcode & 0x08):
+      # Control frame; may be interleaved with fragments of a message.
+      if ((not fin) or (len(payload) > 125)):
+        self._ws_fail(CLOSE_PROTOCOL_ERROR)
+      elif (opcode == OP_PING):
+        self._ws_frame_send(OP_PONG, payload)
+      elif (opcode == OP_PONG):
+        self._ws_ping_pending = False
+      elif (opcode == OP_CLOSE):
+        self._ws_close_process(payload)
+      else:
+        self._ws_fail(CLOSE_PROTOCOL_ERROR)
+      return
+
+    if (opcode == OP_CONT):
+      if (self._ws_frags is None):
+        self._ws_fail(CLOSE_PROTOCOL_ERROR)
+        return
+      self._ws_frags.append(payload)
+      if (sum(len(f) for f in self._ws_frags) > self._ws_msg_size_max):
+        self._ws_fail(CLOSE_TOO_BIG)
+        return
+      if not (fin):
+        return
+      opcode = self._ws_frag_op
+      payload = b''.join(self._ws_frags)
+      self._ws_frags = self._ws_frag_op = None
+    elif (opcode in (OP_TEXT, OP_BINARY)):
+      if not (self._ws_frags is None):
+        self._ws_fail(CLOSE_PROTOCOL_ERROR)
+        return
+      if not (fin):
+        self._ws_frags = [payload]
+        self._ws_frag_op = opcode
+        return
+    else:
+      self._ws_fail(CLOSE_PROTOCOL_ERROR)
+      return
+
+    if (opcode == OP_TEXT):
+      try:
+        payload = payload.decode('utf-8')
+      except UnicodeDecodeError:
+        self._ws_fail(CLOSE_INVALID_DATA)
+        return
+    self.process_message(payload)
+
+  def _ws_close_process(self, payload):
+    if (len(payload) == 1):
+      # A status code takes two bytes.
+      self._ws_fail(CLOSE_PROTOCOL_ERROR)
+      return
+    if (len(payload) >= 2):
+      code = struct.unpack('>H', payload[:2])[0]
+    else:
+      code = CLOSE_NORMAL
+    if not (self._ws_close_sent):
+      self._ws_frame_send(OP_CLOSE, struct.pack('>H', code))
+      self._ws_close_sent = True
+    self.ws_open = False
+    self._ws_close_flushed()
+
+  def _ws_close_flushed(self):
+    """Close stream once pending output has been sent."""
+    if (self.output_pending()):
+      self.drain_notify(self.close)
+    else:
+      self.close()
+
+  def _ws_fail(self, code):
+    _log(25, '{0}: Failing WebSocket connection with code {1}.'.format(self, code))
+    self.ws_close(code)
+    self.ws_open = False
+    self._ws_close_flushed()
+
+  def _ws_keepalive(self):
+    if (self._ws_ping_pending):
+      _log(25, '{0}: No pong within {1} seconds; closing.'.format(self, self._ws_ping_interval))
+      self.close()
+      return
+    self._ws_ping_pending = True
+    self.ping()
+
+  def _ws_frame_send(self, opcode, payload, fin=True):
+    n = len(payload)
+    b0 = opcode | (0x80 if fin else 0)
+    mbit = 0 if self._ws_server else 0x80
+    if (n < 126):
+      hdr = bytes((b0, mbit | n))
+    elif (n < 65536):
+      hdr = _HDR_LEN16.pack(b0, mbit | 126, n)
+    else:
+      hdr = _HDR_LEN64.pack(b0, mbit | 127, n)
+    if not (self._ws_server):
+      # Clients have to mask everything they send.
+      key = os.urandom(4)
+      hdr += key
+      payload = _ws_mask(payload, key)
+    # Header and payload go out in one vectored write.
+    self.send_bytes((hdr, payload))
+
+  def send_message(self, data):
+    """Send str as text message, or bytes-like as binary message."""
+    if ((not self.ws_open) or self._ws_close_sent):
+      raise ValueError('WebSocket {0!a} is not open.'.format(self))
+    if (isinstance(data, str)):
+      self._ws_frame_send(OP_TEXT, data.encode('utf-8'))
+    else:
+      self._ws_frame_send(OP_BINARY, data)
+
+  def ping(self, data=b''):
+    """Send ping frame."""
+    self._ws_frame_send(OP_PING, data)
+
+  def ws_close(self, code=CLOSE_NORMAL, reason=''):
+    """Start WebSocket closing handshake; the stream is closed once the peer
+      has answered."""
+    if (self._ws_close_sent or (not self)):
+      return
+    self._ws_close_sent = True
+    # Control frame payloads are limited to 125 bytes; don't cut a character
+    # in half to get there.
+    reason = reason.encode('utf-8')[:123].decode('utf-8', 'ignore')
+    self._ws_frame_send(OP_CLOSE, struct.pack('>H', code) +
+      reason.encode('utf-8'))
+
+
+def _selftest(out=None):
+  """Run handshake, echo and closing handshake over a socketpair."""
+  import socket
+  import sys
+  from . import ED_get
+  if (out is None):
+    out = sys.stdout
+
+  ed = ED_get()()
+  log_s = []
+  log_c = []
+  big = os.urandom(1 << 20)
+
+  class Server(AsyncWebSocketStream):
+    def process_message(self, data):
+      log_s.append(data if isinstance(data, str) else len(data))
+      self.send_message(data)
+    def process_close(self):
+      log_s.append('closed')
+
+  class Client(AsyncWebSocketStream):
+    def process_open(self):
+      log_c.append(('open', self.protocol))
+      self.send_message('h\xe9llo')
+      # Fragmented message, with a ping in between.
+      self._ws_frame_send(OP_TEXT, b'frag1-', fin=False)
+      self.ping(b'p')
+      self._ws_frame_send(OP_CONT, b'frag2')
+      self.send_message(big)
+    def process_message(self, data):
+      log_c.append(data if isinstance(data, str) else (data == big))
+      if not (isinstance(data, str)):
+        self.ws_close(CLOSE_NORMAL, '\xe9' * 100)
+        try:
+          self.send_message('late')
+        except ValueError:
+          log_c.append('late message refused')
+    def process_close(self):
+      log_c.append('closed')
+      ed.set_timer(0.1, ed.shutdown)
+
+  (sock_s, sock_c) = socket.socketpair()
+  server = Server(ed, sock_s, server_side=True, protocols=('chat',))
+  client = Client(ed, sock_c, protocols=('x', 'chat'))
+  del(sock_s, sock_c)
+  client._ws_request_send(Query(b'http://localhost/ws'))
+  ed.set_timer(10, ed.shutdown)
+  ed.event_loop()
+  out.write('Server: {0!a}\nClient: {1!a}\n'.format(log_s, log_c))
+  if (log_s != ['h\xe9llo', 'frag1-frag2', len(big), 'closed']):
+    raise Exception('Server side mismatch.')
+  if (log_c != [('open', 'chat'), 'h\xe9llo', 'frag1-frag2', True,
+      'late message refused', 'closed']):
+    raise Exception('Client side mismatch.')
+  if (server or client):
+    raise Exception('Streams left open after closing handshake.')
+  out.write('All tests passed.\n')
+
+if (__name__ == '__main__'):
+  _selftest()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#Copyright 2008, 2009 Sebastian Hagen
+# This file is part of gonium.
+#
+# gonium is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# gonium is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Management of forked worker processes.
+
+import logging
+import os
+import signal
+from socket import AF_INET, SOCK_STREAM, SOMAXCONN
+
+from . import ED_get
+from .stream import AsyncSockServer
+
+_logger = logging.getLogger('gonium.fdm.workers')
+_log = _logger.log
+
+
+class WorkerSupervisor:
+   """Forks and supervises a fixed number of worker processes.
+
+   Dead workers are restarted after restart_delay seconds, until stop() is
+   called. Worker exits are noticed through pidfds where available, and by
+   polling every reap_interval seconds otherwise. With cpu_affinity, worker
+   i is pinned to CPU cpus[i], with CPUs allowed for this process assigned
+   round-robin.
+
+   public instance methods:
+      start(): Fork all workers.
+      stop(sig): Stop restarting workers, and send them sig.
+
+   Public attributes (intended for reading only):
+      cpus: list of CPUs workers are pinned to, or None without
+         cpu_affinity
+   Public attributes (r/w):
+      worker_run(index): Run worker with specified index; called in the
+         forked child process, which exits when it returns.
+   """
+   def __init__(self, ed, worker_count:int, worker_run=None, *,
+         cpu_affinity:bool=False, restart_delay:float=1,
+         reap_interval:float=1):
+      self._ed = ed
+      self.worker_count = worker_count
+      if not (worker_run is None):
+         self.worker_run = worker_run
+      self.cpu_affinity = cpu_affinity
+      if (cpu_affinity):
+         cpus = sorted(os.sched_getaffinity(0))
+         self.cpus = [cpus[i % len(cpus)] for i in range(worker_count)]
+      else:
+         self.cpus = None
+      self.restart_delay = restart_delay
+      self._reap_interval = reap_interval
+      self._reap_timer = None
+      self.pids = [None]*worker_count
+      self._pidfws = {}
+      self._stopping = False
+
+   def worker_run(self, index:int):
+      """Should be overridden by instance user: run worker in child process."""
+      raise NotImplementedError()
+
+   def start(self):
+      """Fork all workers."""
+      self._stopping = False
+      for i in range(self.worker_count):
+         if (self.pids[i] is None):
+            self._worker_start(i)
+      if ((not hasattr(os, 'pidfd_open')) and (self._reap_timer is None)):
+         self._reap_timer = self._ed.set_timer(self._reap_interval,
+            self._reap, persist=True)
+
+   def stop(self, sig:int=signal.SIGTERM):
+      """Stop restarting workers, and send sig to all live ones."""
+      self._stopping = True
+      if not (self._reap_timer is None):
+         self._reap_timer.cancel()
+         self._reap_timer = None
+      for pid in self.pids:
+         if (pid is None):
+            continue
+         try:
+            os.kill(pid, sig)
+         except ProcessLookupError:
+            pass
+
+   def _worker_start(self, i):
+      """Fork worker with index i."""
+      if (self._stopping):
+         return
+      pid = os.fork()
+      if (pid == 0):
+         self._worker_main(i)
+
+      _log(20, '{0} started worker {1} as pid {2}.'.format(self, i, pid))
+      self.pids[i] = pid
+      try:
+         pidfd = os.pidfd_open(pid)
+      except (AttributeError, OSError):
+         return
+      fw = self._ed.fd_wrap(pidfd)
+      fw.process_readability = lambda: self._pidfd_process(fw, i, pid)
+      fw.read_r()
+      self._pidfws[i] = fw
+
+   def _worker_main(self, i):
+      """Run worker in child process; never returns."""
+      rv = 1
+      try:
+         if not (self.cpus is None):
+            os.sched_setaffinity(0, (self.cpus[i],))
+         self.worker_run(i)
+         rv = 0
+      except BaseException:
+         _log(40, 'Worker {0} of {1} failed:'.format(i, self), exc_info=True)
+      finally:
+         os._exit(rv)
+
+   def _pidfd_process(self, fw, i, pid):
+      """Process readability of pidfd of worker."""
+      fw.close()
+      del(self._pidfws[i])
+      self._worker_reap(i, pid)
+
+   def _reap(self):
+      """Collect exited workers."""
+      for (i, pid) in enumerate(self.pids):
+         if not (pid is None):
+            self._worker_reap(i, pid)
+
+   def _worker_reap(self, i, pid):
+      """Collect exit status of worker, and schedule restart if it has
+         exited."""
+      try:
+         (pid_r, status) = os.waitpid(pid, os.WNOHANG)
+      except ChildProcessError:
+         status = None
+      else:
+         if (pid_r == 0):
+            return
+
+      _log(30, 'Worker {0} (pid {1}) of {2} exited with status {3!a}.'.format(i, pid, self, status))
+      self.pids[i] = None
+      self.process_worker_exit(i, status)
+      if not (self._stopping):
+         self._ed.set_timer(self.restart_delay, self._worker_start, args=(i,))
+
+   def process_worker_exit(self, index:int, status):
+      """Process exit of a worker; intended to be overridden by instance
+         users."""
+      pass
+
+
+class ShardedSockServer(WorkerSupervisor):
+   """Listening socket address served by several forked worker processes.
+
+   Each worker gets its own SO_REUSEPORT listening socket, so the kernel
+   balances incoming connections over them. The sockets are opened by the
+   supervising process before forking and kept open there, so the group
+   keeps its member order, and connections queued for a dead worker are
+   served by its replacement.
+
+   With cpu_steering, workers are pinned to one CPU each, and a BPF program
+   hands connections to the worker running on the CPU they were received on;
+   there can't be more workers than CPUs this process may run on. With
+   fewer, connections received on the other CPUs are balanced as usual.
+
+   Public attributes (r/w):
+      worker_setup(ed, server, index): Called in each worker process with
+         its new event dispatcher and AsyncSockServer. The worker runs ed's
+         event loop after this returns, and exits when that does.
+   """
+   def __init__(self, ed, address, worker_count:int, worker_setup=None, *,
+         family:int=AF_INET, proto:int=0, type_:int=SOCK_STREAM,
+         backlog:int=SOMAXCONN, cpu_steering:bool=False, **kwargs):
+      if (cpu_steering):
+         cpu_count = len(os.sched_getaffinity(0))
+         if (worker_count > cpu_count):
+            raise ValueError('CPU steering would leave workers beyond the {0} available CPUs idle.'.format(cpu_count))
+      WorkerSupervisor.__init__(self, ed, worker_count,
+         cpu_affinity=cpu_steering, **kwargs)
+      if not (worker_setup is None):
+         self.worker_setup = worker_setup
+      self.socks = []
+      for i in range(worker_count):
+         sock = AsyncSockServer.build_listen_sock(address, family=family,
+            proto=proto, type_=type_, backlog=backlog, reuseport=True)
+         self.socks.append(sock)
+         # Pin down the port, in case we were asked for an ephemeral one.
+         address = sock.getsockname()
+      if (cpu_steering):
+         AsyncSockServer.sock_attach_cpu_steering(self.socks[0], self.cpus)
+
+   def worker_setup(self, ed, server, index:int):
+      """Should be overridden by instance user: set up worker."""
+      raise NotImplementedError()
+
+   def worker_run(self, index:int):
+      for (i, sock) in enumerate(self.socks):
+         if (i != index):
+            sock.close()
+      ed = ED_get()()
+      server = AsyncSockServer(ed, None, sock=self.socks[index])
+      self.worker_setup(ed, server, index)
+      ed.event_loop()
+
+   def close(self):
+      """Stop workers and close listening sockets."""
+      self.stop()
+      for sock in self.socks:
+         sock.close()
@@ -20,7 +20,8 @@ from .fdm import ED_get
 
 class ServiceAggregate:
    """Aggregate of pseudo-singleton highly-stateful callbacking services"""
-   def __init__(self, ed=None, sc=None, aio=None, dtd=None, dnslm=None):
+   def __init__(self, ed=None, sc=None, aio=None, dtd=None, dnslm=None,
+         connpool=None, membudget=None):
       if (ed is None):
          ed = ED_get()()
       self.ed = ed
@@ -30,6 +31,8 @@ class ServiceAggregate:
       self.aio = aio
       self.dtd = dtd
       self.dnslm = dnslm
+      self.connpool = connpool
+      self.membudget = membudget
    
    def add_aio(self):
       """Instantiate and store EAIOManager (posix.aio)"""
@@ -53,6 +56,22 @@ class ServiceAggregate:
       
       rc = ResolverConfig.build_from_file()
       self.dnslm = rc.build_lookup_manager(self.ed)
+   
+   def add_connpool(self, **kwargs):
+      """Instantiate and store ConnectionPool (fdm.connpool)"""
+      from .fdm.connpool import ConnectionPool
+      if not (self.connpool is None):
+         raise Exception('I already have a ConnectionPool object.')
+      
+      self.connpool = ConnectionPool(self, **kwargs)
+   
+   def add_membudget(self, limit, **kwargs):
+      """Instantiate and store MemoryBudget (fdm.stream)"""
+      from .fdm.stream import MemoryBudget
+      if not (self.membudget is None):
+         raise Exception('I already have a MemoryBudget object.')
+      
+      self.membudget = MemoryBudget(limit, **kwargs)
 
 # Ugly workaround for cyclical inter-file dependencies
 from .posix.signal import EMSignalCatcher